@@ -0,0 +1,365 @@
+#!/usr/bin/python
+
+# An asyncio client (Python 3 only): the handlers, events and sending API
+# of client.Client, without gevent.  Handler functions that are coroutines
+# are run as tasks; everything else is called as the event is dispatched,
+# so plain handlers must not block.
+#
+#	client = aio.SimpleClient('flyrcbot', 'flyrc', 'Flyrc', 'irc.example.net', 6697, ssl=True)
+#	client.add_handler(MyHandler())
+#	await aio.run(client)
+
+import asyncio
+import inspect
+import ssl as _ssl
+import sys
+from time import time
+from flyrc import base, framing, message, offload, throttle, util
+from flyrc.base import Overload
+
+class _Protocol(asyncio.Protocol):
+	def __init__(self, client):
+		self.client = client
+
+	def connection_made(self, transport):
+		self.client._connection_made(transport)
+
+	def data_received(self, data):
+		self.client._data_received(data)
+
+	def connection_lost(self, exc):
+		self.client._connection_lost(exc)
+
+	def pause_writing(self):
+		self.client._writable.clear()
+
+	def resume_writing(self):
+		self.client._writable.set()
+
+class Client(base.BaseClient):
+	"""A client connected through an asyncio Protocol.
+
+	ssl may be True for the default TLS settings or an ssl.SSLContext.
+	If more than dispatch_limit handler tasks are running, the client
+	stops reading from the server until half of them have finished.
+	Ordered dispatch (order_key, enforce_order) is only available in the
+	gevent client.
+	"""
+	def __init__(self, host, port, ssl=False, timeout=300, source=None, loop=None):
+		self.host = host
+		self.port = port
+		self.ssl = ssl
+		self.timeout = timeout
+		self._source = source
+		self._loop = loop
+		self._transport = None
+		# Running handler task -> handler function.
+		self._tasks = {}
+		# Coroutines from handlers run before there was a loop to run
+		# them on, started on connect().
+		self._deferred = []
+		# Created on the loop the client runs on (see _init_events);
+		# before Python 3.10 an Event is bound to the loop current when
+		# it's made, which needn't be that one.
+		self._sready = None
+		self._writable = None
+		self._finished = None
+		self._sender = None
+		self._watchdog = None
+		self._last_recv = 0
+
+		self.dispatch_limit = 1000
+		self._paused = False
+
+		self.max_line = framing.MAX_LINE
+		self.line_overflow = framing.Overflow.TRUNCATE
+		self._framer = None
+		# A record.Recorder to log traffic to, or None.
+		self.recorder = None
+
+		super(Client, self).__init__()
+
+	def _init_metrics(self):
+		super(Client, self)._init_metrics()
+		m = self.metrics
+		m.gauge('send_queue_depth', 'Messages waiting to be sent.', lambda: len(self._squeue))
+		m.gauge('handlers_running', 'Handler tasks currently running.', lambda: len(self._tasks))
+		self._lines_overflowed = m.counter('lines_overflowed_total', 'Received lines that exceeded max_line.')
+
+	@property
+	def connected(self):
+		"""Whether the client currently has a connection open."""
+		return self._transport is not None
+
+	def _running_loop(self):
+		if self._loop is None:
+			try:
+				self._loop = asyncio.get_running_loop()
+			except RuntimeError:
+				return None
+		return self._loop
+
+	# Transport hooks (see base.BaseClient).
+
+	def _spawn(self, func, *args, **kwargs):
+		try:
+			result = func(*args, **kwargs)
+		except Exception:
+			self._report_error(func)
+			return None
+		if not inspect.isawaitable(result):
+			return None
+		loop = self._running_loop()
+		if loop is None:
+			self._deferred.append((func, result))
+			return None
+		return self._start_task(func, result)
+
+	def _start_task(self, func, coro):
+		task = asyncio.ensure_future(coro, loop=self._loop)
+		self._tasks[task] = func
+		task.add_done_callback(self._task_done)
+		if self.dispatch_limit and len(self._tasks) >= self.dispatch_limit and not self._paused:
+			self._pause()
+		return task
+
+	def _task_done(self, task):
+		func = self._tasks.pop(task, None)
+		if not task.cancelled() and task.exception() is not None:
+			self._report(func, task.exception())
+		if self._paused and len(self._tasks) <= (self.dispatch_limit or 0) // 2:
+			self._resume()
+
+	def _report_error(self, func):
+		self._report(func, sys.exc_info()[1])
+
+	def _report(self, func, exc):
+		context = {'message': 'Exception in handler %s' % util.handler_name(func), 'exception': exc}
+		loop = self._running_loop()
+		if loop is not None:
+			loop.call_exception_handler(context)
+		else:
+			sys.excepthook(type(exc), exc, exc.__traceback__)
+
+	def _current(self):
+		return asyncio.current_task()
+
+	def _wake_sender(self):
+		if self._sready is not None:
+			self._sready.set()
+
+	def _init_events(self):
+		if self._finished is None:
+			self._sready = asyncio.Event()
+			self._writable = asyncio.Event()
+			self._finished = asyncio.Event()
+
+	async def _offload(self, func, args, kwargs):
+		loop = self._running_loop()
+		future = loop.create_future()
+		def done(outcome):
+			# Called from the pool's result thread.
+			try:
+				loop.call_soon_threadsafe(_set_result, future, outcome)
+			except RuntimeError:
+				# The loop has been closed.
+				pass
+		start = time()
+		pool = self._submit(func, args, kwargs, done)
+		try:
+			outcome = await asyncio.wait_for(future, pool.timeout)
+		except asyncio.TimeoutError:
+			self._offload_timeouts.inc()
+			raise offload.OffloadTimeout(func, pool.timeout)
+		self._offloaded(func, outcome, time() - start)
+
+	def _run_timed(self, handler, timer, *args, **kwargs):
+		start = time()
+		result = handler(self, *args, **kwargs)
+		if inspect.isawaitable(result):
+			return self._timed(result, timer, start)
+		timer.observe(time() - start)
+
+	async def _timed(self, coro, timer, start):
+		try:
+			return await coro
+		finally:
+			timer.observe(time() - start)
+
+	# Backpressure.
+
+	def _pause(self):
+		self._paused = True
+		if self._transport is not None:
+			self._transport.pause_reading()
+		self._handle('client_overload', 'dispatch', Overload.PAUSE)
+
+	def _resume(self):
+		self._paused = False
+		if self._transport is not None:
+			self._transport.resume_reading()
+
+	# The connection.
+
+	async def connect(self):
+		"""Connect to the server.  Connection errors fire client_error,
+		as with client.Client.start."""
+		loop = self._running_loop()
+		self._init_events()
+		self._finished.clear()
+		for func, coro in self._deferred:
+			self._start_task(func, coro)
+		self._deferred = []
+		context = self.ssl
+		if context is True:
+			context = _ssl.create_default_context()
+		local = None
+		if self._source:
+			local = (self._source, 0)
+		try:
+			await asyncio.wait_for(loop.create_connection(lambda: _Protocol(self), self.host, self.port, ssl=context or None, local_addr=local), self.timeout)
+		except (OSError, asyncio.TimeoutError) as e:
+			self._handle('client_error', message.Error(e, message.Step.CONNECT))
+
+	def start(self):
+		"""Start connecting in the background, returning the task."""
+		return asyncio.ensure_future(self.connect(), loop=self._loop)
+
+	def stop(self):
+		"""Close the connection; client_disconnected fires once it's
+		closed."""
+		if self._transport is not None:
+			self._transport.close()
+
+	def shutdown(self):
+		self.stop()
+		for task in list(self._tasks):
+			task.cancel()
+		self._squeue = throttle.OutgoingQueue()
+		self._drop_batches()
+		if self._finished is not None:
+			self._finished.set()
+
+	async def join(self):
+		"""Wait until the client is shut down and its handler tasks have
+		finished."""
+		self._init_events()
+		await self._finished.wait()
+		if self._tasks:
+			await asyncio.wait(list(self._tasks))
+
+	def _connection_made(self, transport):
+		self._transport = transport
+		self._framer = framing.LineFramer(self.max_line, self.line_overflow, overflows=self._lines_overflowed)
+		self._drop_batches()
+		self._writable.set()
+		self._last_recv = self._loop.time()
+		if self.timeout:
+			self._watchdog = self._loop.call_later(self.timeout, self._check_timeout)
+		self._sender = self._loop.create_task(self._send_loop())
+		if self._paused:
+			transport.pause_reading()
+		self._handle('client_connected')
+
+	def _connection_lost(self, exc):
+		self._transport = None
+		if self._watchdog is not None:
+			self._watchdog.cancel()
+			self._watchdog = None
+		if self._sender is not None:
+			self._sender.cancel()
+			self._sender = None
+		self._drop_batches()
+		self._handle('client_disconnected')
+		if exc is not None:
+			self._handle('client_error', message.Error(exc, message.Step.RECV))
+
+	def _check_timeout(self):
+		idle = self._loop.time() - self._last_recv
+		if idle < self.timeout:
+			self._watchdog = self._loop.call_later(self.timeout - idle, self._check_timeout)
+			return
+		self._watchdog = None
+		transport = self._transport
+		if transport is not None:
+			self._transport = None
+			transport.abort()
+			self._handle('client_error', message.Error(asyncio.TimeoutError('timed out'), message.Step.RECV))
+
+	def _data_received(self, data):
+		self._last_recv = self._loop.time()
+		try:
+			lines = self._framer.feed(data)
+		except framing.LineTooLong as e:
+			self._handle('client_error', message.Error(e, message.Step.RECV))
+			self.stop()
+			return
+		self._lines_in.inc(len(lines))
+		self._bytes_in.inc(len(data))
+		if self.recorder is not None:
+			self.recorder.received(lines)
+		for line in lines:
+			msg = message.Message.parse(line.decode('utf-8', 'replace'))
+			if (self._batches or msg.command == 'BATCH') and self._collect_batch(msg):
+				continue
+			self._dispatch_message(msg)
+
+	async def _send_loop(self):
+		while True:
+			squeue = self._squeue
+			if not squeue:
+				self._sready.clear()
+				await self._sready.wait()
+				continue
+
+			# Take everything the throttle allows right now, highest
+			# priority first.  Critical lines never wait for tokens.
+			wait = 0
+			lines = []
+			while squeue:
+				priority, line = squeue.peek()
+				if priority != throttle.Priority.CRITICAL:
+					wait = self.throttle.wait_time(len(line))
+					if wait:
+						break
+				squeue.pop(priority)
+				self.throttle.consume(len(line))
+				lines.append(line)
+				if self.recorder is not None:
+					self.recorder.sent(line)
+				self._bytes_out.inc(len(line))
+
+			if lines:
+				self._transport.write(b''.join(lines))
+				self._lines_out.inc(len(lines))
+				# Let the transport's buffer drain if it's full.
+				await self._writable.wait()
+
+			if wait:
+				# Sleep until the throttle allows the next line, or
+				# something new (possibly critical) is queued.
+				self._sready.clear()
+				start = time()
+				try:
+					await asyncio.wait_for(self._sready.wait(), wait)
+				except asyncio.TimeoutError:
+					pass
+				self._throttled.observe(time() - start)
+			else:
+				await asyncio.sleep(0)
+
+def _set_result(future, result):
+	if not future.done():
+		future.set_result(result)
+
+class SimpleClient(Client):
+	def __init__(self, nick, user, gecos, host, port, ssl=False, timeout=300, autoreconnect=False, version=None, source=None, loop=None):
+		super(SimpleClient, self).__init__(host, port, ssl, timeout, source, loop)
+
+		for h in base.simple_handlers(nick, user, gecos, autoreconnect, version):
+			self.add_handler(h)
+
+async def run(client):
+	"""Connect client and wait until it has been shut down."""
+	await client.connect()
+	await client.join()
@@ -0,0 +1,803 @@
+#!/usr/bin/python
+
+# The parts of a client that don't depend on how it talks to the server:
+# handler loading, event dispatch, and queueing messages to send.  The
+# gevent client (client.Client) and the asyncio one (aio.Client) build on
+# this, and neither this nor the modules it uses import gevent.
+
+import sys
+from time import time
+from flyrc import cache, compat, handler, message, metrics, offload, throttle, util
+
+class Overload():
+	# Stop reading from the socket until the receive queue drains,
+	# letting TCP push back on the server.
+	PAUSE=0
+	# Drop incoming lines other than client.ESSENTIAL_COMMANDS.
+	SHED=1
+	# Drop every incoming line until the receive queue drains to half
+	# its limit.
+	DROP=2
+
+class ClientError(Exception):
+	"""A generic flyrc client error."""
+
+class DuplicateHandlerObject(ClientError):
+	"""Exception raised when an already-added handler is added a
+	second time.
+
+	Attributes:
+		obj - the object itself.
+	"""
+	def __init__(self, obj):
+		self.obj = obj
+
+class MissingHandlerObject(ClientError):
+	"""Exception raised when attempting to remove a handler that isn't
+	loaded.
+
+	Attributes:
+		obj - the object itself.
+	"""
+	def __init__(self, obj):
+		self.obj = obj
+
+class DependencyViolation(ClientError):
+	"""Exception raised when adding or removing a handler causes a
+	dependency violation of some kind.
+
+	Attributes:
+		args - the object subject to the conflict.
+	"""
+
+class UnsatisfiedDependency(DependencyViolation):
+	"""Exception raised when a dependency isn't satisfied.
+
+	Attributes:
+		args - the missing dependency.
+	"""
+
+class LingeringDependency(DependencyViolation):
+	"""Exception raised when a handler being unloaded still has
+	dependencies.
+
+	Attributes:
+		args - the handler being unloaded.
+	"""
+
+class InvalidDependencyTree(DependencyViolation):
+	"""Exception raised when the dependency tree has become invalid
+	(probably due to prior Dependency exceptions.)
+
+	Attributes:
+		args - the handler with invalid dependency information.
+	"""
+
+class DependencyCycle(DependencyViolation):
+	"""Exception raised when handlers added together depend on each
+	other in a cycle.
+
+	Attributes:
+		args - the handlers involved.
+	"""
+
+def _batch_size(batch):
+	# The messages in batch, counting those in batches nested in it.
+	return sum(_batch_size(item) if isinstance(item, message.Batch) else 1 for item in batch.messages)
+
+class BaseClient(object):
+	"""A client without a connection.  Subclasses provide the transport:
+	they feed received messages to _handle_recv (or _dispatch_message),
+	write out what send queues in _squeue, and implement the hooks
+	below for running handlers.
+	"""
+	def __init__(self):
+		self._squeue = throttle.OutgoingQueue()
+
+		self._handlers = {}
+		self._handlerobjects = {}
+		# Handler -> (handlers satisfying its dependencies, event name ->
+		# function, (pattern, function) pairs), as found when it was added.
+		self._handlerinfo = {}
+		# Class -> loaded handlers that are instances of it, in load order.
+		self._types = {}
+		# Event name -> (inline handler functions, spawned handler functions)
+		self._dispatch = {}
+		# Pattern subscriptions (see util.subscribe): handler function ->
+		# patterns, and the index built from them: exact event name ->
+		# functions, prefix -> functions, and the distinct prefix lengths.
+		self._patterns = {}
+		self._pattern_exact = {}
+		self._pattern_prefixes = {}
+		self._prefix_lengths = ()
+		# Dispatch entries resolved from patterns alone, for events
+		# without handlers of their own.
+		self._resolved = cache.LRUCache(4096)
+		# (event name, function) -> ((function, timer), inline), so entries
+		# can be rebuilt without looking everything up again.
+		self._dispatch_items = {}
+		# Bumped whenever the set of handled events may have changed, so
+		# anything derived from it knows when to rebuild.
+		self.handlers_version = 0
+
+		self.throttle = throttle.Throttle()
+
+		# Our nick, and how to compare nicks and recognise channels on
+		# this server; handler.ISupport updates the latter two from
+		# CASEMAPPING and CHANTYPES.
+		self.nick = None
+		# Our own nick!user@host as the server sees it, once known (see
+		# handler.OwnHostmask).
+		self.hostmask = None
+		self.casefold = util.casefold
+		self.chantypes = util.DEFAULT_CHANTYPES
+
+		# Tasks dispatching ordered lanes (see client.Client.order_key);
+		# events triggered from one are handled in it, in order.
+		self._lane_workers = set()
+
+		# IRCv3 batches being collected: reference tag -> message.Batch.
+		# Batches are given up on (their messages dispatched one by one,
+		# as if they weren't batched) once more than batch_limit messages
+		# are held back, or when one has been open for batch_timeout
+		# seconds; past open_batch_limit open batches, new ones aren't
+		# collected at all.
+		self._batches = {}
+		self.batch_limit = 10000
+		self.open_batch_limit = 32
+		self.batch_timeout = 60
+		# Messages held back in open batches, and when the oldest open
+		# batch was opened (or a little earlier).
+		self._held = 0
+		self._oldest_batch = 0
+
+		# The offload.ProcessPool cpu_bound handler functions run in;
+		# offload.shared() if it's still None when one is added.
+		self.offload = None
+
+		self.metrics = metrics.Registry()
+		# Handler run times are sampled from one in this many dispatches
+		# (1 times every dispatch, 0 turns timing off).
+		self.timing_interval = 10
+		self._untimed = 1
+		self._init_metrics()
+
+	def _init_metrics(self):
+		m = self.metrics
+		self._lines_in = m.counter('lines_received_total', 'Lines received from the server.')
+		self._bytes_in = m.counter('bytes_received_total', 'Bytes received from the server.')
+		self._lines_out = m.counter('lines_sent_total', 'Lines written to the server.')
+		self._bytes_out = m.counter('bytes_sent_total', 'Bytes written to the server.')
+		self._throttled = m.histogram('throttle_wait_seconds', 'Time the send loop spent waiting on the throttle.')
+		self._batches_in = m.counter('batches_received_total', 'Server batches collected and dispatched.')
+		self._batches_abandoned = dict((reason, m.counter('batches_abandoned_total', 'Server batches dispatched line by line or dropped instead of collected.', reason=reason)) for reason in ('size', 'count', 'timeout', 'disconnect'))
+		self._offload_calls = m.counter('offload_calls_total', 'Handler calls sent to a worker process.')
+		self._offload_timeouts = m.counter('offload_timeouts_total', 'Offloaded handler calls that timed out.')
+		self._offload_time = m.histogram('offload_seconds', 'Time from offloading a handler call to getting its results.')
+		m.gauge('offload_queue_depth', 'Calls waiting for or running in the offload pool.', lambda: self.offload.pending if self.offload is not None else 0)
+
+	# Transport hooks.
+
+	def _spawn(self, func, *args, **kwargs):
+		"""Run a handler function that isn't inline, concurrently with
+		dispatch."""
+		raise NotImplementedError
+
+	def _report_error(self, func):
+		"""Report the exception being handled, raised by func."""
+		raise NotImplementedError
+
+	def _current(self):
+		"""The task (greenlet, coroutine task) running right now."""
+		raise NotImplementedError
+
+	def _wake_sender(self):
+		"""Tell the transport there are messages queued in _squeue."""
+		raise NotImplementedError
+
+	def _dispatch_message(self, msg, handlers=None):
+		"""Dispatch a received message (see _handle_recv), in its
+		ordered lane if the transport has them."""
+		self._handle_recv(msg, handlers)
+
+	def _offload(self, func, args, kwargs):
+		"""Run a cpu_bound handler function in the offload pool (see
+		_submit) and wait for it, then apply what it sent (see
+		_offloaded)."""
+		raise NotImplementedError
+
+	# Offloading.
+
+	def _submit(self, func, args, kwargs, callback):
+		snapshot = {
+			'nick': self.nick,
+			'hostmask': self.hostmask,
+			'chantypes': self.chantypes,
+			'isupport': getattr(self, 'isupport', None)
+		}
+		self._offload_calls.inc()
+		self.offload.submit(func, snapshot, args, kwargs, callback)
+		return self.offload
+
+	def _offloaded(self, func, outcome, elapsed):
+		calls, details = outcome
+		self._offload_time.observe(elapsed)
+		if details is not None:
+			raise offload.OffloadError(func, details)
+		for name, args, kwargs in calls:
+			getattr(self, name)(*args, **kwargs)
+
+	def is_me(self, nick):
+		"""Whether nick is our own nick, under the server's casemapping."""
+		return self.nick is not None and self.casefold(nick) == self.casefold(self.nick)
+
+	def stats(self):
+		"""Return a snapshot of the client's metrics (see
+		metrics.Registry.collect)."""
+		return self.metrics.collect()
+
+	@property
+	def throttle_delay(self):
+		"""Seconds per message once the burst is used up (0 disables
+		throttling)."""
+		return self.throttle.delay
+
+	@throttle_delay.setter
+	def throttle_delay(self, d):
+		self.throttle.delay = d
+
+	@property
+	def throttle_burst(self):
+		"""Number of messages that can be sent without delay."""
+		return self.throttle.burst
+
+	@throttle_burst.setter
+	def throttle_burst(self, b):
+		self.throttle.burst = b
+
+	def _collect_batch(self, msg):
+		# Returns whether msg was held back as part of an open batch.
+		# BATCH lines themselves are dispatched as usual, a closing one
+		# after the batch it closes.
+		batches = self._batches
+		if batches and time() - self._oldest_batch >= self.batch_timeout:
+			self._expire_batches()
+		if msg.command == 'BATCH':
+			ref = msg.args and msg.args[0] or ''
+			if ref[:1] == '+' and len(msg.args) > 1:
+				if len(batches) >= self.open_batch_limit:
+					# Its lines are dispatched as they arrive.
+					self._batches_abandoned['count'].inc()
+					return False
+				if not batches:
+					self._oldest_batch = time()
+				parent = batches.get(msg.tags.get('batch'))
+				batch = batches[ref[1:]] = message.Batch(ref[1:], msg.args[1], msg.args[2:], msg, parent)
+				batch.opened = time()
+			elif ref[:1] == '-':
+				batch = batches.pop(ref[1:], None)
+				if batch is not None and batch.parent is not None:
+					batch.parent.messages.append(batch)
+				elif batch is not None:
+					self._held -= _batch_size(batch)
+					self._dispatch_batch(batch)
+			return False
+		batch = batches.get(msg.tags.get('batch'))
+		if batch is None:
+			return False
+		batch.messages.append(msg)
+		self._held += 1
+		if self._held > self.batch_limit:
+			while batch.parent is not None:
+				batch = batch.parent
+			self._abandon_batch(batch, 'size')
+		return True
+
+	def _expire_batches(self):
+		now = time()
+		for batch in sorted(self._batches.values(), key=lambda batch: batch.opened):
+			if batch.opened + self.batch_timeout > now:
+				break
+			if batch.ref in self._batches:
+				self._abandon_batch(batch, 'timeout')
+		if self._batches:
+			self._oldest_batch = min(batch.opened for batch in self._batches.values())
+
+	def _abandon_batch(self, batch, reason):
+		# Stop collecting batch and the batches open inside it, and
+		# dispatch what they hold as if it had never been batched.  Lines
+		# still to come for them are dispatched as they arrive.
+		self._batches.pop(batch.ref, None)
+		self._batches_abandoned[reason].inc()
+		self._held -= _batch_size(batch)
+		inner = [b for b in self._batches.values() if b.parent is batch]
+		for item in batch.messages:
+			if isinstance(item, message.Batch):
+				self._dispatch_batch(item)
+			else:
+				self._dispatch_message(item)
+		for b in inner:
+			self._abandon_batch(b, reason)
+
+	def _drop_batches(self):
+		# Batches left open when the connection ends never close.
+		if self._batches:
+			self._batches_abandoned['disconnect'].inc(len(self._batches))
+			self._batches = {}
+		self._held = 0
+
+	def _dispatch_batch(self, batch):
+		"""Fire batch_<type> with a finished batch, then dispatch its
+		messages one by one to every handler that doesn't handle
+		batch_<type> itself."""
+		self._batches_in.inc()
+		event = 'batch_' + batch.type.lower()
+		entry = self._dispatch.get(event)
+		if entry is None and self._patterns:
+			entry = self._resolve(event)
+		if not entry:
+			for item in batch.messages:
+				if isinstance(item, message.Batch):
+					self._dispatch_batch(item)
+				else:
+					self._dispatch_message(item)
+			return
+
+		self._handle(event, batch)
+		aware = set(getattr(handler, '__self__', handler) for handler, timer in entry[0] + entry[1])
+		# Event name -> (function, inline) for the handlers left.
+		unaware = {}
+
+		def handlers(name):
+			calls = unaware.get(name)
+			if calls is None:
+				calls = unaware[name] = self._handlers_except(name, aware)
+			return calls
+
+		for item in batch.messages:
+			if isinstance(item, message.Batch):
+				self._dispatch_batch(item)
+			else:
+				self._dispatch_message(item, handlers)
+
+	def _handlers_except(self, name, owners):
+		# The functions handling name, as (function, inline), leaving out
+		# those belonging to owners.
+		entry = self._dispatch.get(name)
+		if entry is None and self._patterns:
+			entry = self._resolve(name)
+		if not entry:
+			return ()
+		inline, spawned = entry
+		calls = [(handler, False) for handler, timer in spawned if getattr(handler, '__self__', handler) not in owners]
+		calls.extend((handler, True) for handler, timer in inline if getattr(handler, '__self__', handler) not in owners)
+		return calls
+
+	def dependency_satisfier(self, dep):
+		"""The loaded handler satisfying dep (a class), if any: the first
+		loaded handler that is an instance of it."""
+		satisfiers = self._types.get(dep)
+		if satisfiers:
+			return satisfiers[0]
+		return None
+
+	def add_handler(self, handler):
+		self.add_handlers([handler])
+
+	def add_handlers(self, handlers):
+		"""Add several handlers, loading them in an order that satisfies
+		their dependencies on each other and on handlers already loaded.
+		Nothing is added if any dependency can't be satisfied
+		(UnsatisfiedDependency) or the dependencies form a cycle
+		(DependencyCycle)."""
+		order = self._load_order(handlers)
+		names = set()
+		patterns = False
+		for handler in order:
+			h_funcs, h_patterns = self._add_handler(handler)
+			names.update(h_funcs)
+			patterns = patterns or bool(h_patterns)
+		if patterns:
+			self._index_patterns()
+		else:
+			self._update_dispatch(names)
+
+		# Special - spawn just these instances, not all "client_load" handlers.
+		for handler in order:
+			h_funcs = self._handlerinfo[handler][1]
+			if 'client_load' in h_funcs:
+				self._spawn(h_funcs['client_load'], self)
+
+	def _load_order(self, handlers):
+		handlers = list(handlers)
+		batch = set()
+		for handler in handlers:
+			if handler in self._handlerobjects or handler in batch:
+				raise DuplicateHandlerObject(handler)
+			batch.add(handler)
+
+		# Which handler in the batch provides each class.
+		provides = {}
+		for handler in handlers:
+			for cls in util.handler_class(handler.__class__).mro:
+				provides.setdefault(cls, handler)
+
+		# Kahn's algorithm, over dependencies not already satisfied by a
+		# loaded handler.
+		waiting = {}
+		dependents = dict((handler, []) for handler in handlers)
+		for handler in handlers:
+			count = 0
+			for dep in getattr(handler, 'DEPENDENCIES', ()):
+				if self.dependency_satisfier(dep) is not None:
+					continue
+				provider = provides.get(dep)
+				if provider is None:
+					raise UnsatisfiedDependency(dep)
+				if provider is handler:
+					raise DependencyCycle(handler)
+				dependents[provider].append(handler)
+				count += 1
+			waiting[handler] = count
+		order = [handler for handler in handlers if not waiting[handler]]
+		for handler in order:
+			for dependent in dependents[handler]:
+				waiting[dependent] -= 1
+				if not waiting[dependent]:
+					order.append(dependent)
+		if len(order) < len(handlers):
+			raise DependencyCycle(*[handler for handler in handlers if waiting[handler]])
+		return order
+
+	def _add_handler(self, handler):
+		dependencies, h_funcs = util.get_handler_properties(handler)
+		satisfiers = []
+		for dep in dependencies:
+			sat = self.dependency_satisfier(dep)
+			if sat is None:
+				raise UnsatisfiedDependency(dep)
+			satisfiers.append(sat)
+		for sat in satisfiers:
+			# Increment refcount.
+			self._handlerobjects[sat] += 1
+
+		patterns = util.get_handler_patterns(handler)
+		self._handlerobjects[handler] = 0
+		self._handlerinfo[handler] = (satisfiers, h_funcs, patterns)
+		for cls in util.handler_class(handler.__class__).mro:
+			if cls is not object:
+				self._types.setdefault(cls, []).append(handler)
+
+		for h_name, func in h_funcs.items():
+			if h_name in self._handlers:
+				self._handlers[h_name].add(func)
+			else:
+				self._handlers[h_name] = set([func])
+		for pattern, func in patterns:
+			self._patterns.setdefault(func, []).append(pattern)
+		if self.offload is None and any(util.is_cpu_bound(f) for f in list(h_funcs.values()) + [f for p, f in patterns]):
+			# Fork the workers now, rather than on the first call
+			# once there's a connection and more to copy.
+			self.offload = offload.shared()
+		return h_funcs, patterns
+
+	def remove_handler(self, handler):
+		if handler not in self._handlerobjects:
+			raise MissingHandlerObject(handler)
+
+		if self._handlerobjects[handler] > 0:
+			raise LingeringDependency(handler)
+
+		del self._handlerobjects[handler]
+		satisfiers, h_funcs, patterns = self._handlerinfo.pop(handler)
+		for sat in satisfiers:
+			if sat not in self._handlerobjects:
+				raise InvalidDependencyTree(sat)
+			# Decrement refcount.
+			self._handlerobjects[sat] -= 1
+			if self._handlerobjects[sat] < 0:
+				raise InvalidDependencyTree(sat)
+
+		for cls in util.handler_class(handler.__class__).mro:
+			if cls is not object:
+				loaded = self._types[cls]
+				loaded.remove(handler)
+				if not loaded:
+					del self._types[cls]
+
+		for h_name, func in h_funcs.items():
+			self._handlers[h_name].discard(func)
+			self._dispatch_items.pop((h_name, func), None)
+			# If there aren't any handler functions left, remove that event entirely.
+			if not self._handlers[h_name]:
+				del self._handlers[h_name]
+		if patterns:
+			for pattern, func in patterns:
+				self._patterns.pop(func, None)
+			self._index_patterns()
+		else:
+			self._update_dispatch(h_funcs)
+
+		# Special - spawn just this instance of client_unload.
+		if 'client_unload' in h_funcs:
+			self._spawn(h_funcs['client_unload'], self)
+
+	def _update_dispatch(self, names):
+		self.handlers_version += 1
+		for name in names:
+			entry = self._build_entry(name)
+			if entry:
+				self._dispatch[name] = entry
+			else:
+				self._dispatch.pop(name, None)
+
+	def _build_entry(self, name):
+		inline = []
+		spawned = []
+		for f in self._handlers.get(name, ()):
+			item = self._dispatch_items.get((name, f))
+			if item is None:
+				timer = self.metrics.histogram('handler_seconds', 'Time spent in each handler function (sampled, see timing_interval).', event=name, handler=util.handler_name(f))
+				if util.is_cpu_bound(f):
+					item = ((self._offload_caller(f), timer), False)
+				else:
+					item = ((f, timer), util.is_inline(f))
+				self._dispatch_items[name, f] = item
+			if item[1]:
+				inline.append(item[0])
+			else:
+				spawned.append(item[0])
+		if self._patterns:
+			for f in self._match_patterns(name):
+				timer = self.metrics.histogram('handler_seconds', 'Time spent in each handler function (sampled, see timing_interval).', event='*', handler=util.handler_name(f))
+				if util.is_cpu_bound(f):
+					spawned.append((self._offload_caller(f, (name,)), timer))
+					continue
+				call = self._pattern_caller(f, name)
+				if util.is_inline(f):
+					inline.append((call, timer))
+				else:
+					spawned.append((call, timer))
+		if inline or spawned:
+			return (tuple(inline), tuple(spawned))
+		return None
+
+	@staticmethod
+	def _pattern_caller(func, name):
+		def call(client, *args, **kwargs):
+			return func(client, name, *args, **kwargs)
+		# So the function can still be told apart by its handler.
+		call.__self__ = getattr(func, '__self__', func)
+		return call
+
+	@staticmethod
+	def _offload_caller(func, prefix=()):
+		def call(client, *args, **kwargs):
+			return client._offload(func, prefix + args, kwargs)
+		call.__self__ = getattr(func, '__self__', func)
+		call.__name__ = func.__name__
+		return call
+
+	def _index_patterns(self):
+		exact = {}
+		prefixes = {}
+		for func, patterns in self._patterns.items():
+			for pattern in patterns:
+				names, prefix = util.expand_pattern(pattern)
+				for name in names:
+					exact.setdefault(name, set()).add(func)
+				if prefix is not None:
+					prefixes.setdefault(prefix, set()).add(func)
+		self._pattern_exact = exact
+		self._pattern_prefixes = prefixes
+		self._prefix_lengths = tuple(sorted(set(len(p) for p in prefixes)))
+		self._resolved.clear()
+		self._update_dispatch(set(self._handlers) | set(self._dispatch))
+
+	def _match_patterns(self, name):
+		"""The pattern-subscribed functions for an event: one dict lookup
+		for exact names and numerics, plus one per distinct prefix
+		length, however many patterns there are."""
+		funcs = set(self._pattern_exact.get(name, ()))
+		prefixes = self._pattern_prefixes
+		for length in self._prefix_lengths:
+			if length > len(name):
+				break
+			matched = prefixes.get(name[:length])
+			if matched:
+				funcs |= matched
+		return funcs
+
+	def _resolve(self, name):
+		entry = self._resolved.get(name)
+		if entry is None:
+			entry = self._build_entry(name) or ()
+			self._resolved.put(name, entry)
+		return entry
+
+	def _handle(self, hname, *args, **kwargs):
+		entry = self._dispatch.get(hname)
+		if entry is None and self._patterns:
+			entry = self._resolve(hname)
+		if entry:
+			inline, spawned = entry
+			if self._lane_workers and self._current() in self._lane_workers:
+				# Inside an ordered lane: run everything here, in order.
+				for handler, timer in spawned + inline:
+					try:
+						handler(self, *args, **kwargs)
+					except Exception:
+						self._report_error(handler)
+				return
+
+			self._untimed -= 1
+			if self._untimed > 0:
+				for handler, timer in spawned:
+					self._spawn(handler, self, *args, **kwargs)
+				for handler, timer in inline:
+					try:
+						handler(self, *args, **kwargs)
+					except Exception:
+						# Report it the way a failed greenlet would be.
+						self._report_error(handler)
+				return
+
+			# Time the handlers for this dispatch.
+			self._untimed = self.timing_interval or sys.maxsize
+			for handler, timer in spawned:
+				self._spawn(self._run_timed, handler, timer, *args, **kwargs)
+			if inline:
+				start = time()
+				for handler, timer in inline:
+					try:
+						handler(self, *args, **kwargs)
+					except Exception:
+						self._report_error(handler)
+					end = time()
+					timer.observe(end - start)
+					start = end
+
+	def _run_timed(self, handler, timer, *args, **kwargs):
+		start = time()
+		try:
+			handler(self, *args, **kwargs)
+		finally:
+			timer.observe(time() - start)
+
+	def _handle_recv(self, message, handlers=None):
+		# handlers, if given, picks the (function, inline) pairs to call
+		# for each event instead of everything handling it (see
+		# _dispatch_batch).
+		command = message.command
+		if not (command.isupper() or command.isdigit()):
+			command = command.upper()
+		if handlers is None:
+			self._handle('client_global_recv', message)
+			self._handle(command, message)
+			return
+		in_lane = self._lane_workers and self._current() in self._lane_workers
+		for name in ('client_global_recv', command):
+			for handler, inline in handlers(name):
+				if not (inline or in_lane):
+					self._spawn(handler, self, message)
+					continue
+				try:
+					handler(self, message)
+				except Exception:
+					self._report_error(handler)
+
+	def send(self, message, priority=None):
+		"""Queue a message for sending.  priority is a
+		throttle.Priority; by default registration and keepalive
+		commands are CRITICAL and everything else is INTERACTIVE."""
+		if priority is None:
+			priority = throttle.default_priority(message.command)
+		self._handle('client_global_send', message)
+		self._squeue.put(message.wire(), priority)
+		self._wake_sender()
+
+	def send_many(self, messages, priority=None):
+		"""Queue several messages at once.  Each may be a Message or an
+		already encoded line (with or without its CRLF).  Lines are queued
+		as they are, and only parsed if something handles
+		client_global_send or priority is left to default (as for send)
+		for each message."""
+		squeue = self._squeue
+		notify = 'client_global_send' in self._dispatch or self._patterns
+		for msg in messages:
+			if not isinstance(msg, message.Message):
+				if isinstance(msg, compat.text_type):
+					msg = msg.encode('utf-8')
+				if msg[-2:] != b'\r\n':
+					msg = msg.rstrip(b'\r\n') + b'\r\n'
+				wire = msg
+				if notify or priority is None:
+					msg = message.Message.parse(compat.native_str(wire[:-2]))
+			else:
+				wire = msg.wire()
+			p = priority
+			if p is None:
+				p = throttle.default_priority(msg.command)
+			if notify:
+				self._handle('client_global_send', msg)
+			squeue.put(wire, p)
+		self._wake_sender()
+
+	def say(self, targets, text, command='PRIVMSG', priority=None):
+		"""Send text to a target or list of targets in as few lines as
+		the server allows: targets are combined up to its TARGMAX (or
+		MAXTARGETS) for command, and text is split so that no line
+		passes the 512-byte limit once the server has added our prefix.
+		Returns the number of lines queued; raises ValueError if a
+		target leaves no room for text."""
+		if isinstance(targets, compat.string_types):
+			targets = [targets]
+		if compat.PY3 or isinstance(text, compat.text_type) or any(isinstance(t, compat.text_type) for t in targets):
+			# Lines are text on Python 3; on Python 2, mixing str and
+			# unicode fails as soon as either isn't ASCII.
+			text = compat.to_text(text)
+			targets = [compat.to_text(t) for t in targets]
+		room = message.MAX_LINE - self.prefix_length() - len(command) - 3
+		lines = []
+		# Targets are only combined while they leave half the line for
+		# text; one that leaves none makes split_text raise ValueError.
+		for group in message.group_targets(targets, self.max_targets(command), min(200, room // 2)):
+			limit = room - message.utf8_length(group)
+			for chunk in message.split_text(text, limit):
+				lines.append(message.Message(None, command, [group, chunk]))
+		self.send_many(lines, priority)
+		return len(lines)
+
+	def max_targets(self, command):
+		"""The most targets the server accepts for command, or None for
+		no limit."""
+		isupport = getattr(self, 'isupport', {})
+		targmax = isupport.get('TARGMAX')
+		if targmax is not None:
+			return targmax.get(command.upper(), 1)
+		return isupport.get('MAXTARGETS') or 1
+
+	def prefix_length(self):
+		"""Bytes the server adds to lines we send when relaying them
+		(":nick!user@host "), assuming the longest user and host
+		allowed until our hostmask is known."""
+		hostmask = self.hostmask
+		if hostmask is not None and hostmask.host:
+			return sum(message.utf8_length(part) for part in (hostmask.nick, hostmask.user or '', hostmask.host)) + 4
+		return message.utf8_length(self.nick or '') + message.USERLEN + message.HOSTLEN + 4
+
+	def trigger_handler(self, handler, *args, **kwargs):
+		self._handle(handler, *args, **kwargs)
+
+	def get_handled_events(self):
+		"""The events handled by name, including names given to
+		util.subscribe in full (but not prefix patterns; see
+		handles)."""
+		return list(set(self._handlers) | set(self._pattern_exact))
+
+	def handles(self, event):
+		"""Whether anything handles event, by name or by pattern."""
+		if event in self._dispatch:
+			return True
+		return bool(self._patterns and self._resolve(event))
+
+
+def simple_handlers(nick, user, gecos, autoreconnect=False, version=None):
+	"""The handlers a SimpleClient starts with."""
+	handlers = [
+		handler.Ping(),
+		handler.ForgetHostmasks(),
+		handler.User(nick, user, gecos),
+		handler.OwnHostmask(),
+		handler.NickInUse(),
+		handler.MessageProcessor()
+	]
+	if autoreconnect:
+		handlers.append(handler.AutoReconnect())
+	else:
+		handlers.append(handler.GenericDisconnect())
+	if version:
+		handlers.append(handler.BasicCTCP(version))
+	else:
+		handlers.append(handler.BasicCTCP())
+	return handlers
@@ -0,0 +1,5 @@
+# Performance benchmarks for flyrc.  These aren't imported by flyrc
+# itself.  Run the suite with python -m flyrc.bench (see __main__.py for
+# options, including saving results as JSON and comparing against a
+# baseline); modules with a main() can also be run on their own, e.g.
+# python -m flyrc.bench.parse
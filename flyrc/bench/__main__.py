@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+# Run the flyrc benchmark suite:
+#   python -m flyrc.bench [-o results.json] [-b baseline.json] [-t 0.1]
+#                         [-k substring] [--traffic capture.txt]
+# Exits with status 1 if any benchmark regressed against the baseline.
+
+from __future__ import print_function
+import sys
+from optparse import OptionParser
+from flyrc.bench import core, micro, pipeline, tracker
+
+def main(argv):
+	parser = OptionParser(usage="python -m flyrc.bench [options]")
+	parser.add_option('-o', '--output', help="write results as JSON to this file")
+	parser.add_option('-b', '--baseline', help="compare against results saved in this file")
+	parser.add_option('-t', '--threshold', type='float', default=0.1, help="fractional slowdown counted as a regression (default 0.1)")
+	parser.add_option('-k', '--filter', action='append', help="only run benchmarks whose names contain this (repeatable)")
+	parser.add_option('-r', '--repeat', type='int', default=5, help="timings per benchmark; the best is kept (default 5)")
+	parser.add_option('--min-time', type='float', default=0.2, help="minimum seconds per timing (default 0.2)")
+	parser.add_option('--traffic', help="file of raw IRC lines to use for the pipeline benchmarks")
+	options, args = parser.parse_args(argv[1:])
+
+	if options.traffic:
+		with open(options.traffic) as f:
+			pipeline.traffic = [line.rstrip('\r\n') for line in f if line.strip()]
+
+	names = None
+	if options.filter:
+		names = [name for name in core.benchmarks if any(f in name for f in options.filter)]
+
+	def report(name, result):
+		print("%-45s %14.0f ops/s" % (name, result['ops_per_sec']))
+		sys.stdout.flush()
+	doc = core.run(names, options.repeat, options.min_time, report)
+
+	if options.output:
+		core.save(doc, options.output)
+
+	if options.baseline:
+		rows, regressions = core.compare(doc, core.load(options.baseline), options.threshold)
+		print()
+		print("%-45s %14s %14s %8s" % ('benchmark', 'baseline', 'current', 'change'))
+		for name, base, now, change in rows:
+			flag = ''
+			if name in regressions:
+				flag = '  REGRESSION'
+			print("%-45s %14.0f %14.0f %+7.1f%%%s" % (name, base, now, change * 100, flag))
+		if regressions:
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
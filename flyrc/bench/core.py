@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import json
+import platform
+import sys
+from time import time
+from timeit import default_timer
+
+# Name -> factory.  A factory does any setup and returns a function
+# run(n) that performs n rounds of work and returns the number of
+# operations that amounted to.  If run has a close attribute, it's
+# called once timing is done.
+benchmarks = {}
+
+def benchmark(name):
+	"""Decorator registering a benchmark factory under name."""
+	def register(factory):
+		benchmarks[name] = factory
+		return factory
+	return register
+
+def measure(factory, repeat=5, min_time=0.2):
+	"""Time a benchmark, returning a result dict.  The number of rounds is
+	doubled until one timing takes at least min_time seconds; the best
+	of repeat timings is reported."""
+	run = factory()
+	n = 1
+	while True:
+		start = default_timer()
+		ops = run(n)
+		elapsed = default_timer() - start
+		if elapsed >= min_time:
+			break
+		n *= 2
+	best = elapsed / ops
+	for i in range(repeat - 1):
+		start = default_timer()
+		ops = run(n)
+		best = min(best, (default_timer() - start) / ops)
+	if hasattr(run, 'close'):
+		run.close()
+	return {'ops': ops, 'repeat': repeat, 'seconds_per_op': best, 'ops_per_sec': 1.0 / best}
+
+def run(names=None, repeat=5, min_time=0.2, report=None):
+	"""Run the named benchmarks (all of them by default), returning a
+	document suitable for save().  report, if given, is called with each
+	name and result as it completes."""
+	results = {}
+	for name in sorted(names or benchmarks):
+		results[name] = measure(benchmarks[name], repeat, min_time)
+		if report:
+			report(name, results[name])
+	return {
+		'meta': {
+			'timestamp': time(),
+			'python': sys.version.split()[0],
+			'implementation': platform.python_implementation(),
+			'platform': platform.platform()
+		},
+		'results': results
+	}
+
+def save(doc, path):
+	with open(path, 'w') as f:
+		json.dump(doc, f, indent=1, sort_keys=True)
+
+def load(path):
+	with open(path) as f:
+		return json.load(f)
+
+def compare(doc, baseline, threshold=0.1):
+	"""Compare results against a baseline document.  Returns a list of
+	(name, baseline ops/s, current ops/s, change) for every benchmark
+	present in both, and a list of the names that regressed by more
+	than threshold (a fraction).  A baseline entry may carry its own
+	'threshold' to override the default."""
+	rows = []
+	regressions = []
+	current = doc['results']
+	for name, base in sorted(baseline['results'].items()):
+		if name not in current:
+			continue
+		now = current[name]['ops_per_sec']
+		change = now / base['ops_per_sec'] - 1
+		rows.append((name, base['ops_per_sec'], now, change))
+		if change < -base.get('threshold', threshold):
+			regressions.append(name)
+	return rows, regressions
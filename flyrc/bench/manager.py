@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+# Memory and CPU cost per connection for a ClientManager hosting N
+# SimpleClients against a local stand-in IRC server.
+# Run with: python -m flyrc.bench.manager [N ...]
+#
+# The stand-in server runs in a child process (python -m
+# flyrc.bench.manager --serve PORT) so its CPU time isn't counted.
+
+from __future__ import print_function
+import os
+import resource
+import subprocess
+import sys
+import gevent
+from gevent import socket
+from gevent.server import StreamServer
+from timeit import default_timer
+from flyrc import client, manager
+
+COUNTS = [10, 100, 1000]
+# Seconds of steady-state traffic to measure CPU over.
+STEADY = 5
+# Seconds between messages the stand-in server sends each client.
+INTERVAL = 0.5
+
+def serve_client(sock, addr):
+	f = sock.makefile('rb')
+	nick = 'flyrcbot'
+	for line in f:
+		if line.startswith(b'NICK '):
+			nick = line[5:].strip().decode('utf-8', 'replace')
+		elif line.startswith(b'USER '):
+			break
+	else:
+		return
+	sock.sendall((':bench.test 001 %s :Welcome to the bench network %s!bench@localhost\r\n' % (nick, nick)).encode('utf-8'))
+
+	def talk():
+		n = 0
+		while True:
+			gevent.sleep(INTERVAL)
+			n += 1
+			if n % 10:
+				sock.sendall(b':someone!user@host.test PRIVMSG #bench :message number ' + str(n).encode('ascii') + b'\r\n')
+			else:
+				sock.sendall(b'PING :bench.test\r\n')
+	talker = gevent.spawn(talk)
+	try:
+		for line in f:
+			pass
+	except socket.error:
+		pass
+	finally:
+		talker.kill()
+
+def serve(port):
+	StreamServer(('127.0.0.1', port), serve_client, backlog=2048).serve_forever()
+
+def rss():
+	"""Current resident set size in bytes."""
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * resource.getpagesize()
+	except IOError:
+		# Peak rather than current, but the best we have.
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def cpu():
+	t = os.times()
+	return t[0] + t[1]
+
+class Welcomed(object):
+	INLINE = True
+
+	def __init__(self, counter):
+		self.counter = counter
+
+	def irc_RPL_WELCOME(self, client, msg):
+		self.counter[0] += 1
+
+def run(port, count):
+	welcomed = [0]
+	mgr = manager.ClientManager(stagger=0.002)
+	base_mem = rss()
+	for i in range(count):
+		c = client.SimpleClient('bot%d' % i, 'bench', 'flyrc bench', '127.0.0.1', port)
+		c.add_handler(Welcomed(welcomed))
+		mgr.add(c)
+
+	start = default_timer()
+	mgr.start()
+	while welcomed[0] < count and default_timer() - start < 60:
+		gevent.sleep(0.05)
+	connect_time = default_timer() - start
+
+	cpu_start = cpu()
+	gevent.sleep(STEADY)
+	cpu_used = cpu() - cpu_start
+	mem = rss() - base_mem
+
+	health = mgr.health()[None]
+	mgr.shutdown()
+	return {
+		'clients': count,
+		'connected': health['connected'],
+		'connect_seconds': connect_time,
+		'rss_per_client_kb': mem / 1024.0 / count,
+		'cpu_percent': 100.0 * cpu_used / STEADY,
+		'cpu_ms_per_client_second': 1000.0 * cpu_used / STEADY / count
+	}
+
+def raise_fd_limit(count):
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	want = count + 64
+	if soft < want:
+		resource.setrlimit(resource.RLIMIT_NOFILE, (min(want, hard), hard))
+
+def main(argv):
+	if len(argv) > 2 and argv[1] == '--serve':
+		serve(int(argv[2]))
+		return
+
+	counts = [int(x) for x in argv[1:]] or COUNTS
+	raise_fd_limit(max(counts))
+	probe = socket.socket()
+	probe.bind(('127.0.0.1', 0))
+	port = probe.getsockname()[1]
+	probe.close()
+	server = subprocess.Popen([sys.executable, '-m', 'flyrc.bench.manager', '--serve', str(port)])
+	try:
+		gevent.sleep(1)
+		print("%8s %10s %12s %16s %8s %22s" % ('clients', 'connected', 'connect (s)', 'RSS/client (KB)', 'CPU %', 'CPU ms/client/second'))
+		for count in counts:
+			r = run(port, count)
+			print("%8d %10d %12.2f %16.1f %8.1f %22.3f" % (r['clients'], r['connected'], r['connect_seconds'], r['rss_per_client_kb'], r['cpu_percent'], r['cpu_ms_per_client_second']))
+			gevent.sleep(1)
+	finally:
+		server.terminate()
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# Micro-benchmarks for the individual steps of the pipeline.
+
+from flyrc import client, handler, hostmask, message, util
+from flyrc.bench.core import benchmark
+from flyrc.bench.parse import SAMPLES
+
+PREFIXES = [
+	'nick!user@host.example.com',
+	'irc.example.net',
+	'someone!~ident@2001:db8::1',
+	'a_much_longer_nickname!withuser@some.really.long.cloaked.host.example.org'
+]
+
+CHANNEL_TEXT = [
+	'just chatting, nothing to see here',
+	'!hello world',
+	'flyrcbot: help me',
+	'another ordinary line of conversation in a busy channel',
+	'!unknown command'
+]
+
+def _rounds(func, items):
+	def run(n):
+		for i in range(n):
+			for item in items:
+				func(item)
+		return n * len(items)
+	return run
+
+@benchmark('message.irc_split')
+def irc_split():
+	return _rounds(message.irc_split, SAMPLES)
+
+@benchmark('message.Message.parse')
+def message_parse():
+	return _rounds(message.Message.parse, SAMPLES)
+
+@benchmark('message.irc_join')
+def irc_join():
+	parts = [message.irc_split(line) for line in SAMPLES]
+	join = message.irc_join
+	def run(n):
+		for i in range(n):
+			for prefix, command, args in parts:
+				join(prefix, command, args)
+		return n * len(parts)
+	return run
+
+@benchmark('message.Message.render')
+def message_render():
+	msgs = [message.msg('#channel', 'hello there, how is everyone doing?'), message.pong('irc.example.net'), message.join('#channel'), message.notice('nick', util.ctcp('VERSION', 'flyrc'))]
+	def run(n):
+		for i in range(n):
+			for msg in msgs:
+				msg.render()
+		return n * len(msgs)
+	return run
+
+@benchmark('message.Message.wire (new messages)')
+def message_wire():
+	def run(n):
+		for i in range(n):
+			message.msg('#channel', 'hello there, how is everyone doing?').wire()
+			message.pong('irc.example.net').wire()
+			message.notice('nick', util.ctcp('VERSION', 'flyrc')).wire()
+		return n * 3
+	return run
+
+@benchmark('client.send broadcast (one message, 100 clients)')
+def send_broadcast():
+	clients = [client.Client('localhost', 6667) for i in range(100)]
+	def run(n):
+		for i in range(n):
+			msg = message.msg('#channel', 'an announcement for every network')
+			for cli in clients:
+				cli.send(msg)
+		for cli in clients:
+			cli._squeue = client.throttle.OutgoingQueue()
+		return n * len(clients)
+	return run
+
+@benchmark('hostmask.Hostmask.parse')
+def hostmask_parse():
+	return _rounds(hostmask.Hostmask.parse, PREFIXES)
+
+@benchmark('hostmask.Hostmask.parse (uncached)')
+def hostmask_parse_uncached():
+	return _rounds(hostmask.Hostmask._parse, PREFIXES)
+
+@benchmark('util.parse_ctcp')
+def parse_ctcp():
+	return _rounds(util.parse_ctcp, ['\001VERSION\001', '\001PING 1234567890\001', '\001ACTION waves\001', 'not a ctcp at all'])
+
+class _Counter(object):
+	def __init__(self):
+		self.count = 0
+
+	def irc_bench(self, client, msg):
+		self.count += 1
+
+class _InlineCounter(_Counter):
+	INLINE = True
+
+	def irc_bench(self, client, msg):
+		self.count += 1
+
+@benchmark('client._handle fan-out (5 inline)')
+def handle_inline():
+	return _fanout(_InlineCounter)
+
+@benchmark('client._handle fan-out (5 spawned)')
+def handle_spawned():
+	return _fanout(_Counter)
+
+def _fanout(cls):
+	cli = client.Client('localhost', 6667)
+	for i in range(5):
+		cli.add_handler(cls())
+	msg = message.Message.parse(SAMPLES[0])
+	def run(n):
+		for i in range(n):
+			cli._handle('bench', msg)
+		cli._group.join()
+		return n
+	return run
+
+class _Commands(object):
+	INLINE = True
+
+	def irc_command_hello(self, client, source, target, args):
+		pass
+
+@benchmark('handler.BasicChannelCommand matching')
+def channel_command():
+	return _channel_commands(CHANNEL_TEXT)
+
+@benchmark('handler.BasicChannelCommand (no commands)')
+def channel_chatter():
+	return _channel_commands([text for text in CHANNEL_TEXT if text[0] != '!' and not text.startswith('flyrcbot')])
+
+def _channel_commands(lines):
+	cli = client.Client('localhost', 6667)
+	cli.nick = 'flyrcbot'
+	cli.add_handler(handler.User('flyrcbot', 'flyrc', 'flyrc'))
+	cli.add_handler(handler.MessageProcessor())
+	cmd = handler.BasicChannelCommand()
+	cli.add_handler(cmd)
+	cli.add_handler(_Commands())
+	source = hostmask.Hostmask.parse(PREFIXES[0])
+	def run(n):
+		for i in range(n):
+			for text in lines:
+				cmd.irc_channel_message(cli, source, '#channel', text)
+		return n * len(lines)
+	return run
+
+def _plugin_classes(count):
+	# Handler classes resembling plugins: a few events each, most of
+	# them shared, and a dependency on MessageProcessor.
+	classes = []
+	for i in range(count):
+		attrs = {
+			'DEPENDENCIES': [handler.MessageProcessor],
+			'INLINE': True,
+			'irc_channel_message': lambda self, client, source, target, text: None,
+			'irc_RPL_WELCOME': lambda self, client, msg: None,
+			'irc_command_plugin%d' % i: lambda self, client, source, target, args: None
+		}
+		classes.append(type('Plugin%d' % i, (object,), attrs))
+	return classes
+
+@benchmark('client.add_handler (100 plugins)')
+def add_plugins():
+	classes = _plugin_classes(100)
+	def run(n):
+		for i in range(n):
+			cli = client.Client('localhost', 6667)
+			cli.add_handler(handler.User('flyrcbot', 'flyrc', 'flyrc'))
+			cli.add_handler(handler.MessageProcessor())
+			for cls in classes:
+				cli.add_handler(cls())
+		return n * len(classes)
+	return run
+
+@benchmark('client.add_handlers (100 plugins, bulk)')
+def add_plugins_bulk():
+	classes = _plugin_classes(100)
+	def run(n):
+		for i in range(n):
+			cli = client.Client('localhost', 6667)
+			cli.add_handlers([cls() for cls in classes] + [handler.MessageProcessor(), handler.User('flyrcbot', 'flyrc', 'flyrc')])
+		return n * len(classes)
+	return run
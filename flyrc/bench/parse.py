@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Message.parse throughput, compared against the parser flyrc 0.1.1
+# shipped with.  Run with: python -m flyrc.bench.parse [iterations]
+
+from __future__ import print_function
+import sys
+from timeit import default_timer
+from flyrc import message
+
+SAMPLES = [
+	':nick!user@host.example.com PRIVMSG #channel :hello there, how is everyone doing?',
+	':irc.example.net 353 flyrcbot = #channel :@op +voice nick1 nick2 nick3 nick4 nick5',
+	':nick!user@host.example.com JOIN #channel',
+	':nick!user@host.example.com QUIT :Ping timeout: 240 seconds',
+	'PING :irc.example.net',
+	':irc.example.net 005 flyrcbot CHANTYPES=# PREFIX=(ov)@+ NETWORK=Example :are supported by this server',
+	'@time=2012-06-30T23:59:60.419Z;account=nick :nick!user@host.example.com PRIVMSG #channel :tagged'
+]
+
+def legacy_irc_split(text):
+	prefix = None
+	command = None
+	args = []
+	if text:
+		trailing = ''
+		if text[0] == ':':
+			prefix, text = text[1:].split(' ', 1)
+		if text.find(' :') != -1:
+			text, trailing = text.split(' :', 1)
+		args = text.split(' ')
+		if trailing:
+			args.append(trailing)
+		command = args.pop(0)
+	return prefix, command, args
+
+class LegacyHostmask(object):
+	@classmethod
+	def parse(cls, text):
+		nick = None
+		user = None
+		host = None
+		if text:
+			if text.find('!') != -1:
+				nick, text = text.split('!', 1)
+				user, host = text.split('@', 1)
+			else:
+				nick = text
+		return cls(nick, user, host)
+
+	def __init__(self, n, u, h):
+		self.nick = n
+		self.user = u
+		self.host = h
+
+class LegacyMessage(object):
+	@classmethod
+	def parse(cls, text):
+		prefix, command, args = legacy_irc_split(text)
+		source = None
+		if prefix:
+			source = LegacyHostmask.parse(prefix)
+		return cls(source, command, args)
+
+	def __init__(self, s, c, a):
+		self._args = None
+		self.source = s
+		self.command = c
+		self.args = a
+
+	@property
+	def args(self):
+		return self._args
+
+	@args.setter
+	def args(self, newargs):
+		newargs = [x for x in newargs if x != ""]
+		for i, arg in enumerate(newargs):
+			if i != len(newargs)-1 and (arg[0] == ':' or arg.find(' ') != -1):
+				raise message.InvalidArgumentOrder(arg, i)
+		self._args = newargs
+
+def measure(parse, lines, iterations):
+	"""Return parsed lines per second."""
+	start = default_timer()
+	for i in range(iterations):
+		for line in lines:
+			parse(line)
+	return len(lines) * iterations / (default_timer() - start)
+
+def main(argv):
+	iterations = 20000
+	if len(argv) > 1:
+		iterations = int(argv[1])
+	# The legacy parser doesn't understand tags.
+	untagged = [line for line in SAMPLES if line[0] != '@']
+	before = measure(LegacyMessage.parse, untagged, iterations)
+	after = measure(message.Message.parse, untagged, iterations)
+	tagged = measure(message.Message.parse, SAMPLES, iterations)
+	print("legacy Message.parse:  %10.0f lines/s" % before)
+	print("Message.parse:         %10.0f lines/s (%.2fx)" % (after, after / before))
+	print("Message.parse (+tags): %10.0f lines/s" % tagged)
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+# End-to-end benchmarks: traffic goes through a real Client over a local
+# socketpair, from framing and parsing through dispatch to rendering and
+# sending replies.
+
+import gevent
+import gevent.event
+from gevent import socket
+from flyrc import client, compat, handler, message
+from flyrc.bench.core import benchmark
+
+# Raw lines to replay, e.g. from a capture; None means synthetic_traffic().
+traffic = None
+
+def synthetic_traffic():
+	lines = []
+	for i in range(100):
+		nick = 'user%d' % (i % 37)
+		mask = ':%s!ident@host%d.example.com' % (nick, i % 37)
+		if i % 20 == 0:
+			lines.append('PING :irc.example.net')
+		elif i % 10 == 1:
+			lines.append(mask + ' JOIN #channel%d' % (i % 5))
+		elif i % 10 == 2:
+			lines.append(mask + ' QUIT :Ping timeout: 240 seconds')
+		elif i % 10 == 3:
+			lines.append(':irc.example.net 353 flyrcbot = #channel :@op +voice nick1 nick2 nick3 nick4')
+		elif i % 10 == 4:
+			lines.append(mask + ' PRIVMSG flyrcbot :\001VERSION\001')
+		else:
+			lines.append(mask + ' PRIVMSG #channel%d :an ordinary line of chatter, number %d' % (i % 5, i))
+	return lines
+
+class _Counter(object):
+	INLINE = True
+
+	def __init__(self, event):
+		self.event = event
+		self.count = 0
+		self.target = 0
+
+	def hit(self):
+		self.count += 1
+		if self.count >= self.target:
+			self.event.set()
+
+	def irc_client_global_recv(self, client, msg):
+		self.hit()
+
+class _Reply(_Counter):
+	INLINE = True
+
+	def irc_client_global_recv(self, client, msg):
+		pass
+
+	def irc_command_ping(self, client, source, target, args):
+		client.send(message.msg(target, 'pong'))
+
+def _connect(*handlers):
+	ours, theirs = socket.socketpair()
+	cli = client.SimpleClient('flyrcbot', 'flyrc', 'flyrc bench', 'localhost', 6667)
+	cli.throttle_delay = 0
+	cli._create_socket = lambda: ours
+	for h in handlers:
+		cli.add_handler(h)
+	cli.start()
+	return cli, theirs
+
+def _drain(sock, counter=None):
+	"""Read everything the client sends, counting lines for counter."""
+	while True:
+		data = sock.recv(65536)
+		if not data:
+			return
+		if counter:
+			for i in range(data.count(b'\n')):
+				counter.hit()
+
+@benchmark('pipeline.recv (parse + dispatch)')
+def recv():
+	done = gevent.event.Event()
+	counter = _Counter(done)
+	cli, peer = _connect(counter)
+	drainer = gevent.spawn(_drain, peer)
+	lines = traffic or synthetic_traffic()
+	blob = '\r\n'.join(lines) + '\r\n'
+	if isinstance(blob, compat.text_type):
+		blob = blob.encode('utf-8')
+	def run(n):
+		done.clear()
+		counter.target = counter.count + n * len(lines)
+		gevent.spawn(peer.sendall, blob * n)
+		done.wait()
+		return n * len(lines)
+	def close():
+		drainer.kill()
+		cli.shutdown()
+	run.close = close
+	return run
+
+@benchmark('pipeline.command round trip')
+def command_round_trip():
+	done = gevent.event.Event()
+	counter = _Reply(done)
+	cli, peer = _connect(handler.BasicChannelCommand(), counter)
+	# Skip the registration lines before counting replies.
+	gevent.sleep(0.01)
+	peer.recv(65536)
+	drainer = gevent.spawn(_drain, peer, counter)
+	line = b':someone!user@host.example.com PRIVMSG #channel :!ping\r\n'
+	def run(n):
+		done.clear()
+		counter.target = counter.count + n
+		gevent.spawn(peer.sendall, line * n)
+		done.wait()
+		return n
+	def close():
+		drainer.kill()
+		cli.shutdown()
+	run.close = close
+	return run
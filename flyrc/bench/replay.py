@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# Play a recorded session (see flyrc.record) back into a SimpleClient with
+# ISupport, InfoTracker and ChannelSync loaded, and report how fast it
+# went and how much memory the client ended up holding.
+# Run with: python -m flyrc.bench.replay RECORDING [SPEED]
+# SPEED is as for record.ReplaySocket; leave it out to play as fast as
+# possible.  To make a synthetic recording from the tracker benchmark's
+# traffic first:
+#   python -m flyrc.bench.replay --make RECORDING [USERS [CHANNELS]]
+
+from __future__ import print_function
+import gc
+import sys
+import gevent
+from timeit import default_timer
+from flyrc import client, compat, handler, infotracker, record
+from flyrc.bench import tracker
+from flyrc.bench.manager import rss
+
+def _encode(line):
+	# Recordings hold lines as received: encoded.
+	if isinstance(line, compat.text_type):
+		return line.encode('utf-8')
+	return line
+
+def make(path, users, channels):
+	recorder = record.Recorder(path)
+	recorder.received([b':irc.bench.test 001 flyrcbot :Welcome to the bench network flyrcbot!flyrc@bench.test'])
+	lines = []
+	for line in tracker.burst(users, channels):
+		lines.append(_encode(line))
+		if len(lines) == 1000:
+			recorder.received(lines)
+			lines = []
+	recorder.received(lines)
+	for msg in tracker.churn(users, channels, 60000):
+		recorder.received([_encode(msg.render())])
+	recorder.close()
+	print("%d lines recorded to %s" % (recorder.lines, path))
+
+def run(path, speed=None):
+	cli = client.SimpleClient('flyrcbot', 'flyrc', 'flyrc bench', 'localhost', 6667)
+	cli.throttle.delay = 0
+	cli.add_handler(handler.ISupport())
+	cli.add_handler(infotracker.InfoTracker())
+	cli.add_handler(infotracker.ChannelSync())
+	cli._group.join()
+	sock = record.replay(cli, path, speed, hold=True)
+
+	gc.collect()
+	base = rss()
+	start = default_timer()
+	cli.start()
+	sock.finished.wait()
+	while cli._rqueue.qsize():
+		gevent.sleep(0.01)
+	cli._group.join()
+	elapsed = default_timer() - start
+	gc.collect()
+	mem = rss() - base
+
+	print("%d lines in %.2fs (%.0f lines/s)" % (sock.lines, elapsed, sock.lines / elapsed))
+	print("%d users, %d channels tracked" % (len(cli.users), len(cli.channels)))
+	print("%.1f MB resident, %d bytes sent" % (mem / 1048576.0, sock.sent))
+	cli.shutdown()
+
+def main(argv):
+	if len(argv) > 2 and argv[1] == '--make':
+		users = tracker.USERS
+		channels = tracker.CHANNELS
+		if len(argv) > 3:
+			users = int(argv[3])
+		if len(argv) > 4:
+			channels = int(argv[4])
+		make(argv[2], users, channels)
+		return 0
+	if len(argv) < 2:
+		print("usage: python -m flyrc.bench.replay [--make] RECORDING [SPEED | USERS [CHANNELS]]", file=sys.stderr)
+		return 2
+	speed = None
+	if len(argv) > 2:
+		speed = float(argv[2])
+	run(argv[1], speed)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
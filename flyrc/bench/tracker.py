@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# InfoTracker state engine: memory and time to absorb the burst of JOINs
+# and NAMES replies that follows joining many channels on a big network,
+# plus steady-state churn.
+# Run with: python -m flyrc.bench.tracker [USERS [CHANNELS]]
+
+from __future__ import print_function
+import gc
+import random
+import sys
+from timeit import default_timer
+from flyrc import client, infotracker, message
+from flyrc.bench.core import benchmark
+from flyrc.bench.manager import rss
+
+USERS = 100000
+CHANNELS = 2000
+# Channels each user shares with us, on average.
+PER_USER = 3
+NAMES_PER_LINE = 40
+
+def _client():
+	cli = client.Client('localhost', 6667)
+	cli.nick = 'flyrcbot'
+	tracker = infotracker.InfoTracker()
+	cli.add_handler(tracker)
+	cli._group.join()
+	return cli
+
+def _members(users, channels, seed):
+	rng = random.Random(seed)
+	members = [[] for c in range(channels)]
+	for u in range(users):
+		for c in rng.sample(range(channels), PER_USER):
+			members[c].append(u)
+	return members
+
+def burst(users, channels, seed=0):
+	"""Yield the lines a server sends as we join channels channels whose
+	members are drawn from users users."""
+	for c, names in enumerate(_members(users, channels, seed)):
+		chan = '#channel%d' % c
+		yield ':flyrcbot!flyrc@bench.test JOIN %s' % chan
+		for i in range(0, len(names), NAMES_PER_LINE):
+			chunk = ' '.join(('@' if u % 50 == 0 else '') + 'user%d' % u for u in names[i:i+NAMES_PER_LINE])
+			yield ':irc.bench.test 353 flyrcbot = %s :%s' % (chan, chunk)
+		yield ':irc.bench.test 366 flyrcbot %s :End of /NAMES list.' % chan
+
+def who_replies(users, channels, seed=0):
+	"""Yield the WHOX replies ChannelSync's requests get, as if its
+	tokens were handed out in join order."""
+	for c, names in enumerate(_members(users, channels, seed)):
+		chan = '#channel%d' % c
+		token = c % 999 + 1
+		for u in names:
+			yield ':irc.bench.test 354 flyrcbot %d %s ident%d host%d.bench.test user%d H%s account%d :Real Name %d' % (token, chan, u, u, u, '@' if u % 50 == 0 else '', u, u)
+		yield ':irc.bench.test 315 flyrcbot %s :End of /WHO list.' % chan
+
+def churn(users, channels, count, seed=1):
+	"""Lines for count events of everyday membership changes."""
+	rng = random.Random(seed)
+	lines = []
+	for i in range(count):
+		u = rng.randrange(users)
+		mask = ':user%d!ident@host%d.bench.test' % (u, u)
+		chan = '#channel%d' % rng.randrange(channels)
+		kind = i % 6
+		if kind == 0:
+			lines.append(mask + ' JOIN ' + chan)
+		elif kind == 1:
+			lines.append(mask + ' PART ' + chan)
+		elif kind == 2:
+			lines.append(':op!op@bench.test MODE %s +v-o user%d user%d' % (chan, u, u))
+		elif kind == 3:
+			lines.append(mask + ' NICK user%d_' % u)
+		elif kind == 4:
+			lines.append(':user%d_!ident@host%d.bench.test NICK user%d' % (u, u, u))
+		else:
+			lines.append(mask + ' QUIT :Quit: bye')
+			lines.append(mask + ' JOIN ' + chan)
+	return [message.Message.parse(line) for line in lines]
+
+@benchmark('infotracker churn (JOIN/PART/MODE/NICK/QUIT)')
+def tracker_churn():
+	users, channels = 5000, 100
+	cli = _client()
+	for line in burst(users, channels):
+		cli._handle_recv(message.Message.parse(line))
+	msgs = churn(users, channels, 1200)
+	def run(n):
+		for i in range(n):
+			for msg in msgs:
+				cli._handle_recv(msg)
+		return n * len(msgs)
+	return run
+
+def main(argv):
+	users = USERS
+	channels = CHANNELS
+	if len(argv) > 1:
+		users = int(argv[1])
+	if len(argv) > 2:
+		channels = int(argv[2])
+
+	cli = _client()
+	cli.isupport = {'WHOX': True}
+	# Keep 999 WHOs in flight, so tokens are handed out (and reused as
+	# each WHO ends) just as who_replies assumes.
+	cli.add_handler(infotracker.ChannelSync(concurrency=999))
+	cli._group.join()
+	gc.collect()
+	base = rss()
+	start = default_timer()
+	lines = 0
+	for line in burst(users, channels):
+		cli._handle_recv(message.Message.parse(line))
+		lines += 1
+	elapsed = default_timer() - start
+	gc.collect()
+	mem = rss() - base
+
+	memberships = sum(len(c.members) for c in cli.channels.values())
+	print("%d lines in %.2fs (%.0f lines/s)" % (lines, elapsed, lines / elapsed))
+	print("%d users, %d channels, %d memberships tracked" % (len(cli.users), len(cli.channels), memberships))
+	print("%.1f MB resident, %.0f bytes per user, %.0f per membership" % (mem / 1048576.0, float(mem) / len(cli.users), float(mem) / memberships))
+
+	start = default_timer()
+	lines = 0
+	for line in who_replies(users, channels):
+		cli._handle_recv(message.Message.parse(line))
+		lines += 1
+	elapsed = default_timer() - start
+	detailed = sum(1 for c in cli.channels.values() if c.detailed)
+	print("%d WHOX replies in %.2fs (%.0f lines/s), %d channels detailed" % (lines, elapsed, lines / elapsed, detailed))
+
+	msgs = churn(users, channels, 60000)
+	start = default_timer()
+	for msg in msgs:
+		cli._handle_recv(msg)
+	elapsed = default_timer() - start
+	print("%d churn events in %.2fs (%.0f events/s)" % (len(msgs), elapsed, len(msgs) / elapsed))
+
+if __name__ == '__main__':
+	main(sys.argv)
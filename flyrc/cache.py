@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+class LRUCache(object):
+	"""A bounded mapping that forgets the least recently used entries.
+
+	Recency is approximated with two generations instead of a linked
+	list: new entries go into the young generation, and when that fills
+	up it becomes the old generation, replacing (and dropping) the
+	previous one.  A hit in the old generation moves the entry back into
+	the young one, so anything used at least once per generation stays
+	cached, and a hit costs a single dict lookup.  Values must not be
+	None.
+
+	Attributes:
+		maxsize - the most entries the cache will hold.
+		hits - number of successful lookups.
+		misses - number of failed lookups.
+	"""
+	def __init__(self, maxsize=4096):
+		self._young = {}
+		self._old = {}
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+
+	@property
+	def maxsize(self):
+		return self._maxsize
+
+	@maxsize.setter
+	def maxsize(self, size):
+		self._maxsize = size
+		self._limit = max(size // 2, 1)
+		if len(self._young) > self._limit or len(self._old) > self._limit:
+			self.clear()
+
+	def __len__(self):
+		return len(self._young) + len(self._old)
+
+	def __contains__(self, key):
+		return key in self._young or key in self._old
+
+	def get(self, key):
+		"""Return the value cached for key, or None."""
+		value = self._young.get(key)
+		if value is None:
+			value = self._old.pop(key, None)
+			if value is None:
+				self.misses += 1
+				return None
+			self._insert(key, value)
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		self._old.pop(key, None)
+		self._insert(key, value)
+
+	def discard(self, key):
+		self._young.pop(key, None)
+		self._old.pop(key, None)
+
+	def clear(self):
+		self._young = {}
+		self._old = {}
+
+	def stats(self):
+		return {'size': len(self), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+	def _insert(self, key, value):
+		if len(self._young) >= self._limit and key not in self._young:
+			self._old = self._young
+			self._young = {}
+		self._young[key] = value
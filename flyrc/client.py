@@ -3,10 +3,16 @@
 # flyrc:
 # Loosely based upon geventirc (https://github.com/gwik/geventirc)
 
+from __future__ import print_function
+import sys
+from collections import deque
 import gevent
+import gevent.event
 import gevent.pool
 from gevent import queue, socket
-from flyrc import handler, message, util
+from flyrc import base, compat, framing, message, offload, throttle
+# Re-exported from base, where they're defined.
+from flyrc.base import Overload, ClientError, DuplicateHandlerObject, MissingHandlerObject, DependencyViolation, UnsatisfiedDependency, LingeringDependency, InvalidDependencyTree, DependencyCycle
 from time import time
 
 # Client events: connected, disconnected, error, global_send, global_recv, load, unload
@@ -18,65 +24,28 @@ from time import time
 # 'global_recv' fires any time a message is received.
 # 'load' fires when the handler is loaded (note: only the loading handler's 'load' will be triggered)
 # 'unload' fires when the handler is unloaded (note: only the unloading handler's 'unload' will be triggered)
+# 'overload' fires when the receive queue or the handler greenlets hit their limits.
 
-class ClientError(Exception):
-	"""A generic flyrc client error."""
+# Commands that are queued for dispatch even under Overload.SHED.
+ESSENTIAL_COMMANDS = frozenset(['PING', 'ERROR'])
 
-class DuplicateHandlerObject(ClientError):
-	"""Exception raised when an already-added handler is added a
-	second time.
+class _Lane(object):
+	"""Messages waiting to be dispatched in order, as (message,
+	handlers) for _handle_recv, and the greenlet dispatching them."""
+	__slots__ = ('queue', 'worker', 'processed', 'peak')
 
-	Attributes:
-		obj - the object itself.
-	"""
-	def __init__(self, obj):
-		self.obj = obj
+	def __init__(self):
+		self.queue = deque()
+		self.worker = None
+		self.processed = 0
+		self.peak = 0
 
-class MissingHandlerObject(ClientError):
-	"""Exception raised when attempting to remove a handler that isn't
-	loaded.
-
-	Attributes:
-		obj - the object itself.
-	"""
-	def __init__(self, obj):
-		self.obj = obj
-
-class DependencyViolation(ClientError):
-	"""Exception raised when adding or removing a handler causes a
-	dependency violation of some kind.
-
-	Attributes:
-		args - the object subject to the conflict.
-	"""
-
-class UnsatisfiedDependency(DependencyViolation):
-	"""Exception raised when a dependency isn't satisfied.
-
-	Attributes:
-		args - the missing dependency.
-	"""
-
-class LingeringDependency(DependencyViolation):
-	"""Exception raised when a handler being unloaded still has
-	dependencies.
-
-	Attributes:
-		args - the handler being unloaded.
-	"""
-
-class InvalidDependencyTree(DependencyViolation):
-	"""Exception raised when the dependency tree has become invalid
-	(probably due to prior Dependency exceptions.)
-
-	Attributes:
-		args - the handler with invalid dependency information.
-	"""
-
-class Client(object):
+class Client(base.BaseClient):
+	"""A client connected through gevent sockets, dispatching events from
+	a greenlet of its own and running handlers in greenlets."""
 	def __init__(self, host, port, ssl=False, timeout=300, source=None):
 		self._rqueue = queue.Queue()
-		self._squeue = queue.Queue()
+		self._sready = gevent.event.Event()
 		self.host = host
 		self.port = port
 		self.ssl = ssl
@@ -86,14 +55,78 @@ class Client(object):
 		self._group = gevent.pool.Group()
 		self._coregroup = gevent.pool.Group()
 
-		self._handlers = {}
-		self._handlerobjects = {}
-
-		self.throttle_delay = 2
-		self.throttle_burst = 5
-
 		self.enforce_order = False
 
+		# Ordered dispatch: order_key(client, msg) returns a key (or None
+		# for unordered dispatch).  Messages with the same key are
+		# dispatched one after another, each one's handlers finishing
+		# before the next starts; messages with different keys are
+		# dispatched concurrently, over at most order_lanes lanes.
+		self.order_key = None
+		self.order_lanes = 64
+		self._lanes = {}
+
+		# Backpressure: the most received messages waiting for dispatch
+		# and the most running handler greenlets (None for no limit).
+		self.recv_queue_limit = 10000
+		self.dispatch_limit = 1000
+		self.overload_policy = Overload.PAUSE
+		self._overloaded = set()
+		self._recv_room = gevent.event.Event()
+		self._recv_room.set()
+
+		self.max_line = framing.MAX_LINE
+		self.line_overflow = framing.Overflow.TRUNCATE
+		self._framer = None
+		self._writer = framing.LineWriter()
+		# A record.Recorder to log traffic to, or None.
+		self.recorder = None
+
+		super(Client, self).__init__()
+
+	def _init_metrics(self):
+		super(Client, self)._init_metrics()
+		m = self.metrics
+		m.gauge('recv_queue_depth', 'Received messages waiting to be dispatched.', lambda: self._rqueue.qsize())
+		m.gauge('send_queue_depth', 'Messages waiting to be sent.', lambda: len(self._squeue) + len(self._writer))
+		m.gauge('handlers_running', 'Handler greenlets currently running.', lambda: len(self._group))
+		self._lines_dropped = m.counter('lines_dropped_total', 'Received lines dropped by the overload policy.')
+		m.gauge('order_lanes_active', 'Ordered dispatch lanes with messages in flight.', lambda: len(self._lane_workers))
+		m.gauge('order_lanes_queued', 'Messages waiting in ordered dispatch lanes.', lambda: sum(len(lane.queue) for lane in self._lanes.values()))
+		self._lines_overflowed = m.counter('lines_overflowed_total', 'Received lines that exceeded max_line.')
+
+	def _spawn(self, func, *args, **kwargs):
+		return self._group.spawn(func, *args, **kwargs)
+
+	def _report_error(self, func):
+		# Report it the way a failed greenlet would be.
+		gevent.get_hub().handle_error(func, *sys.exc_info())
+
+	def _current(self):
+		return gevent.getcurrent()
+
+	def _wake_sender(self):
+		self._sready.set()
+
+	def _offload(self, func, args, kwargs):
+		# The pool calls back from a thread of its own.
+		hub = gevent.get_hub()
+		result = gevent.event.AsyncResult()
+		start = time()
+		pool = self._submit(func, args, kwargs, lambda outcome: hub.loop.run_callback_threadsafe(result.set, outcome))
+		try:
+			outcome = result.get(timeout=pool.timeout)
+		except gevent.Timeout:
+			self._offload_timeouts.inc()
+			raise offload.OffloadTimeout(func, pool.timeout)
+		self._offloaded(func, outcome, time() - start)
+
+	def _dispatch_message(self, msg, handlers=None):
+		if self.order_key is not None and not self.enforce_order:
+			self._dispatch_ordered(msg, handlers)
+		else:
+			self._handle_recv(msg, handlers)
+
 	def _create_socket(self):
 		sock = gevent.socket.create_connection((self.host, self.port), source_address=(self._source, 0))
 		if self.ssl:
@@ -118,12 +151,20 @@ class Client(object):
 		self._timeout = t
 		self._socket.settimeout(self._timeout)
 
+	@property
+	def connected(self):
+		"""Whether the client currently has a socket open."""
+		return self._socket is not None
+
 	def start(self):
 		try:
 			self._socket = self._create_socket()
-		except socket.error, e:
+		except socket.error as e:
 			self._ioerror(e, message.Step.CONNECT)
 		else:
+			self._framer = framing.LineFramer(self.max_line, self.line_overflow, overflows=self._lines_overflowed)
+			self._writer.reset()
+			self._drop_batches()
 			self._coregroup.spawn(self._send_loop)
 			self._coregroup.spawn(self._recv_loop)
 			self._handle('client_connected')
@@ -133,6 +174,9 @@ class Client(object):
 		if self._socket:
 			self._socket.close()
 			self._socket = None
+		# Let a paused receive loop notice the socket is gone.
+		self._recv_room.set()
+		self._drop_batches()
 
 		self._handle('client_disconnected')
 
@@ -140,44 +184,59 @@ class Client(object):
 		self.stop()
 		self._coregroup.kill()
 		self._rqueue = queue.Queue()
-		self._squeue = queue.Queue()
+		self._squeue = throttle.OutgoingQueue()
+		self._writer = framing.LineWriter()
+		self._lanes = {}
+		self._drop_batches()
 
 	def join(self):
 		self._coregroup.join()
 		self._group.join()
 
 	def _send_loop(self):
-		buf = ''
-		burst_remaining = self.throttle_burst * 1.0
-		last_message = 0
+		writer = self._writer
 		while True:
-			msg = self._squeue.get()
-			buf += msg.render().encode('utf-8', 'replace') + '\r\n'
-			try:
-				self._socket.sendall(buf)
-				buf = ''
-			except socket.error, e:
-				print "I/O error in SEND: " + str(e)
-				self._ioerror(e, message.Step.SEND)
-			except AttributeError:
-				# Socket closed, exit.
-				return
-
-			# Do throttling, but only if throttle_delay != 0.
-			if self.throttle_delay:
-				# Add any owed slots.
-				if last_message:
-					burst_remaining += (time() - last_message) / self.throttle_delay
-					if (burst_remaining > self.throttle_burst):
-						burst_remaining = self.throttle_burst * 1.0
-
-				# Penalize for the message that was just sent.
-				last_message = time()
-				burst_remaining -= 1
-
-				# Sleep if we're out of burst.
-				if burst_remaining < 1:
-					gevent.sleep(self.throttle_delay)
+			squeue = self._squeue
+			if not writer and not squeue:
+				self._sready.clear()
+				self._sready.wait()
+
+			# Take everything the throttle allows right now, highest
+			# priority first.  Critical lines never wait for tokens.
+			wait = 0
+			while squeue:
+				priority, line = squeue.peek()
+				if priority != throttle.Priority.CRITICAL:
+					wait = self.throttle.wait_time(len(line))
+					if wait:
+						break
+				squeue.pop(priority)
+				self.throttle.consume(len(line))
+				writer.append(line)
+				if self.recorder is not None:
+					self.recorder.sent(line)
+				self._bytes_out.inc(len(line))
+
+			if writer:
+				try:
+					self._lines_out.inc(writer.flush(self._socket))
+				except socket.error as e:
+					if self._socket is None:
+						return
+					print("I/O error in SEND: " + str(e))
+					self._ioerror(e, message.Step.SEND)
+					continue
+				except AttributeError:
+					# Socket closed, exit.
+					return
+
+			if wait:
+				# Sleep until the throttle allows the next line, or
+				# something new (possibly critical) is queued.
+				self._sready.clear()
+				start = time()
+				self._sready.wait(wait)
+				self._throttled.observe(time() - start)
 			else:
 				gevent.sleep(0)
 
@@ -185,126 +244,156 @@ class Client(object):
 		while True:
 			if self.enforce_order:
 				self._group.join()
+			elif self.dispatch_limit and len(self._group) >= self.dispatch_limit:
+				self._wait_dispatch()
 			msg = self._rqueue.get()
+			if self._overloaded:
+				self._check_recovered()
 			if hasattr(msg, 'e'):
 				self._handle('client_error', msg)
+			elif (self._batches or msg.command == 'BATCH') and self._collect_batch(msg):
+				continue
 			else:
-				self._handle_recv(msg)
+				self._dispatch_message(msg)
+
+	def _dispatch_ordered(self, msg, handlers=None):
+		key = self.order_key(self, msg)
+		if key is None:
+			self._handle_recv(msg, handlers)
+			return
+		index = hash(key) % self.order_lanes
+		lane = self._lanes.get(index)
+		if lane is None:
+			lane = self._lanes[index] = _Lane()
+		lane.queue.append((msg, handlers))
+		if len(lane.queue) > lane.peak:
+			lane.peak = len(lane.queue)
+		if lane.worker is None:
+			lane.worker = self._spawn(self._run_lane, lane)
+			self._lane_workers.add(lane.worker)
+
+	def _run_lane(self, lane):
+		queue = lane.queue
+		try:
+			while queue:
+				msg, handlers = queue[0]
+				self._handle_recv(msg, handlers)
+				queue.popleft()
+				lane.processed += 1
+		finally:
+			self._lane_workers.discard(lane.worker)
+			lane.worker = None
+
+	def lane_stats(self):
+		"""Return {lane: {'queued', 'peak', 'processed', 'active'}} for
+		every ordered dispatch lane that has been used."""
+		stats = {}
+		for index, lane in self._lanes.items():
+			stats[index] = {
+				'queued': len(lane.queue),
+				'peak': lane.peak,
+				'processed': lane.processed,
+				'active': lane.worker is not None
+			}
+		return stats
+
+	def _wait_dispatch(self):
+		self._overload('dispatch')
+		while len(self._group) >= self.dispatch_limit:
+			# Wake once enough handler greenlets have finished.
+			gevent.wait(list(self._group), count=len(self._group) - self.dispatch_limit + 1)
+
+	def _overload(self, kind):
+		if kind not in self._overloaded:
+			self._overloaded.add(kind)
+			self._handle('client_overload', kind, self.overload_policy)
+
+	def _check_recovered(self):
+		# Overloads end once the queue or group has drained to half
+		# its limit, so client_overload doesn't fire on every message
+		# while hovering around the limit.
+		if 'recv' in self._overloaded and self._rqueue.qsize() <= (self.recv_queue_limit or 0) // 2:
+			self._recovered('recv')
+		if 'dispatch' in self._overloaded and len(self._group) <= (self.dispatch_limit or 0) // 2:
+			self._recovered('dispatch')
+
+	def _recovered(self, kind):
+		self._overloaded.discard(kind)
+		if kind == 'recv':
+			self._recv_room.set()
 
 	def _recv_loop(self):
-		buf = ''
+		framer = self._framer
 		while True:
 			try:
-				buf += self._socket.recv(4096)
-			except socket.error, e:
-				print "I/O error in RECV: " + str(e)
+				lines = framer.recv_from(self._socket)
+			except socket.error as e:
+				if self._socket is None:
+					# Closed by stop() while we were waiting.
+					return
+				print("I/O error in RECV: " + str(e))
+				self._ioerror(e, message.Step.RECV)
+			except framing.LineTooLong as e:
 				self._ioerror(e, message.Step.RECV)
 			except AttributeError:
 				# Socket has been closed, exit.
 				return
 			else:
-				lines = buf.split('\r\n')
-				buf = lines.pop()
-				for line in lines:
-					self._rqueue.put(message.Message.parse(line))
+				if lines is None:
+					# The server closed the connection.
+					self.stop()
+					return
+				self._lines_in.inc(framer.last_count)
+				self._bytes_in.inc(framer.last_bytes)
+				if self.recorder is not None:
+					self.recorder.received(lines)
+				if compat.PY3:
+					lines = [compat.native_str(line) for line in lines]
+				limit = self.recv_queue_limit
+				if self._overloaded:
+					# Under DROP nothing is queued, so the process loop
+					# may never get to notice the queue has drained.
+					self._check_recovered()
+				dropping = self.overload_policy == Overload.DROP and 'recv' in self._overloaded
+				if limit and (dropping or self._rqueue.qsize() + len(lines) > limit):
+					self._queue_overloaded(lines, limit)
+				else:
+					for line in lines:
+						self._rqueue.put(message.Message.parse(line))
 			gevent.sleep(0)
 
-	def dependency_satisfier(self, dep):
-		for item in self._handlerobjects.keys():
-			if isinstance(item, dep):
-				return item
-		return None
-
-	def add_handler(self, handler):
-		if handler in self._handlerobjects.keys():
-			raise DuplicateHandlerObject(item)
-
-		dependencies, h_funcs = util.get_handler_properties(handler)
-		for dep in dependencies:
-			sat = self.dependency_satisfier(dep)
-			if not sat:
-				raise UnsatisfiedDependency(dep)
-			else:
-				# Increment refcount.
-				self._handlerobjects[sat] += 1
-
-		self._handlerobjects[handler] = 0
-
-		for h_name in h_funcs.iterkeys():
-			if self._handlers.has_key(h_name):
-				self._handlers[h_name].add(h_funcs[h_name])
-			else:
-				self._handlers[h_name] = set([h_funcs[h_name]])
-
-		# Special - spawn just this instance, not all "client_load" handlers.
-		if h_funcs.has_key('client_load'):
-			self._group.spawn(h_funcs['client_load'], self)
-
-	def remove_handler(self, handler):
-		if handler not in self._handlerobjects.keys():
-			raise MissingHandlerObject(handler)
-
-		if self._handlerobjects[handler] > 0:
-			raise LingeringDependency(handler)
-
-		del self._handlerobjects[handler]
-
-		dependencies, h_funcs = util.get_handler_properties(handler)
-		for dep in dependencies:
-			sat = self.dependency_satisfier(dep)
-			if not sat:
-				raise InvalidDependencyTree(dep)
-			else:
-				# Decrement refcount.
-				self._handlerobjects[sat] -= 1
-				if self._handlerobjects[sat] < 0:
-					raise InvalidDependencyTree(sat)
-
-		for h_name in h_funcs.iterkeys():
-			self._handlers[h_name] -= set([h_funcs[h_name]])
-			# If there aren't any handler functions left, remove that event entirely.
-			if not self._handlers[h_name]:
-				del self._handlers[h_name]
-
-		# Special - spawn just this instance of client_unload.
-		if h_funcs.has_key('client_unload'):
-			self._group.spawn(h_funcs['client_unload'], self)
-
-	def _handle(self, hname, *args, **kwargs):
-		if self._handlers.has_key(hname):
-			for handler in self._handlers[hname]:
-				self._group.spawn(handler, self, *args, **kwargs)
-
-	def _handle_recv(self, message):
-		self._handle('client_global_recv', message)
-		self._handle(message.command.upper(), message)
-
-	def send(self, message):
-		self._handle('client_global_send', message)
-		self._squeue.put(message)
-
-	def trigger_handler(self, handler, *args, **kwargs):
-		self._handle(handler, *args, **kwargs)
-
-	def get_handled_events(self):
-		return self._handlers.keys()
+	def _queue_overloaded(self, lines, limit):
+		policy = self.overload_policy
+		self._overload('recv')
+		if policy == Overload.PAUSE:
+			# Queue what we've already read, then stop reading.
+			for line in lines:
+				self._rqueue.put(message.Message.parse(line))
+			self._recv_room.clear()
+			self._recv_room.wait()
+			return
+		if policy == Overload.DROP:
+			# Nothing read until the queue has drained is kept.
+			self._lines_dropped.inc(len(lines))
+			return
+
+		room = max(limit - self._rqueue.qsize(), 0)
+		for line in lines[:room]:
+			self._rqueue.put(message.Message.parse(line))
+		dropped = len(lines) - room
+		if policy == Overload.SHED:
+			for line in lines[room:]:
+				msg = message.Message.parse(line)
+				if msg.command.upper() in ESSENTIAL_COMMANDS:
+					self._rqueue.put(msg)
+					dropped -= 1
+		if dropped > 0:
+			self._lines_dropped.inc(dropped)
 
 # A simple client that can stay connected to an IRC network and supports NickServ/SASL authentication.
 class SimpleClient(Client):
 	def __init__(self, nick, user, gecos, host, port, ssl=False, timeout=300, autoreconnect=False, version=None, source=None):
 		super(SimpleClient, self).__init__(host, port, ssl, timeout, source)
 
-		self.add_handler(handler.Ping())
-		self.add_handler(handler.User(nick, user, gecos))
-		self.add_handler(handler.NickInUse())
-		self.add_handler(handler.MessageProcessor())
-
-		if autoreconnect:
-			self.add_handler(handler.AutoReconnect())
-		else:
-			self.add_handler(handler.GenericDisconnect())
-
-		if version:
-			self.add_handler(handler.BasicCTCP(version))
-		else:
-			self.add_handler(handler.BasicCTCP())
+		for h in base.simple_handlers(nick, user, gecos, autoreconnect, version):
+			self.add_handler(h)
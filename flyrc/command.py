@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+import re
+
+_AMBIGUOUS = object()
+
+class Trie(object):
+	"""Maps words to values, and resolves unambiguous abbreviations: a
+	key that is the prefix of words all mapping to the same value
+	resolves to that value."""
+	__slots__ = ('children', 'value', 'only')
+
+	def __init__(self):
+		self.children = {}
+		self.value = None
+		# The value shared by every word below this node, or _AMBIGUOUS.
+		self.only = None
+
+	def insert(self, word, value):
+		node = self
+		for ch in word:
+			node._share(value)
+			child = node.children.get(ch)
+			if child is None:
+				child = node.children[ch] = Trie()
+			node = child
+		node._share(value)
+		node.value = value
+
+	def _share(self, value):
+		if self.only is None:
+			self.only = value
+		elif self.only != value:
+			self.only = _AMBIGUOUS
+
+	def lookup(self, key):
+		"""Return the value for key or the unique word it abbreviates,
+		or None."""
+		node = self
+		for ch in key:
+			node = node.children.get(ch)
+			if node is None:
+				return None
+		if node.value is not None:
+			return node.value
+		if node.only is _AMBIGUOUS:
+			return None
+		return node.only
+
+class CommandRouter(object):
+	"""Recognises commands in message text and works out which command_
+	event, if any, they should fire.
+
+	A line is a command if it starts with prefix or, when the router is
+	told the line was said in a channel, with our nick followed by ':' or
+	','.  Command names are matched against the command_ events the
+	client has handlers for, plus aliases (a dict of alias -> command)
+	and, if abbreviations is set, unambiguous prefixes of either.  The
+	table is rebuilt only when the client's handlers change, and the
+	nick pattern only when our nick does.
+
+	If limiter (a throttle.ReplyLimiter) is given, commands from sources
+	over its budget are ignored.
+	"""
+	def __init__(self, prefix='!', aliases=None, abbreviations=False, limiter=None):
+		self.prefix = prefix
+		self.aliases = dict(aliases or {})
+		self.abbreviations = abbreviations
+		self.limiter = limiter
+		self._table = None
+		self._version = None
+		self._nick = None
+		self._address = None
+		self._limited = (None, None)
+
+	def _refresh(self, client):
+		version = (client, client.handlers_version)
+		if version == self._version:
+			return
+		commands = {}
+		for event in client.get_handled_events():
+			if event[:8] == 'command_':
+				commands[event[8:]] = event
+		for alias, command in self.aliases.items():
+			event = commands.get(command.lower())
+			if event is None and client.handles('command_' + command.lower()):
+				event = 'command_' + command.lower()
+			if event:
+				commands.setdefault(alias.lower(), event)
+		if self.abbreviations:
+			table = Trie()
+			for name, event in commands.items():
+				table.insert(name, event)
+			self._table = table.lookup
+		else:
+			self._table = commands.get
+		self._version = version
+
+	def _address_pattern(self, client):
+		nick = client.nick
+		if nick != self._nick:
+			self._nick = nick
+			self._address = None
+			if nick:
+				self._address = re.compile(re.escape(nick) + "[:,] ", re.IGNORECASE)
+		return self._address
+
+	def split(self, client, text, channel=False):
+		"""Return (command, args) if text is a command, or None.  The
+		command is lowercased; args is everything after the first space."""
+		prefix = self.prefix
+		if text[:len(prefix)] == prefix:
+			text = text[len(prefix):]
+		elif channel:
+			address = self._address_pattern(client)
+			if address is None:
+				return None
+			match = address.match(text)
+			if not match:
+				return None
+			text = text[match.end():]
+		else:
+			return None
+		cmd, _, args = text.partition(' ')
+		if not cmd:
+			return None
+		return cmd.lower(), args
+
+	def event(self, client, cmd):
+		"""The command_ event that cmd fires, or None if nothing handles
+		it."""
+		self._refresh(client)
+		event = self._table(cmd)
+		if event is None and client.handles('command_' + cmd):
+			# Only handled by a pattern such as command_*.
+			event = 'command_' + cmd
+		return event
+
+	def dispatch(self, client, text, source, target, channel=False):
+		"""Fire global_command and the command's own event if text is a
+		command.  Returns whether it was."""
+		split = self.split(client, text, channel)
+		if split is None:
+			return False
+		cmd, args = split
+		if self.limiter and not self.limiter.allow(source.host or source.nick):
+			owner, limited = self._limited
+			if owner is not client:
+				limited = client.metrics.counter('replies_limited_total', 'Requests left unanswered by a reply limiter.')
+				self._limited = (client, limited)
+			limited.inc()
+			return True
+		event = self.event(client, cmd)
+		if event:
+			cmd = event[8:]
+		client.trigger_handler('global_command', cmd, source, target, args)
+		if event:
+			client.trigger_handler(event, source, target, args)
+		return True
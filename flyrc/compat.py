@@ -0,0 +1,37 @@
+#!/usr/bin/python
+
+# The differences between Python 2 and 3 that matter to the modules shared
+# by every client (see base.BaseClient).  Lines are native strs either
+# way: bytes on Python 2, text on Python 3.
+
+import sys
+
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+	text_type = str
+	string_types = (str,)
+	maketrans = str.maketrans
+
+	def native_str(data, encoding='utf-8'):
+		"""data (bytes or a str) as a native str."""
+		if isinstance(data, bytes):
+			return data.decode(encoding, 'replace')
+		return data
+else:
+	import string
+	text_type = unicode
+	string_types = (basestring,)
+	maketrans = string.maketrans
+
+	def native_str(data, encoding='utf-8'):
+		"""data (bytes or a str) as a native str."""
+		if isinstance(data, unicode):
+			return data.encode(encoding)
+		return data
+
+def to_text(data, encoding='utf-8'):
+	"""data (bytes or text) as text."""
+	if isinstance(data, bytes):
+		return data.decode(encoding, 'replace')
+	return data
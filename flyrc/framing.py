@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+from collections import deque
+from flyrc import metrics
+
+# Longest line we expect from a server: 8191 bytes of IRCv3 message tags
+# plus a 512-byte RFC 1459 message, not counting either line ending.
+MAX_LINE = 8191 + 510
+
+class LineTooLong(Exception):
+	"""Exception raised by a LineFramer using Overflow.ERROR when a line
+	exceeds its maximum length.
+
+	Attributes:
+		length - the number of bytes received before giving up.
+	"""
+	def __init__(self, length):
+		self.length = length
+
+	def __str__(self):
+		return "line exceeded %d bytes" % self.length
+
+class Overflow():
+	TRUNCATE=0
+	DISCARD=1
+	ERROR=2
+
+_CR = (b'\r', 13)
+
+class LineFramer(object):
+	"""Splits a byte stream into IRC lines.
+
+	Data is read into a preallocated buffer and only the newly received
+	bytes are scanned for line endings, so a partial line is never
+	rescanned as it grows.  Lines may end in either CRLF or a bare LF;
+	empty lines are skipped.
+
+	Attributes:
+		max_line - longest line accepted, excluding the line ending.
+		overflow - what to do with longer lines (see Overflow).
+		last_count - number of lines produced by the most recent read.
+		last_bytes - number of bytes in the most recent read.
+		overflows - metrics.Counter of lines that have exceeded max_line;
+		pass one in to keep counting across framers.
+	"""
+	def __init__(self, max_line=MAX_LINE, overflow=Overflow.TRUNCATE, bufsize=4096, overflows=None):
+		self.max_line = max_line
+		self.overflow = overflow
+		self.last_count = 0
+		self.last_bytes = 0
+		self.overflows = overflows if overflows is not None else metrics.Counter()
+		self._chunk = bytearray(bufsize)
+		self._view = memoryview(self._chunk)
+		self._partial = bytearray()
+		self._overflowed = False
+
+	def recv_from(self, sock):
+		"""Read once from sock and return the complete lines received,
+		or None if the peer has closed the connection."""
+		n = sock.recv_into(self._chunk)
+		if not n:
+			return None
+		return self._frame(self._chunk, self._view, n)
+
+	def feed(self, data):
+		"""Frame data that has already been read, returning the complete
+		lines it finished."""
+		return self._frame(data, memoryview(data), len(data))
+
+	def pending(self):
+		"""Number of bytes held from an unfinished line."""
+		return len(self._partial)
+
+	def _frame(self, data, view, n):
+		lines = []
+		start = 0
+		while True:
+			end = data.find(b'\n', start, n)
+			if end == -1:
+				break
+			stop = end
+			if stop > start and data[stop-1] in _CR:
+				stop -= 1
+			self._complete(view, start, stop, lines)
+			start = end + 1
+		if start < n:
+			self._append(view, start, n, True)
+		self.last_count = len(lines)
+		self.last_bytes = n
+		return lines
+
+	def _complete(self, view, start, stop, lines):
+		if self._partial or self._overflowed:
+			self._append(view, start, stop)
+			overflowed = self._overflowed
+			self._overflowed = False
+			if self._partial.endswith(b'\r'):
+				del self._partial[-1]
+			line = bytes(self._partial)
+			del self._partial[:]
+			if overflowed and self.overflow == Overflow.DISCARD:
+				return
+		else:
+			if stop - start > self.max_line:
+				self.overflows.inc()
+				if self.overflow == Overflow.ERROR:
+					raise LineTooLong(stop - start)
+				elif self.overflow == Overflow.DISCARD:
+					return
+				stop = start + self.max_line
+			line = view[start:stop].tobytes()
+		if line:
+			lines.append(line)
+
+	def _append(self, view, start, stop, last=False):
+		if self._overflowed:
+			return
+		# Negative if a CR from the end of the last read is being held.
+		room = max(self.max_line - len(self._partial), 0)
+		if last and stop - start == room + 1 and view[stop-1] in _CR:
+			# The read ended between a CR and its LF; the CR doesn't
+			# count towards the line's length.
+			room += 1
+		if stop - start > room:
+			self.overflows.inc()
+			self._overflowed = True
+			if self.overflow == Overflow.ERROR:
+				length = len(self._partial) + stop - start
+				del self._partial[:]
+				self._overflowed = False
+				raise LineTooLong(length)
+			elif self.overflow == Overflow.DISCARD:
+				del self._partial[:]
+				return
+			stop = start + room
+		self._partial += view[start:stop]
+
+class LineWriter(object):
+	"""Accumulates encoded lines and writes them out together.
+
+	All pending lines are joined into one buffer and written with as few
+	send calls as the socket allows.  Progress is tracked per line, so a
+	failed or partial write never resends a line that made it out or
+	forgets one that didn't.
+
+	Attributes:
+		dropped - number of partially written lines given up on by reset().
+	"""
+	def __init__(self):
+		self._lines = deque()
+		self._offset = 0
+		self.dropped = 0
+
+	def __len__(self):
+		return len(self._lines)
+
+	def append(self, line):
+		"""Queue an encoded line, which must include its line ending."""
+		self._lines.append(line)
+
+	def flush(self, sock):
+		"""Write every pending line to sock and return the number of lines
+		completely written.  If sending fails, anything not completely
+		written stays pending and the exception is re-raised."""
+		if len(self._lines) == 1:
+			data = self._lines[0]
+		else:
+			data = b''.join(self._lines)
+		if self._offset:
+			data = data[self._offset:]
+		total = len(data)
+		sent = 0
+		try:
+			while sent < total:
+				if sent:
+					sent += sock.send(data[sent:])
+				else:
+					sent += sock.send(data)
+		finally:
+			written = self._consume(sent)
+		return written
+
+	def reset(self):
+		"""Forget a line that was only partially written (it can't be
+		completed on a new connection); whole lines stay pending."""
+		if self._offset:
+			self._lines.popleft()
+			self._offset = 0
+			self.dropped += 1
+
+	def _consume(self, sent):
+		sent += self._offset
+		lines = self._lines
+		written = 0
+		while lines and len(lines[0]) <= sent:
+			sent -= len(lines.popleft())
+			written += 1
+		self._offset = sent
+		return written
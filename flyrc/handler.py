@@ -1,12 +1,65 @@
-from flyrc import message, util
+from __future__ import print_function
+from flyrc import command, compat, hostmask, message, throttle, util
 import base64
-import re
 
 class Ping(object):
+	INLINE = True
+
 	def irc_PING(self, client, msg):
 		client.send(message.pong(msg.args[0]))
 
+class ForgetHostmasks(object):
+	"""Evict hostmasks from the intern cache once a NICK or QUIT makes
+	them stale."""
+	INLINE = True
+
+	def irc_NICK(self, client, msg):
+		if msg.source:
+			hostmask.forget(msg.source)
+
+	irc_QUIT = irc_NICK
+
+class OwnHostmask(object):
+	"""Keeps client.hostmask, our own nick!user@host as others see it,
+	up to date, so client.say knows how much room the server's prefix
+	takes."""
+	INLINE = True
+
+	def irc_client_disconnected(self, client):
+		client.hostmask = None
+
+	def irc_RPL_WELCOME(self, client, msg):
+		# Most servers end the welcome with our full prefix.
+		words = msg.args[-1].split()
+		if words and '!' in words[-1] and '@' in words[-1]:
+			mask = hostmask.Hostmask.parse(words[-1])
+			if client.is_me(mask.nick):
+				client.hostmask = mask
+
+	def irc_JOIN(self, client, msg):
+		if msg.source.host and client.is_me(msg.source.nick):
+			client.hostmask = msg.source
+
+	def irc_NICK(self, client, msg):
+		if client.hostmask is not None and client.casefold(msg.source.nick) == client.casefold(client.hostmask.nick):
+			mask = client.hostmask
+			client.hostmask = hostmask.Hostmask(msg.args[0], mask.user, mask.host)
+
+	def irc_RPL_HOSTHIDDEN(self, client, msg):
+		mask = client.hostmask
+		if mask is not None:
+			client.hostmask = hostmask.Hostmask(mask.nick, mask.user, msg.args[1])
+
+	def irc_RPL_LOGGEDIN(self, client, msg):
+		client.hostmask = hostmask.Hostmask.parse(msg.args[1])
+
+	def irc_CHGHOST(self, client, msg):
+		if client.is_me(msg.source.nick):
+			client.hostmask = hostmask.Hostmask(msg.source.nick, msg.args[0], msg.args[1])
+
 class AutoJoin(object):
+	INLINE = True
+
 	def __init__(self, *args):
 		self.channels = args
 
@@ -15,6 +68,8 @@ class AutoJoin(object):
 			client.send(message.join(channel))
 
 class NickInUse(object):
+	INLINE = True
+
 	def irc_ERR_NICKNAMEINUSE(self, client, msg):
 		client.nick = msg.args[1] + '_'
 		client.send(message.nick(client.nick))
@@ -22,6 +77,8 @@ class NickInUse(object):
 	irc_ERR_NICKCOLLISION = irc_ERR_NICKNAMEINUSE
 
 class CAP(object):
+	INLINE = True
+
 	def irc_client_load(self, client):
 		self.req = set([])
 		self.interactive = set([])
@@ -83,9 +140,13 @@ class CAP(object):
 
 class SASLPlain(object):
 	DEPENDENCIES = [CAP]
+	INLINE = True
 
 	def __init__(self, user, password):
-		self.auth = base64.b64encode("%s\0%s\0%s" % (user, user, password))
+		auth = "%s\0%s\0%s" % (user, user, password)
+		if isinstance(auth, compat.text_type):
+			auth = auth.encode('utf-8')
+		self.auth = compat.native_str(base64.b64encode(auth))
 
 	def irc_client_load(self, client):
 		client.trigger_handler('cap_request_interactive', 'sasl')
@@ -101,13 +162,39 @@ class SASLPlain(object):
 		client.send(message.authenticate(self.auth))
 		client.send(message.cap('END'))
 
+class Batch(object):
+	"""Asks for the IRCv3 batch capability.  With it, the server groups
+	related lines (a netsplit's QUITs, a netjoin's JOINs, ...) into
+	batches, which the client collects and fires as batch_<type> events
+	with a message.Batch.  A handler with a batch_<type> function gets
+	the batch instead of the individual events for the lines in it;
+	other handlers get those as usual, once the batch is complete."""
+	DEPENDENCIES = [CAP]
+	INLINE = True
+
+	def irc_client_load(self, client):
+		client.trigger_handler('cap_request', 'batch')
+
+	def irc_client_unload(self, client):
+		client.trigger_handler('cap_request_remove', 'batch')
+
 class ISupport(object):
-	"""This relies on the server sending RPL_VERSION right before RPL_ISUPPORT."""
+	"""Parses RPL_ISUPPORT into client.isupport (see util.parse_isupport
+	for the value types), and keeps client.casefold and client.chantypes
+	in line with CASEMAPPING and CHANTYPES.
+
+	This relies on the server sending RPL_VERSION right before RPL_ISUPPORT."""
+	INLINE = True
+
 	def irc_client_load(self, client):
 		client.isupport = {}
+		client.casefold = util.casefold
+		client.chantypes = util.DEFAULT_CHANTYPES
 
 	def irc_client_unload(self, client):
 		del client.isupport
+		client.casefold = util.casefold
+		client.chantypes = util.DEFAULT_CHANTYPES
 
 	irc_RPL_VERSION = irc_client_load
 
@@ -121,10 +208,20 @@ class ISupport(object):
 			else:
 				token = token[0]
 			token = token.upper()
-			# TODO: parse value to make it more useful.
-			client.isupport[token] = value
+			if token[:1] == '-':
+				token = token[1:]
+				client.isupport.pop(token, None)
+				value = None
+			else:
+				value = client.isupport[token] = util.parse_isupport(token, value)
+			if token == 'CASEMAPPING':
+				client.casefold = util.casefolder(value)
+			elif token == 'CHANTYPES':
+				client.chantypes = value or util.DEFAULT_CHANTYPES
 
 class User(object):
+	INLINE = True
+
 	def __init__(self, nick, user, gecos):
 		self.nick = nick
 		self.user = user
@@ -139,19 +236,19 @@ class User(object):
 
 class LogToConsole(object):
 	def irc_client_connected(self, client):
-		print "Connected to server."
+		print("Connected to server.")
 
 	def irc_client_global_send(self, client, msg):
-		print "<< %s" % msg.render()
+		print("<< %s" % msg.render())
 
 	def irc_client_global_recv(self, client, msg):
-		print ">> %s" % msg.render()
+		print(">> %s" % msg.render())
 
 	def irc_client_disconnected(self, client):
-		print "Disconnected from server."
+		print("Disconnected from server.")
 
 	def irc_client_error(self, client, err):
-		print "ERROR: %s" % repr(err)
+		print("ERROR: %s" % repr(err))
 
 class GenericDisconnect(object):
 	def irc_ERROR(self, client, message):
@@ -161,6 +258,8 @@ class GenericDisconnect(object):
 		client.shutdown()
 
 class Oper(object):
+	INLINE = True
+
 	def __init__(self, user, password):
 		self.user = user
 		self.password = password
@@ -174,6 +273,22 @@ class Oper(object):
 
 class MessageProcessor(object):
 	DEPENDENCIES = [User]
+	INLINE = True
+
+	def __init__(self):
+		# Cache of CTCP command -> event name, so hot CTCPs don't
+		# build a new string for every message.
+		self._ctcp_events = {'ctcp_request_': {}, 'ctcp_reply_': {}}
+
+	def _ctcp_event(self, kind, command):
+		events = self._ctcp_events[kind]
+		name = events.get(command)
+		if name is None:
+			name = kind + command.upper()
+			# CTCP commands come from other users, so keep this bounded.
+			if len(events) < 256:
+				events[command] = name
+		return name
 
 	def irc_PRIVMSG(self, client, message):
 		ctcp = util.parse_ctcp(message.args[1])
@@ -182,15 +297,15 @@ class MessageProcessor(object):
 			if len(ctcp) > 1:
 				ctcp_args = ctcp[1]
 			if ctcp[0] == "ACTION":
-				if util.is_nick(message.args[0]):
+				if util.is_nick(message.args[0], client.chantypes):
 					client.trigger_handler('private_action', message.source, ctcp_args)
 				else:
 					client.trigger_handler('channel_action', message.source, message.args[0], ctcp_args)
 			else:
 				#client.trigger_handler('ctcp_request', message.source, message.args[0], ctcp[0], ctcp_args)
-				client.trigger_handler('ctcp_request_'+ctcp[0].upper(), message.source, message.args[0], ctcp_args)
+				client.trigger_handler(self._ctcp_event('ctcp_request_', ctcp[0]), message.source, message.args[0], ctcp_args)
 		else:
-			if util.is_channel(message.args[0]):
+			if util.is_channel(message.args[0], client.chantypes):
 				client.trigger_handler('channel_message', message.source, message.args[0], message.args[1])
 			else:
 				client.trigger_handler('private_message', message.source, message.args[1])
@@ -202,71 +317,88 @@ class MessageProcessor(object):
 			if len(ctcp) > 1:
 				ctcp_args = ctcp[1]
 			client.trigger_handler('ctcp_reply', message.source, message.args[0], ctcp[0], ctcp_args)
-			client.trigger_handler('ctcp_reply_'+ctcp[0].upper(), message.source, message.args[0], ctcp_args)
+			client.trigger_handler(self._ctcp_event('ctcp_reply_', ctcp[0]), message.source, message.args[0], ctcp_args)
 		else:
 			if util.is_server(message.source.nick):
 				client.trigger_handler('server_notice', message.source.nick, message.args[1])
-			if util.is_channel(message.args[0]):
+			if util.is_channel(message.args[0], client.chantypes):
 				client.trigger_handler('channel_notice', message.source, message.args[0], message.args[1])
 			else:
 				client.trigger_handler('private_notice', message.source, message.args[1])
 
 class BasicCTCP(object):
+	"""Answers CTCP CLIENTINFO, VERSION and PING.  Replies are sent at
+	BULK priority and limited by limiter (a throttle.ReplyLimiter, keyed
+	by the requester's host), so a flood of requests can't hold up
+	anything else."""
 	DEPENDENCIES = [MessageProcessor]
+	INLINE = True
 
-	def __init__(self, version="flyrc 0.1"):
+	def __init__(self, version="flyrc 0.1", limiter=None):
 		self.version = version
+		self.limiter = limiter or throttle.ReplyLimiter()
+		self._clientinfo = (None, None)
+		self._limited = (None, None)
+
+	def reply(self, client, source, *ctcp):
+		if not self.limiter.allow(source.host or source.nick):
+			# Looked up once per client rather than on every refusal.
+			owner, limited = self._limited
+			if owner is not client:
+				limited = client.metrics.counter('replies_limited_total', 'Requests left unanswered by a reply limiter.')
+				self._limited = (client, limited)
+			limited.inc()
+			return
+		client.send(message.notice(source.nick, util.ctcp(*ctcp)), throttle.Priority.BULK)
 
 	def irc_ctcp_request_CLIENTINFO(self, client, source, target, args):
-		all_handlers = client.get_handled_events()
-		ctcps = []
-		for handler in all_handlers:
-			if handler[:13] == "ctcp_request_":
-				h = handler[13:]
-				ctcps.append(h)
-		client.send(message.notice(source.nick, util.ctcp("CLIENTINFO", ' '.join(ctcps))))
+		# Only rebuilt when the client's handlers change.
+		version, ctcps = self._clientinfo
+		if version != (client, client.handlers_version):
+			ctcps = ' '.join(event[13:] for event in client.get_handled_events() if event[:13] == "ctcp_request_")
+			self._clientinfo = ((client, client.handlers_version), ctcps)
+		self.reply(client, source, "CLIENTINFO", ctcps)
 
 	def irc_ctcp_request_VERSION(self, client, source, target, args):
-		client.send(message.notice(source.nick, util.ctcp("VERSION", self.version)))
+		self.reply(client, source, "VERSION", self.version)
 
 	def irc_ctcp_request_PING(self, client, source, target, args):
 		if args:
-			client.send(message.notice(source.nick, util.ctcp("PING", args)))
+			self.reply(client, source, "PING", args)
 		else:
-			client.send(message.notice(source.nick, util.ctcp("PING")))
+			self.reply(client, source, "PING")
 
 class BasicCommand(object):
 	"""Base class to use for handlers that provide command signals."""
 
 class BasicChannelCommand(BasicCommand):
+	"""Fires command_ events for channel messages starting with prefix
+	or addressed to us ("nick: command").  See command.CommandRouter for
+	aliases and abbreviations."""
 	DEPENDENCIES = [MessageProcessor]
+	INLINE = True
 
-	def __init__(self, prefix='!'):
-		self.prefix = re.escape(prefix)
+	def __init__(self, prefix='!', aliases=None, abbreviations=False, limiter=None):
+		self.router = command.CommandRouter(prefix, aliases, abbreviations, limiter)
 
 	def irc_channel_message(self, client, source, target, text):
-		match = re.match("^" + self.prefix + "([^ ]+) ?(.*)", text)
-		if not match:
-			match = re.match("^" + re.escape(client.nick) + "[:,] ([^ ]+) ?(.*)", text)
-		if match:
-			cmd = match.group(1).lower()
-			args = match.group(2)
-			client.trigger_handler('global_command', cmd, source, target, args)
-			client.trigger_handler('command_'+cmd, source, target, args)
+		self.router.dispatch(client, text, source, target, True)
 
 class BasicPrivateCommand(BasicCommand):
+	"""Fires command_ events for private messages, whose first word is
+	always the command."""
 	DEPENDENCIES = [MessageProcessor]
+	INLINE = True
+
+	def __init__(self, aliases=None, abbreviations=False, limiter=None):
+		self.router = command.CommandRouter('', aliases, abbreviations, limiter)
 
 	def irc_private_message(self, client, source, text):
-		match = re.match("^([^ ]+) ?(.*)", text)
-		if match:
-			cmd = match.group(1).lower()
-			args = match.group(2)
-			client.trigger_handler('global_command', cmd, source, None, args)
-			client.trigger_handler('command_'+cmd, source, None, args)
+		self.router.dispatch(client, text, source, None)
 
 class QuitWhenAsked(object):
 	DEPENDENCIES = [BasicCommand]
+	INLINE = True
 
 	def irc_command_quit(self, client, source, target, args):
 		client.send(message.quit("Requested by %s." % source.nick))
@@ -277,4 +409,4 @@ class LogCommands(object):
 	def irc_global_command(self, client, command, source, target, args):
 		if not args:
 			args = ''
-		print "Command: <%s!%s@%s %s> %s %s" % (source.nick, source.user, source.host, target, command, args)
+		print("Command: <%s!%s@%s %s> %s %s" % (source.nick, source.user, source.host, target, command, args))
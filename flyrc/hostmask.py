@@ -1,8 +1,34 @@
 #!/usr/bin/python
 
+from flyrc.cache import LRUCache
+
+# Recently seen prefixes, shared by every client in the process.  The
+# same nick!user@host parses to the same Hostmask instance while it's
+# cached; resize with interned.maxsize.
+interned = LRUCache(8192)
+
+def forget(mask):
+	"""Drop a hostmask (or prefix string) from the intern cache, e.g.
+	because a NICK or QUIT has made it stale."""
+	interned.discard(str(mask))
+
 class Hostmask(object):
+	"""A nick!user@host prefix.  Hostmasks are immutable, so parsed
+	instances can be shared."""
+	__slots__ = ('nick', 'user', 'host')
+
 	@classmethod
 	def parse(cls, text):
+		if text and cls is Hostmask:
+			mask = interned.get(text)
+			if mask is None:
+				mask = cls._parse(text)
+				interned.put(text, mask)
+			return mask
+		return cls._parse(text)
+
+	@classmethod
+	def _parse(cls, text):
 		nick = None
 		user = None
 		host = None
@@ -15,9 +41,32 @@ class Hostmask(object):
 		return cls(nick, user, host)
 
 	def __init__(self, n, u, h):
-		self.nick = n
-		self.user = u
-		self.host = h
+		object.__setattr__(self, 'nick', n)
+		object.__setattr__(self, 'user', u)
+		object.__setattr__(self, 'host', h)
+
+	def __setattr__(self, name, value):
+		raise AttributeError("%s is immutable" % type(self).__name__)
+
+	def __delattr__(self, name):
+		raise AttributeError("%s is immutable" % type(self).__name__)
+
+	def __reduce__(self):
+		return (type(self), (self.nick, self.user, self.host))
+
+	def __eq__(self, other):
+		if not isinstance(other, Hostmask):
+			return NotImplemented
+		return self is other or (self.nick == other.nick and self.user == other.user and self.host == other.host)
+
+	def __ne__(self, other):
+		eq = self.__eq__(other)
+		if eq is NotImplemented:
+			return eq
+		return not eq
+
+	def __hash__(self):
+		return hash((self.nick, self.user, self.host))
 
 	def __str__(self):
 		if self.user and self.host:
@@ -1,158 +1,502 @@
-from flyrc import util
+from collections import deque
+from flyrc import message, throttle, util
 import time
 
+class User(object):
+	"""Everything known about a user.  channels is a tuple of the
+	Channels we share with them (a tuple rather than a set, since most
+	users share only a few and tuples are much smaller); the fields
+	filled in by WHO and WHOIS are None until one has been seen."""
+	__slots__ = ('nick', 'user', 'host', 'realname', 'server', 'account',
+		'ssl', 'oper', 'away', 'signon', 'idle', 'channels', 'updated')
+
+	def __init__(self, nick):
+		self.nick = nick
+		self.user = None
+		self.host = None
+		self.realname = None
+		self.server = None
+		self.account = None
+		self.ssl = False
+		self.oper = False
+		self.away = False
+		self.signon = None
+		self.idle = None
+		self.channels = ()
+		self.updated = None
+
+	def __repr__(self):
+		return "<User %s>" % self.nick
+
+class Channel(object):
+	"""A channel we're in.  members maps each User in the channel to
+	their status prefixes (e.g. '@+'), highest first; modes maps the
+	channel's modes to their parameter, or True if they have none.
+	synced is set once NAMES has told us who is in the channel, and
+	detailed once WHO (see ChannelSync) has filled in their details."""
+	__slots__ = ('name', 'topic', 'modes', 'members', 'synced', 'detailed', 'updated')
+
+	def __init__(self, name):
+		self.name = name
+		self.topic = None
+		self.modes = {}
+		self.members = {}
+		self.synced = False
+		self.detailed = False
+		self.updated = time.time()
+
+	def __repr__(self):
+		return "<Channel %s>" % self.name
+
+def split_status(name, prefixes):
+	"""Split the status prefixes off a name from NAMES or WHOIS,
+	returning (status, name) with status ordered like prefixes."""
+	i = 0
+	while i < len(name) and name[i] in prefixes:
+		i += 1
+	if not i:
+		return '', name
+	status = name[:i]
+	return ''.join(p for p in prefixes if p in status), name[i:]
+
 class InfoTracker(object):
-	"""This is half-implemented, you probably shouldn't use it."""
+	"""Tracks the users and channels we can see.
+
+	client.users maps casefolded nicks to User objects, and
+	client.channels maps casefolded channel names to Channel objects.
+	Both are updated as JOIN, PART, KICK, QUIT, NICK, MODE, TOPIC and
+	NAMES replies arrive; WHOIS replies fill in the rest of a User.  If
+	evict is set, users are forgotten as soon as they share no channel
+	with us.
+
+	Netsplit and netjoin batches (see handler.Batch) are applied in one
+	pass as they arrive.
+	"""
+	INLINE = True
+
+	def __init__(self, evict=True):
+		self.evict = evict
+
 	def irc_client_load(self, client):
 		client.users = {}
 		client.channels = {}
 		client.infotracker_pwcstash = {}
+		client.infotracker_names = {}
 
 	def irc_client_unload(self, client):
 		del client.users
 		del client.channels
 		del client.infotracker_pwcstash
+		del client.infotracker_names
 
-	@staticmethod
-	def make_new_user():
-		u = {
-			'nickname': '',
-			'username': '',
-			'hostname': '',
-			'realname': '',
-			'server': '',
-			'ssl': False,
-			'channels': set([]),
-			'account': None,
-			'oper': False,
-			'signon': None,
-			'idle': None,
-			'synced': False,
-			'last-update': time.time()
-		}
-		return u
+	def irc_client_disconnected(self, client):
+		client.users.clear()
+		client.channels.clear()
+		client.infotracker_pwcstash.clear()
+		client.infotracker_names.clear()
 
 	@staticmethod
-	def make_new_channel():
-		c = {
-			'name': '',
-			'topic': '',
-			'modes': '',
-			'bans': [],
-			'quiets': [],
-			'ban-exempts': [],
-			'invite-exempts': [],
-			'users': set([]),
-			'voices': set([]),
-			'halfops': set([]),
-			'ops': set([]),
-			'admins': set([]),
-			'founders': set([]),
-			'synced': False,
-			'last-update': time.time()
-		}
-		return c
+	def prefix(client):
+		"""(modes, prefixes) from ISUPPORT PREFIX, e.g. ('ov', '@+')."""
+		return getattr(client, 'isupport', {}).get('PREFIX', util.DEFAULT_PREFIX)
 
 	@staticmethod
-	def add_user(client, user):
-		if not client.users.has_key(user):
-			client.users[user] = self.make_new_user()
-			client.users[user]['nickname'] = user
+	def chanmodes(client):
+		return getattr(client, 'isupport', {}).get('CHANMODES', util.DEFAULT_CHANMODES)
 
-	@staticmethod
-	def add_channel(client, chan):
-		if not client.channels.has_key(chan):
-			client.channels[chan] = self.make_new_channel()
-			client.channels[chan]['name'] = chan
+	def get_user(self, client, nick):
+		key = client.casefold(nick)
+		user = client.users.get(key)
+		if user is None:
+			# Share the string when the nick is already casefolded.
+			if key == nick:
+				nick = key
+			user = client.users[key] = User(nick)
+		return user
 
-	@staticmethod
-	def remove_channel_status(client, chan, nick):
-		user = client.users[nick]
-		client.channels[chan]['voices'].discard(user)
-		client.channels[chan]['halfops'].discard(user)
-		client.channels[chan]['ops'].discard(user)
-		client.channels[chan]['admins'].discard(user)
-		client.channels[chan]['founders'].discard(user)
+	def get_channel(self, client, name):
+		key = client.casefold(name)
+		chan = client.channels.get(key)
+		if chan is None:
+			chan = client.channels[key] = Channel(name)
+		return chan
 
-	@staticmethod
-	def add_user_to_channel(client, chan, nick):
-		client.channels[chan]['users'].add(client.users[nick])
-		client.users[nick]['channels'].add(client.channels[chan])
+	def update_user(self, client, source):
+		"""Get the User for a message source, filling in user@host."""
+		user = self.get_user(client, source.nick)
+		if source.user:
+			user.user = source.user
+			user.host = source.host
+		return user
 
-	@staticmethod
-	def remove_user_from_channel(client, chan, nick):
-		remove_channel_status(client, chan, nick)
-		client.channels[chan]['users'].discard(client.users[nick])
-		client.users[nick]['channels'].discard(client.channels[chan])
+	def add_member(self, chan, user, status=''):
+		if user not in chan.members:
+			user.channels += (chan,)
+		chan.members[user] = status
+
+	def remove_member(self, client, chan, user):
+		if chan.members.pop(user, None) is not None:
+			user.channels = tuple(c for c in user.channels if c is not chan)
+			if self.evict and not user.channels and not client.is_me(user.nick):
+				self.forget_user(client, user)
+
+	def forget_user(self, client, user):
+		key = client.casefold(user.nick)
+		if client.users.get(key) is user:
+			del client.users[key]
+
+	def forget_channel(self, client, chan):
+		for user in list(chan.members):
+			self.remove_member(client, chan, user)
+		key = client.casefold(chan.name)
+		if client.channels.get(key) is chan:
+			del client.channels[key]
+		client.infotracker_names.pop(key, None)
+
+	def irc_JOIN(self, client, msg):
+		name = msg.args[0]
+		if client.is_me(msg.source.nick):
+			chan = self.get_channel(client, name)
+			chan.synced = False
+		else:
+			chan = client.channels.get(client.casefold(name))
+			if chan is None:
+				return
+		user = self.update_user(client, msg.source)
+		# extended-join: JOIN #channel account :realname
+		if len(msg.args) > 2:
+			user.account = msg.args[1] != '*' and msg.args[1] or None
+			user.realname = msg.args[2]
+		self.add_member(chan, user)
+
+	def irc_PART(self, client, msg):
+		self.part(client, msg.args[0], msg.source.nick)
+
+	def irc_KICK(self, client, msg):
+		self.part(client, msg.args[0], msg.args[1])
+
+	def part(self, client, name, nick):
+		chan = client.channels.get(client.casefold(name))
+		if chan is None:
+			return
+		if client.is_me(nick):
+			self.forget_channel(client, chan)
+			return
+		user = client.users.get(client.casefold(nick))
+		if user is not None:
+			self.remove_member(client, chan, user)
+
+	def irc_QUIT(self, client, msg):
+		user = client.users.get(client.casefold(msg.source.nick))
+		if user is None:
+			return
+		for chan in user.channels:
+			del chan.members[user]
+		user.channels = ()
+		self.forget_user(client, user)
+
+	def irc_batch_netsplit(self, client, batch):
+		# We don't see the batch's lines individually, so apply them all
+		# here, without going through the client's dispatch.
+		for msg in batch:
+			if isinstance(msg, message.Message):
+				handler = getattr(self, 'irc_' + msg.command.upper(), None)
+				if handler is not None:
+					handler(client, msg)
+
+	irc_batch_netjoin = irc_batch_netsplit
+
+	def irc_NICK(self, client, msg):
+		old = client.casefold(msg.source.nick)
+		new = msg.args[0]
+		if client.is_me(msg.source.nick):
+			client.nick = new
+		user = client.users.pop(old, None)
+		if user is None:
+			return
+		key = client.casefold(new)
+		if key == new:
+			new = key
+		user.nick = new
+		client.users[key] = user
+
+	def irc_MODE(self, client, msg):
+		chan = client.channels.get(client.casefold(msg.args[0]))
+		if chan is None:
+			return
+		self.apply_modes(client, chan, msg.args[1], msg.args[2:])
+
+	def apply_modes(self, client, chan, modestring, params):
+		prefix_modes, prefixes = self.prefix(client)
+		lists, always, when_set, never = self.chanmodes(client)
+		params = iter(params)
+		adding = True
+		for mode in modestring:
+			if mode == '+':
+				adding = True
+			elif mode == '-':
+				adding = False
+			elif mode in prefix_modes:
+				nick = next(params, None)
+				user = nick and client.users.get(client.casefold(nick))
+				if user is None or user not in chan.members:
+					continue
+				symbol = prefixes[prefix_modes.index(mode)]
+				status = chan.members[user].replace(symbol, '')
+				if adding:
+					status = ''.join(p for p in prefixes if p in status or p == symbol)
+				chan.members[user] = status
+			elif mode in lists:
+				# List modes (bans and the like) aren't tracked.
+				next(params, None)
+			elif mode in always or (adding and mode in when_set):
+				param = next(params, None)
+				if adding:
+					chan.modes[mode] = param
+				else:
+					chan.modes.pop(mode, None)
+			elif adding:
+				chan.modes[mode] = True
+			else:
+				chan.modes.pop(mode, None)
+		chan.updated = time.time()
+
+	def irc_RPL_CHANNELMODEIS(self, client, msg):
+		chan = client.channels.get(client.casefold(msg.args[1]))
+		if chan is not None:
+			chan.modes = {}
+			self.apply_modes(client, chan, msg.args[2], msg.args[3:])
+
+	def irc_TOPIC(self, client, msg):
+		chan = client.channels.get(client.casefold(msg.args[0]))
+		if chan is not None:
+			chan.topic = msg.args[1]
+
+	def irc_RPL_TOPIC(self, client, msg):
+		chan = client.channels.get(client.casefold(msg.args[1]))
+		if chan is not None:
+			chan.topic = msg.args[2]
+
+	def irc_RPL_NAMREPLY(self, client, msg):
+		chan = client.channels.get(client.casefold(msg.args[2]))
+		if chan is None:
+			return
+		prefixes = self.prefix(client)[1]
+		# Members seen since the first reply, so those who have gone can
+		# be removed at the end.
+		key = client.casefold(chan.name)
+		seen = client.infotracker_names.get(key)
+		if seen is None:
+			seen = client.infotracker_names[key] = set()
+		for name in msg.args[3].split():
+			status, name = split_status(name, prefixes)
+			# userhost-in-names: nick!user@host
+			nick, _, userhost = name.partition('!')
+			user = self.get_user(client, nick)
+			if userhost:
+				user.user, _, user.host = userhost.partition('@')
+			self.add_member(chan, user, status)
+			seen.add(user)
+
+	def irc_RPL_ENDOFNAMES(self, client, msg):
+		key = client.casefold(msg.args[1])
+		chan = client.channels.get(key)
+		seen = client.infotracker_names.pop(key, None)
+		if chan is None:
+			return
+		if seen is not None:
+			for user in [u for u in chan.members if u not in seen]:
+				self.remove_member(client, chan, user)
+		chan.synced = True
+		chan.updated = time.time()
 
 	def irc_RPL_WHOISUSER(self, client, msg):
-		nick, user, host = msg.args[1:3]
-		rn = msg.args[5]
-		add_user(client, nick)
-		client.users[nick]['username'] = user
-		client.users[nick]['hostname'] = host
-		client.users[nick]['realname'] = rn
+		nick, user, host = msg.args[1:4]
+		u = self.get_user(client, nick)
+		u.user = user
+		u.host = host
+		u.realname = msg.args[5]
+		# These are only sent when they apply, so reset them here.
+		u.oper = False
+		u.ssl = False
+		u.account = None
 
 	def irc_RPL_WHOISCHANNELS(self, client, msg):
-		nick, channels = msg.args[1:2]
-		channels = set(channels.split())
-		if client.infotracker_pwcstash.has_key(nick):
-			client.infotracker_pwcstash[nick] |= channels
-		else:
-			client.infotracker_pwcstash[nick] = channels
+		nick, channels = msg.args[1:3]
+		key = client.casefold(nick)
+		client.infotracker_pwcstash.setdefault(key, []).extend(channels.split())
 
 	def irc_RPL_WHOISSERVER(self, client, msg):
-		nick, server = msg.args[1:2]
-		client.users[nick]['server'] = server
+		self.get_user(client, msg.args[1]).server = msg.args[2]
 
-	# TODO - figure out how to note that this ISN'T present.
 	def irc_RPL_WHOISOPERATOR(self, client, msg):
-		nick = msg.args[1]
-		client.users[nick]['oper'] = True
+		self.get_user(client, msg.args[1]).oper = True
 
-	# TODO - figure out how to note that this ISN'T present.
 	def irc_RPL_WHOISSECURE(self, client, msg):
-		nick = msg.args[1]
-		client.users[nick]['ssl'] = True
+		self.get_user(client, msg.args[1]).ssl = True
 
-	# TODO - figure out how to note that this ISN'T present.
 	def irc_RPL_WHOISLOGGEDIN(self, client, msg):
-		nick, acct = msg.args[1:2]
-		client.users[nick]['account'] = acct
+		self.get_user(client, msg.args[1]).account = msg.args[2]
 
-	# TODO - build a new user object and discard the old one
-	# if signon time is different.
 	def irc_RPL_WHOISIDLE(self, client, msg):
-		nick, idle, signon = msg.args[1:3]
-		client.users[nick]['idle'] = int(idle)
-		client.users[nick]['signon'] = int(signon)
+		nick, idle, signon = msg.args[1:4]
+		user = self.get_user(client, nick)
+		user.idle = int(idle)
+		user.signon = int(signon)
 
 	def irc_RPL_ENDOFWHOIS(self, client, msg):
 		nick = msg.args[1]
+		key = client.casefold(nick)
+		user = client.users.get(key)
+		names = client.infotracker_pwcstash.pop(key, [])
+		if user is None:
+			return
 
-		# Change the channel stuff.
-		new_channels_obj = set([])
-		new_channels = set([])
-		if client.infotracker_pwcstash.has_key(nick):
-			new_channels = client.infotracker_pwcstash[nick]
-			del client.infotracker_pwcstash[nick]
-
-		for channel in channels:
-			status = []
-			while channel[0] in util.channel_status_map.keys():
-				status += util.channel_status_map[channel[0]]
-				channel = channel[1:]
-			add_channel(client, channel)
-			new_channels_obj.add(client.channels[channel])
-			client.channels[channel]['users'].add(client.users[nick])
-			self.remove_channel_status(client, channel, nick)
-			for s in status:
-				client.channels[channel][s+'s'].add(client.users[nick])
-		removed_channels = client.users[nick]['channels'] - new_channels_obj
-		for channel in removed_channels:
-			self.remove_user_from_channel(client, channel['name'], nick)
-		client.users['nick']['channels'] = new_channels_obj
-
-		# Set last-update and signal the whois_available event.
-		client.users[nick]['last-update'] = time.time()
+		# Update status in the channels we share; WHOIS doesn't tell us
+		# about channels we aren't in (or secret ones), so membership
+		# elsewhere is left alone.
+		prefixes = self.prefix(client)[1]
+		for name in names:
+			status, name = split_status(name, prefixes)
+			chan = client.channels.get(client.casefold(name))
+			if chan is not None:
+				self.add_member(chan, user, status)
+
+		user.updated = time.time()
 		client.trigger_handler('whois_available', nick)
+
+class _SyncState(object):
+	__slots__ = ('tracker', 'queue', 'pending', 'token')
+
+	def __init__(self, tracker):
+		self.tracker = tracker
+		# Casefolded names of channels waiting for a WHO.
+		self.queue = deque()
+		# Token -> casefolded name of each channel with a WHO in flight.
+		self.pending = {}
+		self.token = 0
+
+class ChannelSync(object):
+	"""Fills in the details of everyone in a channel with a single WHO
+	once we've joined it (and seen its NAMES), rather than a WHOIS per
+	user.
+
+	If the server supports WHOX, the request asks for just the fields
+	InfoTracker keeps (including accounts) and is tagged with a token,
+	so replies are matched to it even when several are in flight;
+	otherwise a plain WHO is sent.  At most concurrency WHOs are in
+	flight at once, and the rest wait their turn.  They're sent at BULK
+	priority, so they don't hold up anything else.  Fires
+	channel_synced(channel) when a channel's WHO completes.
+	"""
+	DEPENDENCIES = [InfoTracker]
+	INLINE = True
+
+	WHOX_FIELDS = 'tcuhnfar'
+
+	def __init__(self, concurrency=2):
+		self.concurrency = concurrency
+
+	def irc_client_load(self, client):
+		client.channelsync = _SyncState(client.dependency_satisfier(InfoTracker))
+
+	def irc_client_unload(self, client):
+		del client.channelsync
+
+	def irc_client_disconnected(self, client):
+		client.channelsync.queue.clear()
+		client.channelsync.pending.clear()
+
+	def irc_RPL_ENDOFNAMES(self, client, msg):
+		# The end of the NAMES that follows our JOIN; by now InfoTracker
+		# has the channel.
+		state = client.channelsync
+		key = client.casefold(msg.args[1])
+		chan = client.channels.get(key)
+		if chan is not None and not chan.detailed and key not in state.queue and key not in state.pending.values():
+			state.queue.append(key)
+			self.next(client)
+
+	def irc_PART(self, client, msg):
+		if client.is_me(msg.source.nick):
+			self.forget(client, msg.args[0])
+
+	def irc_KICK(self, client, msg):
+		if client.is_me(msg.args[1]):
+			self.forget(client, msg.args[0])
+
+	def forget(self, client, name):
+		key = client.casefold(name)
+		try:
+			client.channelsync.queue.remove(key)
+		except ValueError:
+			pass
+
+	def next(self, client):
+		"""Send WHOs for queued channels, up to the concurrency limit."""
+		state = client.channelsync
+		whox = 'WHOX' in getattr(client, 'isupport', {})
+		while state.queue and len(state.pending) < self.concurrency:
+			key = state.queue.popleft()
+			chan = client.channels.get(key)
+			if chan is None:
+				continue
+			# WHOX tokens are at most three digits.
+			token = state.token
+			while True:
+				token = token % 999 + 1
+				if str(token) not in state.pending:
+					break
+			state.token = token
+			state.pending[str(token)] = key
+			if whox:
+				client.send(message.who(chan.name, '%%%s,%d' % (self.WHOX_FIELDS, token)), throttle.Priority.BULK)
+			else:
+				client.send(message.who(chan.name), throttle.Priority.BULK)
+
+	def update(self, client, key, username, host, nick, flags, account, realname):
+		tracker = client.channelsync.tracker
+		chan = client.channels.get(key)
+		if chan is None:
+			return
+		user = tracker.get_user(client, nick)
+		user.user = username
+		user.host = host
+		user.realname = realname
+		if account is not None:
+			user.account = account != '0' and account or None
+		user.away = flags[:1] == 'G'
+		user.oper = '*' in flags
+		prefixes = tracker.prefix(client)[1]
+		tracker.add_member(chan, user, ''.join(p for p in prefixes if p in flags))
+
+	def irc_RPL_WHOSPCRPL(self, client, msg):
+		# me token channel user host nick flags account :realname
+		# (an empty realname leaves the last argument out).
+		args = msg.args
+		key = client.channelsync.pending.get(args[1])
+		if key is not None and len(args) >= 8:
+			realname = args[8] if len(args) > 8 else ''
+			self.update(client, key, args[3], args[4], args[5], args[6], args[7], realname)
+
+	def irc_RPL_WHOREPLY(self, client, msg):
+		# me channel user host server nick flags :hopcount realname
+		args = msg.args
+		key = client.casefold(args[1])
+		if key in client.channelsync.pending.values():
+			realname = args[7].partition(' ')[2]
+			self.update(client, key, args[2], args[3], args[5], args[6], None, realname)
+
+	def irc_RPL_ENDOFWHO(self, client, msg):
+		state = client.channelsync
+		key = client.casefold(msg.args[1])
+		for token, pending in state.pending.items():
+			if pending == key:
+				del state.pending[token]
+				chan = client.channels.get(key)
+				if chan is not None:
+					chan.detailed = True
+					chan.updated = time.time()
+					client.trigger_handler('channel_synced', chan.name)
+				break
+		self.next(client)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+import gevent
+import gevent.pool
+from time import time
+from flyrc import message
+
+class ClientManager(object):
+	"""Runs many clients in one process.
+
+	The manager starts its clients a few at a time, reports on them as a
+	whole, and stops them together.  It offers the same start, send,
+	shutdown and join methods as a client, so util.run_client works on a
+	manager too (sending broadcasts to every connected client).
+
+	Handler metadata is introspected once per handler class and shared by
+	every client (see util.handler_class).
+
+	Attributes:
+		clients - name -> client.
+		stagger - seconds between starting consecutive clients.
+	"""
+	def __init__(self, stagger=0.5):
+		self.clients = {}
+		self.stagger = stagger
+		self._starters = gevent.pool.Group()
+
+	def __len__(self):
+		return len(self.clients)
+
+	def add(self, client, name=None):
+		"""Add a client, returning the name it's managed under."""
+		if name is None:
+			name = "%s:%s#%d" % (client.host, client.port, id(client))
+		self.clients[name] = client
+		return name
+
+	def remove(self, name):
+		"""Stop managing a client (it's left running) and return it."""
+		return self.clients.pop(name)
+
+	def start(self):
+		"""Start every client, stagger seconds apart so a whole fleet
+		doesn't hit the network at once."""
+		self._starters.spawn(self._start_all, self.clients.values())
+
+	def _start_all(self, clients):
+		for i, client in enumerate(clients):
+			if i:
+				gevent.sleep(self.stagger)
+			self._starters.spawn(client.start)
+
+	def send(self, msg, priority=None):
+		"""Send msg from every connected client.  It's rendered once and
+		the same encoded line is queued by each of them."""
+		for client in self.clients.values():
+			if client.connected:
+				client.send(msg, priority)
+
+	def send_many(self, messages, priority=None):
+		"""Send several messages (or encoded lines) from every connected
+		client; see Client.send_many."""
+		messages = list(messages)
+		for client in self.clients.values():
+			if client.connected:
+				client.send_many(messages, priority)
+
+	def health(self):
+		"""Return a summary of every client, with totals under None."""
+		report = {}
+		totals = {'clients': 0, 'connected': 0, 'recv_queue': 0, 'send_queue': 0, 'handlers_running': 0}
+		for name, client in self.clients.items():
+			status = {
+				'connected': client.connected,
+				'recv_queue': client._rqueue.qsize(),
+				'send_queue': len(client._squeue),
+				'handlers_running': len(client._group)
+			}
+			report[name] = status
+			totals['clients'] += 1
+			for key, value in status.items():
+				totals[key] += value
+		report[None] = totals
+		return report
+
+	def shutdown(self, reason=None, timeout=5):
+		"""Shut down every client.  If reason is given, connected
+		clients first QUIT with it and get up to timeout seconds to
+		flush their send queues."""
+		self._starters.kill()
+		if reason is not None:
+			self.send(message.quit(reason))
+			deadline = time() + timeout
+			while time() < deadline and any(len(c._squeue) for c in self.clients.values() if c.connected):
+				gevent.sleep(0.1)
+		for client in self.clients.values():
+			client.shutdown()
+
+	def join(self):
+		self._starters.join()
+		for client in self.clients.values():
+			client.join()
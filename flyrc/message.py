@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-from flyrc import hostmask
+from flyrc import compat, hostmask
 
 class ProtocolViolation(Exception):
 	def __init__(self, value, position=None):
@@ -25,34 +25,175 @@ class EmptyArgument(ProtocolViolation):
 	pass
 
 def irc_split(text):
+	prefix, command, args = split_line(text)[1:]
+	return prefix, command, args
+
+def split_line(text):
+	"""Split a line into (tags, prefix, command, args) in a single pass.
+	tags is the raw IRCv3 tag string (see parse_tags) or None."""
+	tags = None
 	prefix = None
 	command = None
 	args = []
-	if text:
-		trailing = ''
-		if text[0] == ':':
-			prefix, text = text[1:].split(' ', 1)
-		if text.find(' :') != -1:
-			text, trailing = text.split(' :', 1)
-		args = text.split(' ')
-		if trailing:
-			args.append(trailing)
-		command = args.pop(0)
-	return prefix, command, args
+	if not text:
+		return tags, prefix, command, args
+
+	start = 0
+	if text[0] == '@':
+		end = text.find(' ')
+		if end == -1:
+			return text[1:], prefix, command, args
+		tags = text[1:end]
+		start = end + 1
+	if text.startswith(':', start):
+		end = text.find(' ', start)
+		if end == -1:
+			return tags, text[start+1:], '', args
+		prefix = text[start+1:end]
+		start = end + 1
+
+	end = text.find(' ', start)
+	if end == -1:
+		return tags, prefix, text[start:], args
+	command = text[start:end]
+	start = end + 1
+
+	if text.startswith(':', start):
+		trailing = text[start+1:]
+	else:
+		end = text.find(' :', start)
+		if end == -1:
+			args = text[start:].split(' ')
+			trailing = None
+		else:
+			args = text[start:end].split(' ')
+			trailing = text[end+2:]
+		if '' in args:
+			args = [x for x in args if x]
+	if trailing:
+		args.append(trailing)
+	return tags, prefix, command, args
+
+_tag_escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def _unescape_tag(value):
+	out = []
+	i = 0
+	while True:
+		j = value.find('\\', i)
+		if j == -1:
+			out.append(value[i:])
+			break
+		out.append(value[i:j])
+		if j + 1 < len(value):
+			c = value[j+1]
+			out.append(_tag_escapes.get(c, c))
+		i = j + 2
+	return ''.join(out)
+
+def parse_tags(text):
+	"""Parse a raw IRCv3 tag string (without the leading '@') into a
+	dict.  Tags without a value map to an empty string."""
+	tags = {}
+	for tag in text.split(';'):
+		if not tag:
+			continue
+		key, sep, value = tag.partition('=')
+		if '\\' in value:
+			value = _unescape_tag(value)
+		tags[key] = value
+	return tags
 
-def irc_join(prefix, command, args):
-	message = ''
+def render_tags(tags):
+	out = []
+	for key, value in tags.items():
+		if value:
+			value = value.replace('\\', '\\\\').replace(';', '\\:').replace(' ', '\\s').replace('\r', '\\r').replace('\n', '\\n')
+			out.append(key + '=' + value)
+		else:
+			out.append(key)
+	return ';'.join(out)
+
+def irc_join(prefix, command, args, tags=None):
+	parts = []
+	if tags:
+		if not isinstance(tags, compat.string_types):
+			tags = render_tags(tags)
+		parts.append('@' + tags)
 	if prefix:
-		message += ':' + str(prefix) + ' '
-	message += str(command)
+		parts.append(':' + str(prefix))
+	parts.append(str(command))
 	for arg in args:
-		if len(arg) == 0:
+		if not arg:
 			continue # shouldn't happen.
-		elif arg[0] == ':' or arg.find(' ') != -1:
-			message += ' :' + arg
+		elif arg[0] == ':' or ' ' in arg:
+			parts.append(':' + arg)
 		else:
-			message += ' ' + arg
-	return message
+			parts.append(arg)
+	return ' '.join(parts)
+
+# The longest line a server accepts, not counting the CRLF.
+MAX_LINE = 510
+# What RFC 2812 allows for the user and host parts of a prefix, assumed
+# for our own prefix until we know it.
+USERLEN = 10
+HOSTLEN = 63
+
+def utf8_length(text):
+	"""The length of text in bytes once UTF-8 encoded."""
+	if isinstance(text, compat.text_type):
+		return len(text.encode('utf-8'))
+	return len(text)
+
+def split_text(text, limit):
+	"""Split text into chunks of at most limit bytes once UTF-8 encoded,
+	breaking at a space where there's one in the second half of the
+	chunk, and never in the middle of a character.  The chunks are the
+	same type as text.  Raises ValueError if limit isn't positive."""
+	if limit < 1:
+		raise ValueError("no room for text in a %d-byte limit" % limit)
+	decode = isinstance(text, compat.text_type)
+	if decode:
+		text = text.encode('utf-8')
+	text = bytearray(text)
+	chunks = []
+	while len(text) > limit:
+		cut = text.rfind(b' ', limit // 2, limit + 1)
+		if cut != -1:
+			chunks.append(bytes(text[:cut]))
+			text = text[cut+1:]
+			continue
+		cut = limit
+		# Back up past UTF-8 continuation bytes.
+		while cut > 0 and 0x80 <= text[cut] <= 0xbf:
+			cut -= 1
+		if cut == 0:
+			cut = limit
+		chunks.append(bytes(text[:cut]))
+		text = text[cut:]
+	if text:
+		chunks.append(bytes(text))
+	if decode:
+		chunks = [chunk.decode('utf-8', 'replace') for chunk in chunks]
+	return chunks
+
+def group_targets(targets, maxtargets=None, maxlength=200):
+	"""Join targets into comma-separated lists of at most maxtargets
+	targets (None for no limit) and maxlength bytes (UTF-8 encoded)."""
+	groups = []
+	group = []
+	length = -1
+	for target in targets:
+		size = utf8_length(target)
+		if group and ((maxtargets and len(group) >= maxtargets) or length + 1 + size > maxlength):
+			groups.append(','.join(group))
+			group = []
+			length = -1
+		group.append(target)
+		length += 1 + size
+	if group:
+		groups.append(','.join(group))
+	return groups
 
 class Step():
 	NONE=0
@@ -61,20 +202,66 @@ class Step():
 	CONNECT=3
 
 class Message(object):
+	"""A message to or from the server.
+
+	The rendered line and its encoded form are cached, so a message
+	sent by several clients or seen by several handlers is only rendered
+	once.  Assigning to source, command, args or tags clears the cache;
+	changing args or tags in place doesn't, so assign new values instead.
+	"""
+	__slots__ = ('_source', '_command', '_args', '_tags', '_line', '_wire')
+
 	@classmethod
 	def parse(cls, text):
-		prefix, command, args = irc_split(text)
+		tags, prefix, command, args = split_line(text)
 		source = None
 		if prefix:
 			source = hostmask.Hostmask.parse(prefix)
-		return cls(source, command, args)
+		msg = cls.trusted(source, command, args, tags)
+		msg._line = text
+		return msg
 
-	def __init__(self, s, c, a):
+	@classmethod
+	def trusted(cls, s, c, a, tags=None):
+		"""Build a Message from parts that are already known to be well
+		formed (e.g. parsed from the server), skipping validation of
+		the arguments.  tags may be a dict or a raw tag string."""
+		msg = cls.__new__(cls)
+		msg._source = s
+		msg._command = c
+		msg._args = a
+		msg._tags = tags
+		msg._line = None
+		msg._wire = None
+		return msg
+
+	def __init__(self, s, c, a, tags=None):
+		self._line = None
+		self._wire = None
 		self._args = None
-		self.source = s
-		self.command = c
+		self._tags = tags
+		self._source = s
+		self._command = c
 		self.args = a
 
+	@property
+	def source(self):
+		return self._source
+
+	@source.setter
+	def source(self, s):
+		self._source = s
+		self._line = self._wire = None
+
+	@property
+	def command(self):
+		return self._command
+
+	@command.setter
+	def command(self, c):
+		self._command = c
+		self._line = self._wire = None
+
 	@property
 	def args(self):
 		return self._args
@@ -87,13 +274,52 @@ class Message(object):
 			if i != len(newargs)-1 and (arg[0] == ':' or arg.find(' ') != -1):
 				raise InvalidArgumentOrder(arg, i)
 		self._args = newargs
+		self._line = self._wire = None
+
+	@property
+	def tags(self):
+		"""IRCv3 message tags as a dict (parsed on first access)."""
+		tags = self._tags
+		if tags is None:
+			return {}
+		if not isinstance(tags, dict):
+			tags = self._tags = parse_tags(tags)
+		return tags
+
+	@tags.setter
+	def tags(self, newtags):
+		self._tags = newtags
+		self._line = self._wire = None
 
 	def render(self):
-		return irc_join(self.source, self.command, self.args)
+		line = self._line
+		if line is None:
+			line = self._line = irc_join(self._source, self._command, self._args, self._tags)
+		return line
+
+	def wire(self):
+		"""The message as sent: UTF-8 encoded, ending in CRLF."""
+		wire = self._wire
+		if wire is None:
+			line = self.render()
+			if isinstance(line, compat.text_type):
+				line = line.encode('utf-8', 'replace')
+			wire = self._wire = line + b'\r\n'
+		return wire
+
+	def __reduce__(self):
+		# Pickled as its parts, keeping the line it was parsed from or
+		# rendered to but not the encoded form.
+		return (_restore, (self._source, self._command, self._args, self._tags, self._line))
 
 	def __repr__(self):
 		return "<%s.%s(%s, %s, %s)>" % (type(self).__module__, type(self).__name__, repr(self.source), repr(self.command), repr(self.args))
 
+def _restore(source, command, args, tags, line):
+	msg = Message.trusted(source, command, args, tags)
+	msg._line = line
+	return msg
+
 class Error(object):
 	def __init__(self, e, step=Step.NONE):
 		self.e = e
@@ -102,6 +328,40 @@ class Error(object):
 	def __repr__(self):
 		return "<%s.%s(%s)>" % (type(self).__module__, type(self).__name__, self.e.__repr__)
 
+class Batch(object):
+	"""An IRCv3 batch from the server: the lines tagged with its
+	reference between BATCH +ref and BATCH -ref.
+
+	Attributes:
+		ref - the reference tag.
+		type - the batch type, e.g. 'netsplit'.
+		params - any further arguments to BATCH +ref.
+		start - the BATCH +ref message.
+		messages - the batched Messages in order, with any batch nested
+			in this one as a Batch in its place.
+		parent - the Batch this one is nested in, or None.
+		opened - when the client started collecting it (time.time()).
+	"""
+	__slots__ = ('ref', 'type', 'params', 'start', 'messages', 'parent', 'opened')
+
+	def __init__(self, ref, type, params, start=None, parent=None):
+		self.ref = ref
+		self.type = type
+		self.params = params
+		self.start = start
+		self.messages = []
+		self.parent = parent
+		self.opened = None
+
+	def __len__(self):
+		return len(self.messages)
+
+	def __iter__(self):
+		return iter(self.messages)
+
+	def __repr__(self):
+		return "<%s.%s(%s, %s, %d messages)>" % (type(self).__module__, type(self).__name__, repr(self.ref), repr(self.type), len(self.messages))
+
 def _gen_func(name, command):
 	globals()[name] = lambda *args: Message(None, command, list(args))
 
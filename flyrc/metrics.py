@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+from bisect import bisect_left
+from flyrc import compat
+
+# Upper bounds (in seconds) of the default histogram buckets.
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+class Counter(object):
+	__slots__ = ('value',)
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, n=1):
+		self.value += n
+
+	def collect(self):
+		return self.value
+
+class Gauge(object):
+	"""A value that can go up and down.  If func is given, the gauge
+	reads its value from func() whenever it's collected, which costs
+	nothing until then."""
+	__slots__ = ('value', 'func')
+
+	def __init__(self, func=None):
+		self.value = 0
+		self.func = func
+
+	def set(self, value):
+		self.value = value
+
+	def collect(self):
+		if self.func:
+			return self.func()
+		return self.value
+
+class Histogram(object):
+	__slots__ = ('bounds', 'counts', 'sum')
+
+	def __init__(self, bounds=DEFAULT_BUCKETS):
+		self.bounds = bounds
+		# One slot per bucket plus one for +Inf, not cumulative; the
+		# total count is worked out when collected.
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0
+
+	@property
+	def count(self):
+		return sum(self.counts)
+
+	def observe(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.sum += value
+
+	def collect(self):
+		buckets = []
+		total = 0
+		for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+			total += count
+			buckets.append((bound, total))
+		return {'count': total, 'sum': self.sum, 'buckets': buckets}
+
+class Registry(object):
+	"""A named collection of metrics.
+
+	Metrics are created (or fetched, if they already exist) through
+	counter, gauge and histogram.  Keyword arguments become labels; each
+	distinct set of labels is a separate metric under the same name.
+	Look metrics up once and keep them, rather than on every update.
+	"""
+	def __init__(self, prefix='flyrc_'):
+		self.prefix = prefix
+		# name -> [type, help, {labels: metric}]
+		self._metrics = {}
+
+	def _get(self, kind, name, help, labels, factory):
+		family = self._metrics.get(name)
+		if family is None:
+			family = self._metrics[name] = [kind, help, {}]
+		elif family[0] != kind:
+			raise ValueError("%s is already registered as a %s" % (name, family[0]))
+		key = tuple(sorted(labels.items()))
+		metric = family[2].get(key)
+		if metric is None:
+			metric = family[2][key] = factory()
+		return metric
+
+	def counter(self, name, help='', **labels):
+		return self._get('counter', name, help, labels, Counter)
+
+	def gauge(self, name, help='', func=None, **labels):
+		return self._get('gauge', name, help, labels, lambda: Gauge(func))
+
+	def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+		return self._get('histogram', name, help, labels, lambda: Histogram(buckets))
+
+	def collect(self):
+		"""Return {name: value} for unlabelled metrics, or {name: {labels:
+		value}} for labelled ones, where labels is a tuple of (label,
+		value) pairs.  Histogram values are dicts of count, sum and
+		cumulative buckets."""
+		out = {}
+		for name, (kind, help, metrics) in self._metrics.items():
+			if list(metrics) == [()]:
+				out[name] = metrics[()].collect()
+			else:
+				out[name] = dict((labels, m.collect()) for labels, m in metrics.items())
+		return out
+
+	def render(self):
+		"""Render every metric in the Prometheus text exposition format."""
+		return render({None: self})
+
+def render(registries):
+	"""Render a dict of name -> Registry in the Prometheus text format,
+	labelling each registry's samples with client=name (unless name is
+	None)."""
+	families = {}
+	for client, registry in registries.items():
+		for name, family in registry._metrics.items():
+			families.setdefault(registry.prefix + name, []).append((client, family))
+
+	lines = []
+	for full in sorted(families):
+		kind, help = families[full][0][1][:2]
+		if help:
+			lines.append('# HELP %s %s' % (full, help.replace('\\', '\\\\').replace('\n', '\\n')))
+		lines.append('# TYPE %s %s' % (full, kind))
+		for client, (kind, help, metrics) in sorted(families[full], key=lambda f: f[0]):
+			for labels, metric in sorted(metrics.items()):
+				labels = list(labels)
+				if client is not None:
+					labels.append(('client', client))
+				value = metric.collect()
+				if kind == 'histogram':
+					for bound, count in value['buckets']:
+						lines.append(_sample(full + '_bucket', labels + [('le', _number(bound))], count))
+					lines.append(_sample(full + '_sum', labels, value['sum']))
+					lines.append(_sample(full + '_count', labels, value['count']))
+				else:
+					lines.append(_sample(full, labels, value))
+	return '\n'.join(lines) + '\n'
+
+def _number(value):
+	if value == float('inf'):
+		return '+Inf'
+	elif isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+def _sample(name, labels, value):
+	if labels:
+		pairs = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+		name += '{' + pairs + '}'
+	return '%s %s' % (name, _number(value))
+
+def serve(registries, port, host='127.0.0.1'):
+	"""Serve metrics over HTTP in the Prometheus text format, returning
+	the (started) gevent WSGI server.  registries is either a single
+	Registry or a dict of name -> Registry, in which case each one's
+	samples are labelled with client=name."""
+	from gevent.pywsgi import WSGIServer
+
+	def app(environ, start_response):
+		if isinstance(registries, Registry):
+			body = registries.render()
+		else:
+			body = render(registries)
+		if isinstance(body, compat.text_type):
+			body = body.encode('utf-8')
+		start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+		return [body]
+
+	server = WSGIServer((host, port), app, log=None)
+	server.start()
+	return server
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+# Running CPU-bound handler functions (see util.cpu_bound) in worker
+# processes, so they don't hold up the client's event loop.
+#
+# The handler function is pickled with its handler object and sent to a
+# worker along with the event's arguments (Messages and Hostmasks pickle
+# as their parts) and a snapshot of the client's state.  There it's
+# called with a ClientProxy in place of the client, and whatever it
+# sends through the proxy is passed back and sent by the real client.
+# Changes the function makes to its handler object or the proxy stay in
+# the worker.
+
+import multiprocessing
+import traceback
+from flyrc import compat, util
+
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+if compat.PY3:
+	def _dumps(obj):
+		return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+else:
+	# Python 2 can't pickle bound methods; pickle them as the object
+	# and the method's name, as Python 3 does.  This takes a Pickler
+	# with a dispatch table of its own (so the pure Python one), as
+	# registering them with copy_reg would change pickling for the
+	# whole process.
+	import pickle as _pypickle
+	import types
+	from cStringIO import StringIO
+
+	class _Pickler(_pypickle.Pickler):
+		dispatch = dict(_pypickle.Pickler.dispatch)
+
+		def save_method(self, method):
+			owner = method.__self__
+			if owner is None:
+				owner = method.im_class
+			self.save_reduce(getattr, (owner, method.__func__.__name__), obj=method)
+
+		dispatch[types.MethodType] = save_method
+
+	def _dumps(obj):
+		out = StringIO()
+		_Pickler(out, pickle.HIGHEST_PROTOCOL).dump(obj)
+		return out.getvalue()
+
+class OffloadError(Exception):
+	"""A handler function run in a worker process raised an exception.
+
+	Attributes:
+		func - the handler function.
+		details - the traceback from the worker, as text.
+	"""
+	def __init__(self, func, details):
+		self.func = func
+		self.details = details
+
+	def __str__(self):
+		return "%s failed in a worker process:\n%s" % (util.handler_name(self.func), self.details)
+
+class OffloadTimeout(OffloadError):
+	"""A handler function run in a worker process didn't finish in
+	time.  It keeps its worker until it does, and what it sends is
+	dropped.
+
+	Attributes:
+		func - the handler function.
+		timeout - how long it was given, in seconds.
+	"""
+	def __init__(self, func, timeout):
+		self.func = func
+		self.timeout = timeout
+		self.details = None
+
+	def __str__(self):
+		return "%s didn't finish within %ss" % (util.handler_name(self.func), self.timeout)
+
+class ClientProxy(object):
+	"""What a handler function running in a worker gets instead of the
+	client: a snapshot of its nick, hostmask, chantypes and isupport,
+	and send, send_many and say, which are recorded and replayed on the
+	real client once the function returns."""
+	def __init__(self, snapshot):
+		self.nick = snapshot.get('nick')
+		self.hostmask = snapshot.get('hostmask')
+		self.chantypes = snapshot.get('chantypes', util.DEFAULT_CHANTYPES)
+		self.isupport = snapshot.get('isupport') or {}
+		self.casefold = util.casefolder(self.isupport.get('CASEMAPPING', 'rfc1459'))
+		self.calls = []
+
+	def is_me(self, nick):
+		return self.nick is not None and self.casefold(nick) == self.casefold(self.nick)
+
+	def send(self, message, priority=None):
+		self.calls.append(('send', (message, priority), {}))
+
+	def send_many(self, messages, priority=None):
+		self.calls.append(('send_many', (list(messages), priority), {}))
+
+	def say(self, targets, text, command='PRIVMSG', priority=None):
+		if not isinstance(targets, compat.string_types):
+			targets = list(targets)
+		self.calls.append(('say', (targets, text, command, priority), {}))
+
+def _run(payload):
+	# Runs in the worker.  The call arrives and its results leave pickled
+	# by hand, so failing to unpickle or pickle them comes back as text
+	# like any other failure, rather than losing the call (Python 2's
+	# Pool has no error_callback to report it through).
+	try:
+		func, snapshot, args, kwargs = pickle.loads(payload)
+		proxy = ClientProxy(snapshot)
+		func(proxy, *args, **kwargs)
+		return pickle.dumps(proxy.calls, pickle.HIGHEST_PROTOCOL), None
+	except Exception:
+		return None, traceback.format_exc()
+
+class ProcessPool(object):
+	"""A pool of size worker processes (by default one per CPU) running
+	offloaded handler functions, each given at most timeout seconds
+	(None for no limit).
+
+	The pool forks its workers when it's created, so create it before
+	connecting (and loading anything large) and hand it to clients by
+	setting client.offload.  Several clients can share one pool.  A
+	client that has none when a cpu_bound handler is added to it uses
+	shared().
+	"""
+	def __init__(self, size=None, timeout=30, maxtasksperchild=None):
+		self.size = size or multiprocessing.cpu_count()
+		self.timeout = timeout
+		self.submitted = 0
+		# Calls that have come back, whether they succeeded or not;
+		# only ever changed from the pool's result thread.
+		self.finished = 0
+		self._pool = multiprocessing.Pool(self.size, maxtasksperchild=maxtasksperchild)
+
+	@property
+	def pending(self):
+		"""Calls waiting for or running in a worker, including ones
+		that have timed out but not finished."""
+		return self.submitted - self.finished
+
+	def submit(self, func, snapshot, args, kwargs, callback):
+		"""Run func(proxy, *args, **kwargs) in a worker.  callback is
+		called from another thread with (calls, None) once it returns,
+		or (None, details) if it fails, and must not raise.  Raises
+		straight away if the call can't be pickled."""
+		payload = _dumps((func, snapshot, args, kwargs))
+
+		def done(result):
+			data, details = result
+			outcome = (None, details)
+			if data is not None:
+				try:
+					outcome = (pickle.loads(data), None)
+				except Exception:
+					outcome = (None, traceback.format_exc())
+			self.finished += 1
+			callback(outcome)
+
+		options = {}
+		if compat.PY3:
+			options['error_callback'] = lambda e: done((None, "%s: %s" % (type(e).__name__, e)))
+		self.submitted += 1
+		return self._pool.apply_async(_run, (payload,), callback=done, **options)
+
+	def close(self):
+		"""Stop taking calls and wait for the running ones to finish."""
+		self._pool.close()
+		self._pool.join()
+
+	def terminate(self):
+		"""Stop the workers straight away."""
+		self._pool.terminate()
+		self._pool.join()
+
+_shared = None
+
+def shared():
+	"""The pool clients without one of their own use, created with the
+	default settings when the first cpu_bound handler is added."""
+	global _shared
+	if _shared is None:
+		_shared = ProcessPool()
+	return _shared
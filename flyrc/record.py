@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+# Traffic recording and replay.
+#
+# A recording is a text file with one line per IRC line sent or received:
+#   <unix time> <direction> <raw line>
+# where direction is '<' for lines received and '>' for lines sent, e.g.
+#   1700000000.123 < :irc.example.net 001 flyrcbot :Welcome
+# Recordings are only ever appended to, so one file can hold several
+# sessions.
+
+import errno
+import mmap
+import os
+import gevent
+import gevent.event
+from gevent import socket
+from time import time
+
+RECV = b'<'
+SENT = b'>'
+
+class Recorder(object):
+	"""Appends the lines a client sends and receives to a recording.
+	Set it as client.recorder to start recording.
+
+	Writes go through a buffer of bufsize bytes, so call flush() (or
+	close()) to be sure everything has reached the file.
+
+	Attributes:
+		path - the recording's file name.
+		lines - number of lines recorded.
+	"""
+	def __init__(self, path, bufsize=1 << 16, clock=time):
+		self.path = path
+		self.lines = 0
+		self._file = open(path, 'ab', bufsize)
+		self._clock = clock
+
+	def received(self, lines):
+		"""Record encoded lines (without line endings) as just received."""
+		if lines:
+			prefix = self._prefix(RECV)
+			self._file.write(prefix + (b'\n' + prefix).join(lines) + b'\n')
+			self.lines += len(lines)
+
+	def sent(self, line):
+		"""Record an encoded line, ending in CRLF, as just sent."""
+		self._file.write(self._prefix(SENT) + line.rstrip(b'\r\n') + b'\n')
+		self.lines += 1
+
+	def _prefix(self, direction):
+		return ('%.3f ' % self._clock()).encode('ascii') + direction + b' '
+
+	def flush(self):
+		self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+class Recording(object):
+	"""A recording read through a memory map, so it never has to fit in
+	memory however large it is."""
+	def __init__(self, path):
+		self.path = path
+		self._file = open(path, 'rb')
+		self.size = os.fstat(self._file.fileno()).st_size
+		self._map = None
+		if self.size:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __iter__(self):
+		"""Yield (timestamp, direction, line) for every line recorded."""
+		data = self._map
+		if data is None:
+			return
+		find = data.find
+		size = self.size
+		pos = 0
+		while pos < size:
+			end = find(b'\n', pos)
+			if end == -1:
+				end = size
+			record = data[pos:end]
+			pos = end + 1
+			parts = record.split(b' ', 2)
+			if len(parts) == 3:
+				yield float(parts[0]), parts[1], parts[2]
+
+	def received(self):
+		"""Yield (timestamp, line) for every line received."""
+		for stamp, direction, line in self:
+			if direction == RECV:
+				yield stamp, line
+
+	def close(self):
+		if self._map is not None:
+			self._map.close()
+		self._file.close()
+
+class ReplaySocket(object):
+	"""A stand-in for a client's socket that plays back the lines received
+	in a recording and throws away whatever the client sends.
+
+	speed is how fast to play: None for as fast as the client can take
+	it, 1 for the pace the lines were recorded at, 2 for twice that, and
+	so on.  Once the recording is exhausted, reads return no data, which
+	the client takes as the server closing the connection, or if hold is
+	set, block until the socket is closed, leaving the client connected.
+
+	Attributes:
+		finished - a gevent Event set once the recording is exhausted.
+		lines - number of lines played back so far.
+		sent - number of bytes the client has sent.
+	"""
+	def __init__(self, recording, speed=None, hold=False):
+		self.finished = gevent.event.Event()
+		self.hold = hold
+		self.lines = 0
+		self.sent = 0
+		self._speed = speed
+		self._recording = recording
+		self._records = recording.received()
+		self._pending = b''
+		self._next = None
+		# Wall clock time at which the first line was played, and the
+		# first line's timestamp.
+		self._start = None
+		self._first = None
+		self._closed = False
+		self._closing = gevent.event.Event()
+
+	def _due(self, stamp):
+		# Seconds until the line stamped stamp should be played.
+		if self._start is None:
+			self._start = time()
+			self._first = stamp
+		return self._start + (stamp - self._first) / self._speed - time()
+
+	def _fill(self, size):
+		chunk = [self._pending]
+		length = len(self._pending)
+		while length < size:
+			record = self._next
+			if record is None:
+				record = next(self._records, None)
+				if record is None:
+					break
+			self._next = None
+			if self._speed:
+				wait = self._due(record[0])
+				if wait > 0:
+					if length:
+						# Hand over what's ready before waiting.
+						self._next = record
+						break
+					# Woken early by close, which unmaps the recording.
+					if self._closing.wait(wait):
+						raise socket.error(errno.EBADF, 'Bad file descriptor')
+			line = record[1] + b'\r\n'
+			chunk.append(line)
+			length += len(line)
+			self.lines += 1
+		data = b''.join(chunk)
+		self._pending = data[size:]
+		return data[:size]
+
+	def recv_into(self, buf):
+		if self._closed:
+			raise socket.error(errno.EBADF, 'Bad file descriptor')
+		data = self._fill(len(buf))
+		if not data:
+			self.finished.set()
+			if self.hold:
+				self._closing.wait()
+				raise socket.error(errno.EBADF, 'Bad file descriptor')
+			return 0
+		buf[:len(data)] = data
+		return len(data)
+
+	def recv(self, size):
+		buf = bytearray(size)
+		return bytes(buf[:self.recv_into(buf)])
+
+	def send(self, data):
+		if self._closed:
+			raise socket.error(errno.EBADF, 'Bad file descriptor')
+		self.sent += len(data)
+		return len(data)
+
+	def sendall(self, data):
+		self.send(data)
+
+	def setblocking(self, flag):
+		pass
+
+	def settimeout(self, timeout):
+		pass
+
+	def close(self):
+		if not self._closed:
+			self._closed = True
+			self._closing.set()
+			self._recording.close()
+
+def replay(client, path, speed=None, hold=False):
+	"""Make client play back the recording at path the next time it
+	starts, instead of connecting to its server.  Returns the
+	ReplaySocket it will use (see there for speed and hold)."""
+	sock = ReplaySocket(Recording(path), speed, hold)
+	client._create_socket = lambda: sock
+	return sock
@@ -0,0 +1,521 @@
+#!/usr/bin/python
+
+# Running a fleet of clients over several processes.  A Supervisor splits
+# the client configs between worker processes ("shards"), each with a
+# gevent hub and a manager.ClientManager of its own, and restarts any
+# that die.  Workers and controllers talk to the supervisor over a local
+# TCP socket, one JSON object per line.  The first line from either must
+# carry the supervisor's secret, which workers get through the
+# FLYRC_SHARD_SECRET environment variable:
+#
+#	worker -> supervisor: {"op": "worker", "shard": 0, "pid": 123, "secret": ...}
+#	                      {"op": "event", "client": name, "event": "PRIVMSG", "args": [...]}
+#	supervisor -> worker: {"op": "assign", "factory": ..., "clients": {name: config}, ...}
+#	                      {"op": "send", "line": ..., "priority": ..., "client": name}
+#	                      {"op": "subscribe", "events": [pattern, ...]}
+#	                      {"op": "stop", "reason": ..., "timeout": 5}
+#	controller -> supervisor: {"op": "hello", "secret": ...}
+#	                          {"op": "send", ...}, {"op": "subscribe", ...}, {"op": "status"}
+#	supervisor -> controller: events, {"op": "status", "shards": [...]}, {"op": "error", "error": ...}
+#
+#	supervisor = shard.Supervisor(configs, shards=4, address=('127.0.0.1', 6700))
+#	util.run_client(supervisor)
+#	controller = shard.Controller(supervisor.address, supervisor.secret)
+#
+# Workers are started as "python -m flyrc.shard HOST PORT SHARD".
+
+import hmac
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+from time import time
+import gevent
+import gevent.event
+import gevent.pool
+import gevent.subprocess
+from gevent import queue, socket
+from gevent.server import StreamServer
+from flyrc import client, compat, manager, message, util
+
+def simple_client(config):
+	"""The default client factory: a client.SimpleClient taking its
+	arguments from config, with the handlers named in config['handlers']
+	('module:Class' strings) added."""
+	config = dict(config)
+	config.pop('name', None)
+	handlers = config.pop('handlers', ())
+	cli = client.SimpleClient(**config)
+	cli.add_handlers([_import(path)() for path in handlers])
+	return cli
+
+def _import(path):
+	module, _, name = path.partition(':')
+	__import__(module)
+	return getattr(sys.modules[module], name)
+
+def _native(obj):
+	# Strings decoded from JSON as native strs.
+	if isinstance(obj, dict):
+		return dict((_native(k), _native(v)) for k, v in obj.items())
+	if isinstance(obj, list):
+		return [_native(x) for x in obj]
+	if isinstance(obj, compat.text_type):
+		return compat.native_str(obj)
+	return obj
+
+def _jsonable(value):
+	# Event arguments as JSON: messages as their lines, batches as lists
+	# of them, and anything else unfamiliar (e.g. a Hostmask) as a str.
+	if isinstance(value, bytes):
+		return value.decode('utf-8', 'replace')
+	if isinstance(value, message.Message):
+		return _jsonable(value.render())
+	if isinstance(value, message.Error):
+		return {'error': _jsonable(str(value.e)), 'step': value.step}
+	if isinstance(value, (message.Batch, list, tuple)):
+		return [_jsonable(x) for x in value]
+	if isinstance(value, dict):
+		return dict((_jsonable(k), _jsonable(v)) for k, v in value.items())
+	if value is None or isinstance(value, (bool, int, float) + compat.string_types):
+		return value
+	return _jsonable(str(value))
+
+def _matcher(patterns):
+	# (exact event names, prefixes) for util.subscribe patterns.
+	names = set()
+	prefixes = []
+	for pattern in patterns:
+		exact, prefix = util.expand_pattern(pattern)
+		names.update(exact)
+		if prefix is not None:
+			prefixes.append(prefix)
+	return names, tuple(prefixes)
+
+def _matches(matcher, event):
+	names, prefixes = matcher
+	return event in names or any(event.startswith(prefix) for prefix in prefixes)
+
+class _Link(object):
+	"""A connection carrying one JSON object per line.  Objects are
+	written by a greenlet of its own, so put never blocks."""
+	def __init__(self, sock):
+		self.sock = sock
+		self._out = queue.Queue()
+		self._writer = gevent.spawn(self._write_loop)
+
+	def put(self, obj):
+		self._out.put((json.dumps(obj, separators=(',', ':')) + '\n').encode('utf-8'))
+
+	def __iter__(self):
+		f = self.sock.makefile('rb')
+		while True:
+			try:
+				line = f.readline()
+			except socket.error:
+				return
+			if not line:
+				return
+			try:
+				obj = _native(json.loads(line.decode('utf-8')))
+			except ValueError:
+				continue
+			if isinstance(obj, dict):
+				yield obj
+
+	def _write_loop(self):
+		while True:
+			data = self._out.get()
+			if data is None:
+				break
+			try:
+				self.sock.sendall(data)
+			except socket.error:
+				break
+		self.sock.close()
+
+	def close(self, timeout=None):
+		"""Close the connection once everything put has been written,
+		waiting up to timeout seconds for that."""
+		self._out.put(None)
+		self._writer.join(timeout)
+
+class _Shard(object):
+	__slots__ = ('index', 'clients', 'process', 'link', 'restarts', 'started')
+
+	def __init__(self, index):
+		self.index = index
+		self.clients = {}
+		self.process = None
+		self.link = None
+		self.restarts = 0
+		self.started = None
+
+class Supervisor(object):
+	"""Runs clients spread over worker processes, restarting workers
+	that die, and relays between them and Controllers.
+
+	It offers the same start, send, shutdown and join methods as a
+	client, so util.run_client works on a supervisor too (sending
+	broadcasts to every client).
+
+	Each config is a dict handed to factory in a worker to build a
+	client; factory is a 'module:function' path, importable by the
+	workers (they're started with the supervisor's sys.path).  A
+	config's 'name' (by default host:port#index) is how controllers
+	refer to its client.
+
+	Attributes:
+		configs - name -> config.
+		shards - the number of worker processes (one per CPU by default).
+		address - (host, port) to listen on for workers and controllers;
+			port 0 picks a free port, filled in by start.
+		secret - what workers and controllers must present to connect;
+			random unless given.  Pass it to Controller.
+		stagger - seconds between consecutive connects, across shards.
+		restart_delay - seconds before restarting a worker that exited,
+			doubled every time it dies within a minute of starting, up
+			to max_restart_delay.
+	"""
+	def __init__(self, configs, factory='flyrc.shard:simple_client', shards=None, address=('127.0.0.1', 0), stagger=0.5, secret=None):
+		self.factory = factory
+		self.shards = shards or multiprocessing.cpu_count()
+		self.address = address
+		self.secret = secret or '%032x' % random.SystemRandom().getrandbits(128)
+		self.stagger = stagger
+		self.restart_delay = 1
+		self.max_restart_delay = 60
+
+		self.configs = {}
+		self._shards = [_Shard(i) for i in range(self.shards)]
+		# Client name -> the _Shard running it.
+		self._placement = {}
+		for i, config in enumerate(configs):
+			name = config.get('name') or "%s:%s#%d" % (config.get('host'), config.get('port'), i)
+			shard = self._shards[i % self.shards]
+			self.configs[name] = shard.clients[name] = config
+			self._placement[name] = shard
+
+		# Controller link -> (its patterns, their matcher).
+		self._controllers = {}
+		# The patterns workers forward events for: every controller's.
+		self._events = []
+		self._monitors = gevent.pool.Group()
+		self._server = None
+		self._stopping = False
+
+	def start(self):
+		self._stopping = False
+		self._server = StreamServer(self.address, self._serve)
+		self._server.start()
+		self.address = (self.address[0], self._server.server_port)
+		for shard in self._shards:
+			self._monitors.spawn(self._monitor, shard)
+
+	def _monitor(self, shard):
+		delay = self.restart_delay
+		env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path), FLYRC_SHARD_SECRET=self.secret)
+		while not self._stopping:
+			shard.started = time()
+			shard.process = gevent.subprocess.Popen([sys.executable, '-m', 'flyrc.shard', self.address[0], str(self.address[1]), str(shard.index)], env=env)
+			shard.process.wait()
+			if self._stopping:
+				break
+			shard.restarts += 1
+			if time() - shard.started >= 60:
+				delay = self.restart_delay
+			gevent.sleep(delay)
+			delay = min(delay * 2, self.max_restart_delay)
+
+	def _serve(self, sock, addr):
+		link = _Link(sock)
+		requests = iter(link)
+		for request in requests:
+			secret = request.get('secret')
+			if not isinstance(secret, str) or not hmac.compare_digest(secret, self.secret):
+				link.put({'op': 'error', 'error': "bad secret"})
+			elif request.get('op') == 'worker':
+				index = request.get('shard')
+				if type(index) is not int or not 0 <= index < self.shards:
+					link.put({'op': 'error', 'error': "no shard %s" % index})
+				elif self._shards[index].link is not None:
+					link.put({'op': 'error', 'error': "shard %d already has a worker" % index})
+				else:
+					self._serve_worker(link, requests, self._shards[index])
+			elif request.get('op') == 'hello':
+				self._serve_controller(link, requests)
+			else:
+				link.put({'op': 'error', 'error': "expected hello"})
+			break
+		link.close(1)
+
+	def _serve_worker(self, link, requests, shard):
+		shard.link = link
+		link.put({
+			'op': 'assign',
+			'factory': self.factory,
+			'clients': shard.clients,
+			'events': self._events,
+			'stagger': self.stagger * self.shards,
+			# Shards start one stagger apart, the first time round.
+			'delay': self.stagger * shard.index if not shard.restarts else 0
+		})
+		try:
+			for request in requests:
+				if request.get('op') == 'event':
+					self._publish(request)
+		finally:
+			if shard.link is link:
+				shard.link = None
+
+	def _serve_controller(self, link, requests):
+		self._controllers[link] = ((), (set(), ()))
+		try:
+			for request in requests:
+				self._control(link, request)
+		finally:
+			del self._controllers[link]
+			self._update_events()
+
+	def _control(self, link, request):
+		op = request.get('op')
+		if op == 'send':
+			name = request.get('client')
+			try:
+				sent = self.send(request.get('line', ''), request.get('priority'), name)
+			except KeyError:
+				link.put({'op': 'error', 'error': "unknown client %s" % name})
+			else:
+				if not sent:
+					link.put({'op': 'error', 'error': "no shard running %s is up" % (name or 'any client')})
+		elif op == 'subscribe':
+			patterns = tuple(request.get('events') or ())
+			self._controllers[link] = (patterns, _matcher(patterns))
+			self._update_events()
+		elif op == 'status':
+			link.put({'op': 'status', 'shards': self.status()})
+		else:
+			link.put({'op': 'error', 'error': "unknown op %s" % op})
+
+	def _update_events(self):
+		events = sorted(set(p for patterns, matcher in self._controllers.values() for p in patterns))
+		if events != self._events:
+			self._events = events
+			for shard in self._shards:
+				if shard.link is not None:
+					shard.link.put({'op': 'subscribe', 'events': events})
+
+	def _publish(self, event):
+		name = event.get('event', '')
+		for link, (patterns, matcher) in list(self._controllers.items()):
+			if _matches(matcher, name):
+				link.put(event)
+
+	def send(self, msg, priority=None, client=None):
+		"""Send msg (a Message or a line) from the named client, or from
+		every client.  Returns how many shards it was passed to: 0 if
+		they're down (being restarted).  Raises KeyError for an unknown
+		client."""
+		if isinstance(msg, message.Message):
+			msg = msg.render()
+		request = {'op': 'send', 'line': _jsonable(msg), 'priority': priority}
+		if client is None:
+			shards = self._shards
+		else:
+			shards = [self._placement[client]]
+			request['client'] = client
+		sent = 0
+		for shard in shards:
+			if shard.link is not None:
+				shard.link.put(request)
+				sent += 1
+		return sent
+
+	def status(self):
+		"""Return a summary of every shard: its index, pid, whether it's
+		up, how often it's been restarted and its clients' names."""
+		report = []
+		for shard in self._shards:
+			report.append({
+				'shard': shard.index,
+				'pid': shard.process.pid if shard.process is not None else None,
+				'up': shard.link is not None,
+				'restarts': shard.restarts,
+				'clients': sorted(shard.clients)
+			})
+		return report
+
+	def shutdown(self, reason=None, timeout=5):
+		"""Shut down every worker and stop listening.  If reason is
+		given, connected clients first QUIT with it and get up to
+		timeout seconds to flush their send queues; workers still
+		running a second after that are killed."""
+		self._stopping = True
+		for shard in self._shards:
+			if shard.link is not None:
+				shard.link.put({'op': 'stop', 'reason': reason, 'timeout': timeout})
+		deadline = time() + timeout + 1
+		processes = [shard.process for shard in self._shards if shard.process is not None]
+		while time() < deadline and any(p.poll() is None for p in processes):
+			gevent.sleep(0.1)
+		for p in processes:
+			if p.poll() is None:
+				p.kill()
+		if self._server is not None:
+			self._server.stop()
+			self._server = None
+		for link in list(self._controllers):
+			link.close(1)
+
+	def join(self):
+		self._monitors.join()
+
+class Controller(object):
+	"""A connection to a Supervisor, for sending from its clients and
+	receiving their events.
+
+	Attributes:
+		address - the supervisor's (host, port).
+	"""
+	def __init__(self, address, secret):
+		self.address = address
+		self._link = _Link(socket.create_connection(address))
+		self._link.put({'op': 'hello', 'secret': secret})
+		self._received = queue.Queue()
+		self._status = None
+		self._reader = gevent.spawn(self._read_loop)
+
+	def _read_loop(self):
+		for msg in self._link:
+			if msg.get('op') == 'status' and self._status is not None:
+				self._status.set(msg['shards'])
+			else:
+				self._received.put(msg)
+		# The supervisor has gone.
+		self._received.put(None)
+
+	def subscribe(self, *patterns):
+		"""Receive the events matching patterns (as for util.subscribe)
+		from every client, in place of any subscribed to before."""
+		self._link.put({'op': 'subscribe', 'events': list(patterns)})
+
+	def send(self, msg, priority=None, client=None):
+		"""Send msg (a Message or a line) from the named client, or from
+		every client.  Failures come back through get."""
+		if isinstance(msg, message.Message):
+			msg = msg.render()
+		self._link.put({'op': 'send', 'line': _jsonable(msg), 'priority': priority, 'client': client})
+
+	def status(self, timeout=5):
+		"""The supervisor's status (see Supervisor.status)."""
+		self._status = gevent.event.AsyncResult()
+		self._link.put({'op': 'status'})
+		try:
+			return self._status.get(timeout=timeout)
+		finally:
+			self._status = None
+
+	def get(self, timeout=None):
+		"""The next event ({'client', 'event', 'args'}) or error
+		({'op': 'error', 'error'}) from the supervisor, or None once
+		it's gone.  Raises gevent.queue.Empty on timeout."""
+		return self._received.get(timeout=timeout)
+
+	def close(self):
+		self._link.close(1)
+
+# Forwarder classes by the patterns they subscribe to.  Patterns are read
+# from a handler's class (see util.handler_class), so each set of them
+# needs a class of its own.
+_forwarders = {}
+
+class _Forwarder(object):
+	def __init__(self, link, name):
+		self.link = link
+		self.name = name
+
+def _forwarder_class(patterns):
+	cls = _forwarders.get(patterns)
+	if cls is None:
+		@util.inline
+		@util.subscribe(*patterns)
+		def forward(self, client, event, *args):
+			self.link.put({'op': 'event', 'client': self.name, 'event': event, 'args': [_jsonable(arg) for arg in args]})
+		cls = _forwarders[patterns] = type('Forwarder', (_Forwarder,), {'forward': forward})
+	return cls
+
+class _Worker(object):
+	"""A shard's clients, as assigned by the supervisor."""
+	def __init__(self, link, assignment):
+		self.link = link
+		factory = _import(assignment['factory'])
+		self.manager = manager.ClientManager(assignment['stagger'])
+		for name, config in sorted(assignment['clients'].items()):
+			self.manager.add(factory(config), name)
+		self.forwarders = {}
+		self.subscribe(assignment['events'])
+		self._starter = gevent.spawn_later(assignment['delay'], self.manager.start)
+
+	def subscribe(self, patterns):
+		cls = None
+		if patterns:
+			cls = _forwarder_class(tuple(patterns))
+		for name, cli in self.manager.clients.items():
+			old = self.forwarders.pop(name, None)
+			if old is not None:
+				cli.remove_handler(old)
+			if cls is not None:
+				self.forwarders[name] = cls(self.link, name)
+				cli.add_handler(self.forwarders[name])
+
+	def send(self, line, priority=None, name=None):
+		msg = message.Message.parse(line)
+		if name is None:
+			self.manager.send(msg, priority)
+		elif name in self.manager.clients:
+			self.manager.clients[name].send(msg, priority)
+
+	def stop(self, reason=None, timeout=5):
+		self._starter.kill()
+		self.manager.shutdown(reason, timeout)
+
+def run_worker(host, port, index):
+	"""Run shard index of the supervisor at host:port until it says to
+	stop or goes away."""
+	# Ctrl-C reaches the whole process group; the supervisor decides
+	# what happens.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	link = _Link(socket.create_connection((host, port)))
+	link.put({'op': 'worker', 'shard': index, 'pid': os.getpid(), 'secret': os.environ.get('FLYRC_SHARD_SECRET', '')})
+	worker = None
+	reason = None
+	timeout = 0
+	for request in link:
+		op = request.get('op')
+		if op == 'assign':
+			worker = _Worker(link, request)
+		elif worker is None:
+			continue
+		elif op == 'send':
+			worker.send(request['line'], request.get('priority'), request.get('client'))
+		elif op == 'subscribe':
+			worker.subscribe(request['events'])
+		elif op == 'stop':
+			reason = request.get('reason')
+			timeout = request.get('timeout', 5)
+			break
+	if worker is not None:
+		worker.stop(reason, timeout)
+	link.close(1)
+
+def main(argv):
+	if len(argv) != 4:
+		sys.stderr.write("usage: python -m flyrc.shard HOST PORT SHARD\n")
+		return 2
+	run_worker(argv[1], int(argv[2]), int(argv[3]))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+from collections import deque
+from time import time
+from flyrc.cache import LRUCache
+
+class Priority():
+	CRITICAL=0
+	INTERACTIVE=1
+	BULK=2
+
+# Commands that keep the connection registered and alive.  These are sent
+# at CRITICAL priority unless the sender asks otherwise.
+CRITICAL_COMMANDS = frozenset([
+	'PING',
+	'PONG',
+	'QUIT',
+	'PASS',
+	'NICK',
+	'USER',
+	'CAP',
+	'AUTHENTICATE'
+])
+
+def default_priority(command):
+	if command.upper() in CRITICAL_COMMANDS:
+		return Priority.CRITICAL
+	return Priority.INTERACTIVE
+
+class TokenBucket(object):
+	"""A bucket holding up to capacity tokens, refilled continuously at
+	rate tokens per second.  A rate of 0 disables the bucket.
+
+	Tokens may be consumed past zero; the debt is paid off by the refill
+	before anything else is allowed through.
+	"""
+	def __init__(self, rate, capacity, clock=time):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = float(capacity)
+		self._clock = clock
+		self._stamp = clock()
+
+	def _refill(self):
+		now = self._clock()
+		self.tokens += (now - self._stamp) * self.rate
+		if self.tokens > self.capacity:
+			self.tokens = float(self.capacity)
+		self._stamp = now
+
+	def wait_time(self, n=1):
+		"""Seconds until n tokens are available (capped at capacity, so
+		an oversized request waits for a full bucket, not forever)."""
+		if not self.rate:
+			return 0
+		self._refill()
+		n = min(n, self.capacity)
+		if self.tokens >= n:
+			return 0
+		return (n - self.tokens) / self.rate
+
+	def consume(self, n=1):
+		if self.rate:
+			self._refill()
+			self.tokens -= n
+
+class Throttle(object):
+	"""Decides when outgoing lines may be sent, using a line budget and
+	an optional byte budget.
+
+	Attributes:
+		lines - TokenBucket counting lines.
+		bytes - TokenBucket counting bytes (disabled unless byte_rate is set).
+	"""
+	def __init__(self, delay=2, burst=5, byte_rate=0, byte_burst=0, clock=time):
+		self.lines = TokenBucket(0, burst, clock)
+		self.bytes = TokenBucket(byte_rate, byte_burst, clock)
+		self.delay = delay
+
+	@classmethod
+	def from_profile(cls, name):
+		return cls(**PROFILES[name])
+
+	@property
+	def delay(self):
+		"""Seconds per line once the burst is used up; 0 disables line
+		throttling."""
+		if self.lines.rate:
+			return 1.0 / self.lines.rate
+		return 0
+
+	@delay.setter
+	def delay(self, d):
+		self.lines.rate = d and 1.0 / d
+
+	@property
+	def burst(self):
+		"""Number of lines that may be sent back-to-back."""
+		return self.lines.capacity
+
+	@burst.setter
+	def burst(self, b):
+		self.lines.capacity = b
+
+	def wait_time(self, nbytes):
+		"""Seconds until a line of nbytes may be sent."""
+		return max(self.lines.wait_time(1), self.bytes.wait_time(nbytes))
+
+	def consume(self, nbytes):
+		self.lines.consume(1)
+		self.bytes.consume(nbytes)
+
+# Approximations of common server flood controls.
+PROFILES = {
+	# One line per two seconds with ten seconds of slack (RFC 1459 8.10).
+	'rfc1459': {'delay': 2, 'burst': 5},
+	# ircu additionally charges a second for every 120 bytes.
+	'ircu': {'delay': 2, 'burst': 5, 'byte_rate': 120, 'byte_burst': 1200},
+	# For servers that allow a larger burst, e.g. with a raised class limit.
+	'lenient': {'delay': 1, 'burst': 10},
+	'unthrottled': {'delay': 0, 'burst': 0}
+}
+
+class OutgoingQueue(object):
+	"""Outgoing lines, in one FIFO lane per priority."""
+	def __init__(self):
+		self._lanes = tuple(deque() for p in range(Priority.BULK + 1))
+
+	def __len__(self):
+		return sum(len(lane) for lane in self._lanes)
+
+	def put(self, item, priority=Priority.INTERACTIVE):
+		self._lanes[priority].append(item)
+
+	def depth(self, priority):
+		return len(self._lanes[priority])
+
+	def peek(self):
+		"""Return (priority, item) for the next item to send, or None."""
+		for priority, lane in enumerate(self._lanes):
+			if lane:
+				return priority, lane[0]
+		return None
+
+	def pop(self, priority):
+		return self._lanes[priority].popleft()
+
+class SlidingWindow(object):
+	"""Counts events over the last period seconds, approximating a true
+	sliding window from the counts in the current and previous fixed
+	windows, so it needs three numbers rather than a timestamp per
+	event."""
+	__slots__ = ('start', 'previous', 'current')
+
+	def __init__(self, now):
+		self.start = now
+		self.previous = 0
+		self.current = 0
+
+	def count(self, now, period):
+		elapsed = now - self.start
+		if elapsed >= period:
+			windows = int(elapsed // period)
+			self.previous = windows == 1 and self.current or 0
+			self.current = 0
+			self.start += windows * period
+			elapsed -= windows * period
+		return self.previous * (1 - elapsed / period) + self.current
+
+class ReplyLimiter(object):
+	"""Decides whether to answer a request, so that floods of CTCPs or
+	commands don't fill the send queue.
+
+	Each source may be answered limit times per period seconds, and all
+	sources together total times per period.  Per-source windows are
+	kept in an LRU cache of at most maxsources entries, so a flood from
+	many sources can't grow it without bound (a forgotten source simply
+	starts over).
+
+	Attributes:
+		allowed - number of requests allowed.
+		denied - number of requests refused.
+	"""
+	def __init__(self, limit=3, total=20, period=30, maxsources=1024, clock=time):
+		self.limit = limit
+		self.total = total
+		self.period = float(period)
+		self.allowed = 0
+		self.denied = 0
+		self._clock = clock
+		self._sources = LRUCache(maxsources)
+		self._global = SlidingWindow(clock())
+
+	def allow(self, source):
+		"""Count a request from source (e.g. a hostname) and return
+		whether it should be answered.  Refused requests aren't counted
+		against the budgets."""
+		now = self._clock()
+		window = self._sources.get(source)
+		if window is None:
+			window = SlidingWindow(now)
+			self._sources.put(source, window)
+		if (self.limit and window.count(now, self.period) >= self.limit) or \
+			(self.total and self._global.count(now, self.period) >= self.total):
+			self.denied += 1
+			return False
+		window.current += 1
+		self._global.current += 1
+		self.allowed += 1
+		return True
@@ -1,7 +1,10 @@
 #!/usr/bin/python
 
-#from flyrc import message, numeric
-import message, numeric
+from flyrc import compat, message, numeric
+import inspect
+import re
+import string
+from operator import methodcaller
 
 def is_ctcp(text):
 	return text[0] == '\001' and text[-1] == '\001'
@@ -18,15 +21,110 @@ def ctcp(*args):
 	cmd = ' '.join(args)
 	return "\001%s\001" % cmd
 
-def is_channel(text):
-	return not text[0].isalpha()
+# What the server is assumed to support until RPL_ISUPPORT says
+# otherwise (see handler.ISupport).
+DEFAULT_CHANTYPES = '#&'
+# (modes, prefixes), highest status first.
+DEFAULT_PREFIX = ('ov', '@+')
+# Channel modes by type: lists, always with a parameter, with a parameter
+# only when set, and never with a parameter.
+DEFAULT_CHANMODES = ('beI', 'k', 'l', 'imnpst')
 
-def is_nick(text):
-	return text[0].isalpha() and not is_server(text)
+# CASEMAPPING name -> translation table for casefolding.
+casemappings = {
+	'ascii': compat.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+	'strict-rfc1459': compat.maketrans(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+	'rfc1459': compat.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^')
+}
+
+def casefolder(casemapping):
+	"""Return a function casefolding nicks and channel names according
+	to the named CASEMAPPING, falling back to rfc1459 for unknown ones.
+	The function is a single str.translate call."""
+	table = casemappings.get(casemapping, casemappings['rfc1459'])
+	if compat.PY3:
+		return methodcaller('translate', table)
+	# unicode.translate wants a dict of ordinals rather than Python 2's
+	# 256-character str table.
+	utable = dict((i, ord(c)) for i, c in enumerate(table) if i != ord(c))
+
+	def casefold(name):
+		if isinstance(name, compat.text_type):
+			return name.translate(utable)
+		return name.translate(table)
+	return casefold
+
+# The casefold used until the server announces a CASEMAPPING.
+casefold = casefolder('rfc1459')
+
+# RPL_ISUPPORT tokens with integer values.
+ISUPPORT_INTEGERS = frozenset(['NICKLEN', 'CHANNELLEN', 'TOPICLEN', 'KICKLEN', 'AWAYLEN', 'MODES', 'MAXTARGETS', 'MONITOR', 'SILENCE'])
+
+_isupport_escape = re.compile(r'\\x([0-9A-Fa-f]{2})')
+
+def _limits(value, split_keys=False):
+	# "PRIVMSG:4,JOIN:" -> {'PRIVMSG': 4, 'JOIN': None}; with split_keys,
+	# every character of a key gets the limit ("bq:100").
+	limits = {}
+	for item in value.split(','):
+		key, _, limit = item.partition(':')
+		limit = limit.isdigit() and int(limit) or None
+		for k in (split_keys and key or [key.upper()]):
+			limits[k] = limit
+	return limits
+
+def parse_isupport(token, value):
+	"""Turn the value of an RPL_ISUPPORT token into something more
+	useful: PREFIX becomes (modes, prefixes), CHANMODES a tuple of the
+	four mode types, TARGMAX and MAXLIST dicts of limits (None meaning
+	unlimited), CASEMAPPING a lowercase name, and lengths and counts
+	integers.  Anything else is returned as a string, or True if the
+	token has no value."""
+	if value is True:
+		return True
+	value = _isupport_escape.sub(lambda m: chr(int(m.group(1), 16)), value)
+	if token == 'PREFIX':
+		if value[:1] == '(' and ')' in value:
+			modes, prefixes = value[1:].split(')', 1)
+			return modes, prefixes
+		return '', ''
+	elif token == 'CHANMODES':
+		types = tuple(value.split(',')[:4])
+		return types + ('',) * (4 - len(types))
+	elif token == 'TARGMAX':
+		return _limits(value)
+	elif token == 'MAXLIST':
+		return _limits(value, True)
+	elif token == 'CASEMAPPING':
+		return value.lower()
+	elif token in ISUPPORT_INTEGERS:
+		if value.isdigit():
+			return int(value)
+		return None
+	return value
+
+def is_channel(text, chantypes=DEFAULT_CHANTYPES):
+	return text[:1] != '' and text[0] in chantypes
+
+def is_nick(text, chantypes=DEFAULT_CHANTYPES):
+	return text[:1] != '' and text[0] not in chantypes and not is_server(text)
 
 def is_server(text):
 	return text.find('.') != -1
 
+def order_by_target(client, msg):
+	"""Order key for Client.order_key: the channel a message is
+	addressed to, so each channel's messages are handled in order."""
+	if msg.args and is_channel(msg.args[0], client.chantypes):
+		return client.casefold(msg.args[0])
+	return None
+
+def order_by_source(client, msg):
+	"""Order key for Client.order_key: the nick a message is from."""
+	if msg.source and msg.source.nick:
+		return client.casefold(msg.source.nick)
+	return None
+
 def run_client(client):
 	client.start()
 	graceful_sigint_quit(client)
@@ -43,25 +141,166 @@ def graceful_sigint_quit(client):
 			else:
 				client.shutdown()
 
+def inline(func):
+	"""Decorator marking a handler function as non-blocking.  Inline
+	handler functions are run directly by the client's dispatch loop
+	instead of in a greenlet of their own, so they must not block."""
+	func.inline = True
+	return func
+
+def blocking(func):
+	"""Decorator marking a handler function as blocking, overriding
+	INLINE on its handler class."""
+	func.inline = False
+	return func
+
+def cpu_bound(func):
+	"""Decorator marking a handler function as CPU-bound.  Instead of
+	running in the client's process, where it would hold up everything
+	else, it's called in a worker process (see offload.ProcessPool) with
+	a copy of its handler object and a stand-in for the client that
+	passes back whatever it sends."""
+	func.cpu_bound = True
+	return func
+
+def is_cpu_bound(func):
+	return getattr(func, 'cpu_bound', False)
+
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda func: False)
+
+def is_inline(func):
+	"""Whether a bound handler function should be run inline: either
+	it was marked by inline/blocking, or the class defining it sets
+	INLINE = True.  INLINE isn't inherited, so a subclass of an inline
+	handler doesn't run its own (possibly blocking) functions inline
+	unless it sets INLINE too."""
+	marked = getattr(func, 'inline', None)
+	if marked is not None:
+		return marked
+	if _iscoroutinefunction(func):
+		# Coroutines have to be awaited (see aio.Client).
+		return False
+	owner = getattr(func, '__self__', None)
+	if owner is None:
+		return False
+	target = getattr(func, '__func__', func)
+	for cls in handler_class(owner.__class__).mro:
+		attrs = vars(cls)
+		if any(value is target for value in attrs.values()):
+			return attrs.get('INLINE', False)
+	return False
+
+def subscribe(*patterns):
+	"""Decorator subscribing a handler function to every event matching
+	one of patterns, in addition to any event its irc_ name gives it.
+	A pattern is an event name, a prefix ending in '*' (e.g.
+	'ctcp_request_*'), or a range of numerics (e.g. '311-319').  Numeric
+	names work too, so 'RPL_WHOIS*' covers every RPL_WHOIS numeric.
+
+	Pattern handler functions are called with the event name after the
+	client: func(client, event, *args)."""
+	def mark(func):
+		func.patterns = getattr(func, 'patterns', ()) + patterns
+		return func
+	return mark
+
+def expand_pattern(pattern):
+	"""Split a subscription pattern into (exact event names, prefix or
+	None)."""
+	if '-' in pattern:
+		low, _, high = pattern.partition('-')
+		if low.isdigit() and high.isdigit():
+			return ['%03d' % n for n in range(int(low), int(high) + 1)], None
+	if pattern[-1:] != '*':
+		return [event_name(pattern)], None
+	prefix = pattern[:-1]
+	# A prefix of numeric names stands for the numerics themselves.
+	numerics = [numeric_events[name] for name in _numeric_names if name.startswith(prefix)]
+	if prefix and numerics:
+		return numerics, None
+	return [], prefix
+
+def handler_name(func):
+	"""A readable name for a bound handler function, e.g. Ping.irc_PING."""
+	owner = getattr(func, '__self__', None)
+	name = getattr(func, '__name__', None) or repr(func)
+	if owner is None:
+		return name
+	return "%s.%s" % (owner.__class__.__name__, name)
+
+# Numeric name -> numeric, e.g. 'RPL_WELCOME' -> '001'.
+numeric_events = dict((name, value) for name, value in vars(numeric).items() if name[:1] != '_' and isinstance(value, str))
+
+def event_name(name):
+	"""The event handled by a handler function named irc_<name>.
+	Numeric names resolve to the numeric, so irc_RPL_WELCOME and irc_001
+	handle the same event."""
+	return numeric_events.get(name, name)
+
+class HandlerClass(object):
+	"""What a handler class handles, worked out once per class and
+	shared by every instance of it in every client.
+
+	Attributes:
+		events - (event name, attribute name) for each irc_ function.
+		patterns - names of the functions with pattern subscriptions.
+		mro - the class and its bases, most derived first.
+	"""
+	__slots__ = ('events', 'patterns', 'mro')
+
+	def __init__(self, cls):
+		events = []
+		patterns = []
+		for item in dir(cls):
+			attr = getattr(cls, item, None)
+			if not hasattr(attr, '__call__'):
+				continue
+			if item[:4] == "irc_":
+				events.append((event_name(item[4:]), item))
+			if getattr(attr, 'patterns', None):
+				patterns.append(item)
+		self.events = tuple(events)
+		self.patterns = tuple(patterns)
+		self.mro = inspect.getmro(cls)
+
+_handler_classes = {}
+
+def handler_class(cls):
+	"""The HandlerClass for cls, cached."""
+	info = _handler_classes.get(cls)
+	if info is None:
+		info = _handler_classes[cls] = HandlerClass(cls)
+	return info
+
+def get_handler_patterns(h):
+	"""Return (pattern, func) for each pattern a handler subscribes to
+	(see subscribe)."""
+	patterns = []
+	for item in handler_class(h.__class__).patterns:
+		func = getattr(h, item)
+		for pattern in func.patterns:
+			patterns.append((pattern, func))
+	return patterns
+
 def get_handler_properties(h):
 	handler_deps = getattr(h, 'DEPENDENCIES', [])
 	handler_funcs = {}
-	for item in dir(h):
+	# It shouldn't be possible for a module to add two
+	# different handlers for the same event (but
+	# technically it is, due to the numerics).
+	# We're only going to allow one, however.
+	for h_name, item in handler_class(h.__class__).events:
+		handler_funcs[h_name] = getattr(h, item)
+	# Handler functions can also be attached to the instance itself.
+	for item in getattr(h, '__dict__', ()):
 		if item[:4] == "irc_":
-			h_name = item[4:]
 			func = getattr(h, item)
-			if not hasattr(func, '__call__'):
-				continue
-
-			h_name = getattr(numeric, h_name, h_name)
-
-			# It shouldn't be possible for a module to add two
-			# different handlers for the same event (but
-			# technically it is, due to the numerics).
-			# We're only going to allow one, however.
-			handler_funcs[h_name] = func
+			if hasattr(func, '__call__'):
+				handler_funcs[event_name(item[4:])] = func
 	return handler_deps, handler_funcs
 
+_numeric_names = [name for name in numeric_events if name[:4] in ('RPL_', 'ERR_')]
+
 channel_status_map = {
 	'+': 'voice',
 	'%': 'halfop',
@@ -5,7 +5,7 @@ setup(
 	version='0.1.1',
 	author='Keith Buck',
 	author_email='mr_flea@esper.net',
-	packages=['flyrc'],
+	packages=['flyrc', 'flyrc.bench'],
 	url='https://github.com/mrflea/flyrc',
 	license='LICENSE.txt',
 	description='Fully-featured IRC client library.',
@@ -17,10 +17,11 @@ setup(
 		"Operating System :: OS Independent",
 		"Programming Language :: Python",
 		"Programming Language :: Python :: 2",
+		"Programming Language :: Python :: 3",
 		"Topic :: Communications :: Chat :: Internet Relay Chat",
 		"Topic :: Software Development :: Libraries :: Python Modules"
 	],
 	install_requires=[
-		'gevent >= 0.13.6'
+		'gevent >= 20.12.0'
 	]
 )